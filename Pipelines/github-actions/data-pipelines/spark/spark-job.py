@@ -13,27 +13,82 @@ This script demonstrates production-ready Spark ETL patterns including:
 """
 
 import argparse
+import base64
+import hashlib
+import json
 import logging
+import math
 import os
+import re
+import shlex
+import subprocess
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional, Tuple
+from urllib.error import URLError
+from urllib.parse import urlparse
+from urllib.request import urlopen
 
-from pyspark.sql import SparkSession, DataFrame
+from pyspark import SparkConf, SparkContext
+from pyspark.sql import SparkSession, DataFrame, Observation, Column
 from pyspark.sql.functions import (
     col, lit, when, coalesce, regexp_replace, trim, upper, lower,
     sum as spark_sum, count as spark_count, avg, max as spark_max, min as spark_min,
     year, month, dayofmonth, hour, date_format, to_timestamp, current_timestamp,
-    broadcast, expr, split, explode, collect_list, size, isnan, isnull,
-    row_number, rank, dense_rank, lag, lead, first, last
+    broadcast, expr, split, explode, collect_list, collect_set, size, isnan, isnull,
+    row_number, rank, dense_rank, lag, lead, first, last,
+    approx_count_distinct, xxhash64, octet_length, array,
+    concat, lpad, struct, round as spark_round, flatten, array_sort
 )
 from pyspark.sql.types import (
     StructType, StructField, StringType, IntegerType, DoubleType, 
-    TimestampType, BooleanType, ArrayType, MapType
+    TimestampType, BooleanType, ArrayType, MapType, FloatType, NumericType, BinaryType, LongType
 )
+from pyspark.sql.streaming.state import GroupStateTimeout
 from pyspark.sql.window import Window
 from pyspark.storagelevel import StorageLevel
 
+# Optional: parquet footer statistics for join size estimation
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pads = None
+    pafs = None
+    pq = None
+
+try:
+    from delta.tables import DeltaTable
+except ImportError:
+    DeltaTable = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    from deltalake import write_deltalake
+except ImportError:
+    write_deltalake = None
+
+try:
+    import numpy as np
+    import pandas as pd
+    import pandas.testing as pd_testing
+except ImportError:
+    np = None
+    pd = None
+    pd_testing = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -45,6 +100,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Mirrors quality_thresholds in get_pipeline_config of airflow/dags/example_dag.py
+DEFAULT_QUALITY_THRESHOLDS = {
+    'min_row_count': 1000,
+    'max_null_percentage': 5.0,
+    'max_duplicate_percentage': 1.0,
+    'freshness_hours': 24
+}
+
+DEFAULT_BROADCAST_THRESHOLD_BYTES = 64 * 1024 * 1024
+DEFAULT_TARGET_FILE_SIZE_MB = 128
+# spark.sql.optimizer.runtime.bloomFilter.maxNumBits: the filter is shipped inside the plan of every task
+DEFAULT_BLOOM_MAX_NUM_BITS = 67108864
+
+# Declared keys of the processed outputs, used by upsert writes
+OUTPUT_MERGE_KEYS = {
+    "processed_customers": ["customer_id"],
+    "processed_transactions": ["transaction_id"],
+    "analytical_aggregates": ["transaction_date", "transaction_country", "payment_method"],
+    "analytical_aggregates_daily": ["transaction_date"],
+    "analytical_aggregates_country": ["transaction_country"],
+    # Single-row table: the constant source column is its key
+    "analytical_aggregates_total": ["data_source"]
+}
+
+# Fields an upsert compares to decide whether a matched row changed: the source fields plus the
+# country ranks and per-customer window features, which incremental runs recompute over the full
+# history of every customer and country a batch touches. Derived columns that move on every run
+# (days_since_registration from current_date(), joined customer attributes) are only rewritten
+# with such a change. Outputs not listed here compare every non-key column.
+OUTPUT_CHANGE_COLUMNS = {
+    "processed_customers": ["first_name", "last_name", "email", "phone_cleaned", "country",
+                            "registration_timestamp", "age", "lifetime_value", "customer_rank_in_country"],
+    "processed_transactions": ["customer_id", "amount", "merchant_id", "transaction_timestamp",
+                               "status", "payment_method", "transaction_country",
+                               "transaction_sequence", "days_since_last_transaction", "total_transactions",
+                               "total_amount", "first_transaction_date", "last_transaction_date",
+                               "unique_merchants_count"]
+}
+
+# Aggregate output tables and the dimensions each one is grouped by - all computed in one pass
+AGGREGATE_GRAINS = {
+    "analytical_aggregates": ["transaction_date", "transaction_country", "payment_method"],
+    "analytical_aggregates_daily": ["transaction_date"],
+    "analytical_aggregates_country": ["transaction_country"],
+    "analytical_aggregates_total": []
+}
+
+# Read-time contracts for the raw inputs - only the columns the transforms use are projected
+SCHEMA_CONTRACTS = {
+    "customers": StructType([
+        StructField("customer_id", StringType()),
+        StructField("first_name", StringType()),
+        StructField("last_name", StringType()),
+        StructField("email", StringType()),
+        StructField("phone", StringType()),
+        StructField("country", StringType()),
+        StructField("registration_date", StringType()),
+        StructField("age", IntegerType()),
+        StructField("lifetime_value", DoubleType())
+    ]),
+    "transactions": StructType([
+        StructField("transaction_id", StringType()),
+        StructField("user_id", StringType()),
+        StructField("amount", DoubleType()),
+        StructField("merchant_id", StringType()),
+        StructField("timestamp", LongType()),  # epoch milliseconds
+        StructField("status", StringType()),
+        StructField("payment_method", StringType()),
+        StructField("location", StructType([StructField("country", StringType())]))
+    ])
+}
+
 
 class SparkJobConfig:
     """Configuration class for Spark job parameters"""
@@ -63,13 +190,552 @@ class SparkJobConfig:
         self.enable_adaptive_query = args.enable_adaptive_query
         self.max_records_per_file = args.max_records_per_file
         self.coalesce_partitions = args.coalesce_partitions
+        self.exact_duplicates = args.exact_duplicates
+        self.quality_mode = args.quality_mode
+        self.sketch_path = args.sketch_path or f"{args.checkpoint_path or args.output_path}/_quality_sketches"
+        self.refresh_sketches = args.refresh_sketches
+        self.broadcast_threshold_bytes = args.broadcast_threshold_mb * 1024 * 1024
+        self.incremental = args.incremental
+        self.full_refresh = args.full_refresh
+        self.incremental_lookback_ms = int(args.incremental_lookback_hours * 60 * 60 * 1000)
+        self.state_path = args.state_path or f"{args.checkpoint_path or args.output_path}/_ingestion_state"
+        self.file_index_path = args.file_index_path or f"{args.checkpoint_path or args.output_path}/_file_index"
+        self.file_index_refresh_partitions = args.file_index_refresh_partitions
+        self.file_index_full_relist_hours = args.file_index_full_relist_hours
+        self.schema_cache_path = args.schema_cache_path or f"{args.checkpoint_path or args.output_path}/_schema_fingerprints"
+        # Keep the historical behaviour: checkpoint whenever a checkpoint directory is given
+        if args.materialization == "auto":
+            self.materialization = "checkpoint" if args.checkpoint_path else "none"
+        else:
+            self.materialization = args.materialization
+        self.materialization_path = f"{args.checkpoint_path or args.output_path}/_materialized"
+        self.jar_cache_dir = args.jar_cache_dir or os.environ.get(
+            "SPARK_JAR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "spark-jars")
+        )
+        self.mode = args.mode
+        self.engine = args.engine
+        self.duckdb_max_input_bytes = args.duckdb_max_input_mb * 1024 * 1024
+        self.scale_factors = [float(f) for f in args.scale_factors.split(',')]
+        self.skew = args.skew
+        self.null_rate = args.null_rate
+        self.benchmark_iterations = args.benchmark_iterations
+        self.benchmark_results_path = args.benchmark_results_path or f"{args.output_path}/_benchmarks"
+        self.benchmark_compare = args.benchmark_compare
+        self.plan_baseline_path = args.plan_baseline or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "plan_baseline.json"
+        )
+        self.plan_fixture_path = args.plan_fixture_path or f"{args.output_path}/_plan_fixtures"
+        self.update_plan_baseline = args.update_plan_baseline
+        self.metrics_path = args.metrics_path or f"{args.output_path}/_pipeline_metrics"
+        self.write_mode = args.write_mode
+        self.write_concurrency = args.write_concurrency
+        self.driver_concurrency = args.driver_concurrency
+        self.target_file_size_bytes = args.target_file_size_mb * 1024 * 1024
+        self.aggregate_grains = args.aggregate_grains.split(',') if args.aggregate_grains else list(AGGREGATE_GRAINS)
+        unknown_grains = [name for name in self.aggregate_grains if name not in AGGREGATE_GRAINS]
+        if unknown_grains:
+            raise ValueError(f"Unknown aggregate grains {unknown_grains}, declared: {list(AGGREGATE_GRAINS)}")
+        self.streaming_trigger = args.streaming_trigger
+        self.streaming_interval = args.streaming_interval
+        self.streaming_watermark = args.streaming_watermark
+        self.streaming_state_ttl_days = args.streaming_state_ttl_days
+        self.streaming_max_files_per_trigger = args.streaming_max_files_per_trigger
+        self.streaming_format = args.streaming_format
+        self.streaming_checkpoint_path = args.streaming_checkpoint_path or \
+            f"{args.checkpoint_path or args.output_path}/_streaming/transactions"
+        # Appending a batch's aggregates would split groups that were already written
+        self.incremental_aggregates = args.incremental_aggregates or args.incremental
+        if self.incremental_aggregates and "analytical_aggregates" not in self.aggregate_grains:
+            raise ValueError("Incremental aggregates refresh analytical_aggregates and roll the other grains up from it")
+        self.bloom_prefilter = args.bloom_prefilter
+        self.bloom_fpp = args.bloom_fpp
+        self.bloom_max_num_bits = args.bloom_max_num_bits
+        self.skew_join = args.skew_join
+        self.skew_threshold = args.skew_threshold
+        self.skew_salt_buckets = args.skew_salt_buckets
+        self.skew_sample_fraction = args.skew_sample_fraction
+        self.quality_thresholds = json.loads(args.quality_thresholds) if args.quality_thresholds else DEFAULT_QUALITY_THRESHOLDS
+
+
+def _is_hidden_path(relative_path: str) -> bool:
+    """Same rule Spark uses to skip metadata files (_SUCCESS, .crc, _delta_log, _temporary)"""
+    for segment in relative_path.split('/'):
+        if segment.startswith('.') or (segment.startswith('_') and '=' not in segment):
+            return True
+    return False
+
+
+class LocalFileSystemBackend:
+    """Driver-side file access for local paths (also used for offline testing)"""
+    
+    @staticmethod
+    def _local_path(path: str) -> str:
+        parsed = urlparse(path)
+        return parsed.path if parsed.scheme == "file" else path
+    
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self._local_path(path))
+    
+    def read_text(self, path: str) -> str:
+        with open(self._local_path(path), "r", encoding="utf-8") as handle:
+            return handle.read()
+    
+    def write_text(self, path: str, content: str) -> None:
+        """Write atomically so readers never observe a partial file"""
+        local_path = self._local_path(path)
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        tmp_path = f"{local_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            handle.write(content)
+        os.replace(tmp_path, local_path)
+    
+    def list_dir(self, path: str) -> List[Dict[str, any]]:
+        """Immediate children of a directory"""
+        root = self._local_path(path).rstrip('/')
+        if not os.path.isdir(root):
+            return []
+        entries = []
+        for entry in os.scandir(root):
+            stat = entry.stat()
+            entries.append({'name': entry.name, 'path': entry.path, 'is_dir': entry.is_dir(),
+                            'size': 0 if entry.is_dir() else stat.st_size, 'mtime': int(stat.st_mtime * 1000)})
+        return entries
+    
+    def list_files(self, path: str) -> List[Dict[str, any]]:
+        """Recursively list data files with size and modification time (ms)"""
+        root = self._local_path(path).rstrip('/')
+        files = []
+        for directory, _, names in os.walk(root):
+            for name in names:
+                file_path = os.path.join(directory, name)
+                if _is_hidden_path(os.path.relpath(file_path, root)):
+                    continue
+                stat = os.stat(file_path)
+                files.append({'path': file_path, 'size': stat.st_size, 'mtime': int(stat.st_mtime * 1000)})
+        return files
+
+
+class HadoopFileSystemBackend:
+    """Driver-side file access through the Hadoop FileSystem API (s3a, abfss, hdfs, ...)"""
+    
+    def __init__(self, spark: SparkSession, path: str):
+        self._jvm = spark._jvm
+        hadoop_conf = spark._jsc.hadoopConfiguration()
+        self._fs = self._jvm.org.apache.hadoop.fs.Path(path).getFileSystem(hadoop_conf)
+    
+    def _path(self, path: str):
+        return self._jvm.org.apache.hadoop.fs.Path(path)
+    
+    def exists(self, path: str) -> bool:
+        return self._fs.exists(self._path(path))
+    
+    def read_text(self, path: str) -> str:
+        stream = self._fs.open(self._path(path))
+        try:
+            return self._jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+        finally:
+            stream.close()
+    
+    def write_text(self, path: str, content: str) -> None:
+        stream = self._fs.create(self._path(path), True)
+        try:
+            stream.write(bytearray(content.encode("utf-8")))
+        finally:
+            stream.close()
+    
+    def list_dir(self, path: str) -> List[Dict[str, any]]:
+        """Immediate children of a directory (directories on object stores report mtime 0)"""
+        if not self._fs.exists(self._path(path)):
+            return []
+        entries = []
+        for status in self._fs.listStatus(self._path(path)):
+            entries.append({'name': status.getPath().getName(), 'path': status.getPath().toString(),
+                            'is_dir': status.isDirectory(), 'size': status.getLen(),
+                            'mtime': status.getModificationTime()})
+        return entries
+    
+    def list_files(self, path: str) -> List[Dict[str, any]]:
+        """Recursively list data files with size and modification time (ms) - a flat listing on object stores"""
+        root = path.rstrip('/')
+        files = []
+        if not self._fs.exists(self._path(root)):
+            return files
+        
+        iterator = self._fs.listFiles(self._path(root), True)
+        while iterator.hasNext():
+            status = iterator.next()
+            file_path = status.getPath().toString()
+            relative_path = file_path.split(root.split('://')[-1], 1)[-1].lstrip('/')
+            if _is_hidden_path(relative_path):
+                continue
+            files.append({'path': file_path, 'size': status.getLen(), 'mtime': status.getModificationTime()})
+        return files
+
+
+def get_filesystem_backend(spark: Optional[SparkSession], path: str):
+    """Pick the filesystem backend for a path - local paths never need the JVM"""
+    if spark is None or urlparse(path).scheme in ("", "file"):
+        return LocalFileSystemBackend()
+    return HadoopFileSystemBackend(spark, path)
+
+
+def _sql_literal(value) -> str:
+    """Render a collected value as a Spark SQL literal for pushed-down predicates"""
+    if isinstance(value, (int, float)):
+        return repr(value)
+    escaped = str(value).replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
+class HyperLogLogSketch:
+    """Mergeable HyperLogLog distinct-count sketch over the registers of GrainAggregator.register_code"""
+    
+    def __init__(self, precision: int = 12, registers: Optional[bytearray] = None):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.num_registers)
+    
+    @property
+    def relative_error(self) -> float:
+        """Standard error of the estimate relative to the true distinct count"""
+        return 1.04 / math.sqrt(self.num_registers)
+    
+    def add_codes(self, codes) -> None:
+        """Fold in an array of register * 64 + rank codes"""
+        np.maximum.at(np.frombuffer(self.registers, dtype=np.uint8), codes // 64, (codes % 64).astype(np.uint8))
+    
+    def merge(self, other: "HyperLogLogSketch") -> "HyperLogLogSketch":
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HLL sketches with precision {self.precision} and {other.precision}")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+    
+    def estimate(self) -> int:
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw_estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zero_registers = self.registers.count(0)
+        
+        # Linear counting is more accurate for small cardinalities
+        if raw_estimate <= 2.5 * m and zero_registers > 0:
+            return int(round(m * math.log(m / zero_registers)))
+        return int(round(raw_estimate))
+    
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(zlib.compress(bytes(self.registers))).decode("ascii")
+        }
+    
+    @classmethod
+    def from_dict(cls, payload: Dict[str, any]) -> "HyperLogLogSketch":
+        registers = bytearray(zlib.decompress(base64.b64decode(payload['registers'])))
+        return cls(payload['precision'], registers)
+
+
+class TDigestSketch:
+    """Mergeable t-digest for approximate quantiles (merging variant)"""
+    
+    def __init__(self, compression: float = 100.0):
+        self.compression = compression
+        self.centroids: List[List[float]] = []
+        self.min_value: Optional[float] = None
+        self.max_value: Optional[float] = None
+    
+    def _scale(self, q: float) -> float:
+        q = min(max(q, 0.0), 1.0)
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+    
+    @classmethod
+    def from_values(cls, values, compression: float = 100.0) -> "TDigestSketch":
+        """Digest of an array of values in one vectorized pass: the sorted values are cut wherever the
+        scale function crosses a whole unit, the bound the merging pass keeps every centroid within"""
+        digest = cls(compression)
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        if len(values) == 0:
+            return digest
+        
+        q = (np.arange(len(values)) + 0.5) / len(values)
+        units = np.floor(compression / (2 * math.pi) * np.arcsin(2 * q - 1) - digest._scale(0.0)).astype(np.int64)
+        starts = np.flatnonzero(np.concatenate(([True], units[1:] != units[:-1])))
+        weights = np.diff(np.append(starts, len(values)))
+        means = np.add.reduceat(values, starts) / weights
+        digest.centroids = [[float(m), float(w)] for m, w in zip(means, weights)]
+        digest.min_value, digest.max_value = float(values[0]), float(values[-1])
+        return digest
+    
+    def _compress(self) -> None:
+        items = sorted(self.centroids, key=lambda c: c[0])
+        if not items:
+            return
+        
+        total_weight = sum(w for _, w in items)
+        merged = []
+        current_mean, current_weight = items[0]
+        weight_so_far = 0.0
+        lower_scale = self._scale(0.0)
+        
+        # Greedily merge neighbours while the centroid stays within one unit of the scale function
+        for mean, weight in items[1:]:
+            q = (weight_so_far + current_weight + weight) / total_weight
+            if self._scale(q) - lower_scale <= 1.0:
+                current_weight += weight
+                current_mean += (mean - current_mean) * weight / current_weight
+            else:
+                merged.append([current_mean, current_weight])
+                weight_so_far += current_weight
+                lower_scale = self._scale(weight_so_far / total_weight)
+                current_mean, current_weight = mean, weight
+        merged.append([current_mean, current_weight])
+        self.centroids = merged
+    
+    def merge(self, other: "TDigestSketch") -> "TDigestSketch":
+        other._compress()
+        self.centroids = self.centroids + [list(c) for c in other.centroids]
+        for bound in (other.min_value, other.max_value):
+            if bound is not None:
+                self.min_value = bound if self.min_value is None else min(self.min_value, bound)
+                self.max_value = bound if self.max_value is None else max(self.max_value, bound)
+        self._compress()
+        return self
+    
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        
+        total_weight = sum(w for _, w in self.centroids)
+        target = q * total_weight
+        cumulative = 0.0
+        previous_center, previous_mean = 0.0, self.min_value
+        
+        # Interpolate between centroid centres, anchored at the observed min/max
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target < center:
+                span = center - previous_center
+                fraction = (target - previous_center) / span if span > 0 else 0.0
+                return previous_mean + (mean - previous_mean) * fraction
+            previous_center, previous_mean = center, mean
+            cumulative += weight
+        
+        span = total_weight - previous_center
+        fraction = (target - previous_center) / span if span > 0 else 0.0
+        return previous_mean + (self.max_value - previous_mean) * fraction
+    
+    def to_dict(self) -> Dict[str, any]:
+        self._compress()
+        return {
+            'compression': self.compression,
+            'min': self.min_value,
+            'max': self.max_value,
+            'centroids': self.centroids
+        }
+    
+    @classmethod
+    def from_dict(cls, payload: Dict[str, any]) -> "TDigestSketch":
+        digest = cls(payload['compression'])
+        digest.centroids = [list(c) for c in payload['centroids']]
+        digest.min_value = payload['min']
+        digest.max_value = payload['max']
+        return digest
+
+
+class ColumnSketch:
+    """Null counter, distinct sketch and (for numeric columns) moments and quantiles of one column"""
+    
+    def __init__(self, numeric: bool, precision: int = 12, compression: float = 100.0):
+        self.numeric = numeric
+        self.null_count = 0
+        self.value_count = 0
+        self.value_sum = 0.0
+        self.distinct = HyperLogLogSketch(precision)
+        self.quantiles = TDigestSketch(compression) if numeric else None
+    
+    def add_batch(self, codes, values=None) -> None:
+        """Add a pandas batch of the column's register codes (null for nulls) and, if numeric, its values"""
+        present = codes.notna()
+        if values is not None:
+            # NaN counts as null, as in the exact profile
+            present &= values.notna()
+        self.null_count += int(len(codes) - present.sum())
+        self.distinct.add_codes(codes[present].to_numpy(dtype=np.int64))
+        if self.numeric:
+            observed = values[present].to_numpy(dtype=np.float64)
+            self.value_count += len(observed)
+            self.value_sum += float(observed.sum())
+            self.quantiles.merge(TDigestSketch.from_values(observed, self.quantiles.compression))
+    
+    def merge(self, other: "ColumnSketch") -> "ColumnSketch":
+        self.null_count += other.null_count
+        self.value_count += other.value_count
+        self.value_sum += other.value_sum
+        self.distinct.merge(other.distinct)
+        if self.numeric and other.numeric:
+            self.quantiles.merge(other.quantiles)
+        return self
+    
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            'numeric': self.numeric,
+            'null_count': self.null_count,
+            'value_count': self.value_count,
+            'value_sum': self.value_sum,
+            'distinct': self.distinct.to_dict(),
+            'quantiles': self.quantiles.to_dict() if self.numeric else None
+        }
+    
+    @classmethod
+    def from_dict(cls, payload: Dict[str, any]) -> "ColumnSketch":
+        sketch = cls(payload['numeric'], payload['distinct']['precision'])
+        sketch.null_count = payload['null_count']
+        sketch.value_count = payload['value_count']
+        sketch.value_sum = payload['value_sum']
+        sketch.distinct = HyperLogLogSketch.from_dict(payload['distinct'])
+        sketch.quantiles = TDigestSketch.from_dict(payload['quantiles']) if payload['numeric'] else None
+        return sketch
+
+
+class ProfileSketch:
+    """Mergeable data quality profile of one dataset partition (or a merged window of partitions)"""
+    
+    # Sidecars of another format hash differently and cannot be merged with this one
+    FORMAT_VERSION = 2
+    
+    # Duplicates are total minus distinct rows, so the row sketch needs a tighter error than columns
+    ROW_PRECISION = 16
+    
+    def __init__(self, dataset: str, partitions: List[str], columns: Dict[str, ColumnSketch],
+                 total_rows: int = 0, rows: Optional[HyperLogLogSketch] = None, row_precision: int = ROW_PRECISION):
+        self.dataset = dataset
+        self.partitions = partitions
+        self.columns = columns
+        self.total_rows = total_rows
+        self.rows = rows or HyperLogLogSketch(row_precision)
+    
+    @classmethod
+    def empty(cls, dataset: str, partition: str, schema: StructType,
+              precision: int = 12, compression: float = 100.0) -> "ProfileSketch":
+        columns = {
+            f.name: ColumnSketch(isinstance(f.dataType, NumericType), precision, compression)
+            for f in schema.fields
+        }
+        return cls(dataset, [partition], columns)
+    
+    def add_batch(self, batch) -> None:
+        """Add a pandas batch of register codes - r for the row, c<i> for the i-th column - and
+        the numeric columns' values as v<i>"""
+        self.total_rows += len(batch)
+        self.rows.add_codes(batch["r"].to_numpy(dtype=np.int64))
+        for i, sketch in enumerate(self.columns.values()):
+            sketch.add_batch(batch[f"c{i}"], batch[f"v{i}"] if sketch.numeric else None)
+    
+    def merge(self, other: "ProfileSketch") -> "ProfileSketch":
+        self.total_rows += other.total_rows
+        self.rows.merge(other.rows)
+        self.partitions = sorted(set(self.partitions) | set(other.partitions))
+        for name, sketch in other.columns.items():
+            if name in self.columns:
+                self.columns[name].merge(sketch)
+            else:
+                self.columns[name] = sketch
+        return self
+    
+    def to_quality_report(self) -> Dict[str, any]:
+        """Render the sketch in the same shape as DataQualityValidator.check_data_quality"""
+        total_rows = self.total_rows
+        quality_report = {
+            'total_rows': total_rows,
+            'null_counts': {},
+            'duplicate_count': 0,
+            'column_stats': {}
+        }
+        quality_report.update(DataQualityValidator.estimated_duplicates(
+            total_rows, self.rows.estimate(), self.rows.relative_error
+        ))
+        
+        for name, sketch in self.columns.items():
+            quality_report['null_counts'][name] = {
+                'count': sketch.null_count,
+                'percentage': (sketch.null_count / total_rows * 100) if total_rows > 0 else 0
+            }
+            if sketch.numeric:
+                quality_report['column_stats'][name] = {
+                    'min': sketch.quantiles.min_value,
+                    'max': sketch.quantiles.max_value,
+                    'avg': sketch.value_sum / sketch.value_count if sketch.value_count else None,
+                    'p50': sketch.quantiles.quantile(0.5),
+                    'p95': sketch.quantiles.quantile(0.95),
+                    'p99': sketch.quantiles.quantile(0.99),
+                    'distinct_estimate': sketch.distinct.estimate()
+                }
+        
+        return quality_report
+    
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            'format': self.FORMAT_VERSION,
+            'dataset': self.dataset,
+            'partitions': self.partitions,
+            'total_rows': self.total_rows,
+            'rows': self.rows.to_dict(),
+            'columns': {name: sketch.to_dict() for name, sketch in self.columns.items()}
+        }
+    
+    @classmethod
+    def from_dict(cls, payload: Dict[str, any]) -> "ProfileSketch":
+        rows = HyperLogLogSketch.from_dict(payload['rows'])
+        columns = {name: ColumnSketch.from_dict(c) for name, c in payload['columns'].items()}
+        return cls(payload['dataset'], payload['partitions'], columns, payload['total_rows'], rows)
+
+
+class SketchStore:
+    """Per-partition profile sketches persisted as small JSON sidecar files"""
+    
+    def __init__(self, spark: SparkSession, base_path: str):
+        self.base_path = base_path.rstrip('/')
+        self.backend = get_filesystem_backend(spark, self.base_path)
+    
+    def sidecar_path(self, dataset: str, partition: str) -> str:
+        return f"{self.base_path}/{dataset}/data_date={partition}/profile.sketch.json"
+    
+    def load(self, dataset: str, partition: str) -> Optional[ProfileSketch]:
+        path = self.sidecar_path(dataset, partition)
+        if not self.backend.exists(path):
+            return None
+        payload = json.loads(self.backend.read_text(path))
+        if payload.get('format') != ProfileSketch.FORMAT_VERSION:
+            logger.warning(f"Ignoring {path} - sketch format {payload.get('format', 1)}, expected {ProfileSketch.FORMAT_VERSION}")
+            return None
+        return ProfileSketch.from_dict(payload)
+    
+    def save(self, sketch: ProfileSketch) -> None:
+        for partition in sketch.partitions:
+            self.backend.write_text(self.sidecar_path(sketch.dataset, partition), json.dumps(sketch.to_dict()))
+    
+    def load_window(self, dataset: str, end_date: str, days: int) -> Optional[ProfileSketch]:
+        """Merge the sidecars of the trailing window ending at end_date without touching raw data"""
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+        merged = None
+        for offset in range(days):
+            partition = (end - timedelta(days=offset)).strftime('%Y-%m-%d')
+            sketch = self.load(dataset, partition)
+            if sketch is not None:
+                merged = sketch if merged is None else merged.merge(sketch)
+        return merged
 
 
 class DataQualityValidator:
     """Data quality validation utilities"""
     
+    # Standard errors of a distinct-row estimate whose duplicate count is indistinguishable from noise
+    DUPLICATE_ERROR_SIGMAS = 3
+    
     @staticmethod
-    def validate_schema(df: DataFrame, expected_schema: StructType) -> Tuple[bool, List[str]]:
+    def validate_schema(df: DataFrame, expected_schema: StructType,
+                        allow_extra_nested_fields: bool = False) -> Tuple[bool, List[str]]:
         """Validate DataFrame schema against expected schema"""
         errors = []
         
@@ -78,247 +744,2019 @@ class DataQualityValidator:
                 errors.append(f"Missing column: {expected_field.name}")
             else:
                 actual_field = next((f for f in df.schema.fields if f.name == expected_field.name), None)
-                if actual_field and actual_field.dataType != expected_field.dataType:
+                if allow_extra_nested_fields:
+                    compatible = DataQualityValidator._is_type_compatible(actual_field.dataType, expected_field.dataType)
+                else:
+                    compatible = actual_field.dataType == expected_field.dataType
+                if actual_field and not compatible:
                     errors.append(f"Type mismatch for {expected_field.name}: expected {expected_field.dataType}, got {actual_field.dataType}")
         
         return len(errors) == 0, errors
     
     @staticmethod
-    def check_data_quality(df: DataFrame) -> Dict[str, any]:
-        """Comprehensive data quality checks"""
-        total_rows = df.count()
+    def _is_type_compatible(actual, expected) -> bool:
+        """Structs only need the expected nested fields (nested column pruning); other types must match"""
+        if isinstance(expected, StructType) and isinstance(actual, StructType):
+            actual_fields = {f.name: f.dataType for f in actual.fields}
+            return all(
+                f.name in actual_fields and DataQualityValidator._is_type_compatible(actual_fields[f.name], f.dataType)
+                for f in expected.fields
+            )
+        return actual == expected
+    
+    @staticmethod
+    def _build_profile_expressions(df: DataFrame, duplicate_rsd: float) -> Tuple[List, List[str]]:
+        """Build the aggregate expressions for a single-pass profile of every column"""
+        profile_exprs = [spark_count(lit(1)).alias("__total_rows")]
+        
+        # Null/NaN counters - NaN only exists for floating point columns
+        for idx, field in enumerate(df.schema.fields):
+            null_condition = col(field.name).isNull()
+            if isinstance(field.dataType, (DoubleType, FloatType)):
+                null_condition = null_condition | isnan(col(field.name))
+            profile_exprs.append(spark_count(when(null_condition, True)).alias(f"__nulls_{idx}"))
+        
+        # Min/max/avg for numeric columns in the same pass
+        numeric_columns = [f.name for f in df.schema.fields if isinstance(f.dataType, NumericType)]
+        for idx, column in enumerate(numeric_columns):
+            profile_exprs.extend([
+                spark_min(col(column)).alias(f"__min_{idx}"),
+                spark_max(col(column)).alias(f"__max_{idx}"),
+                avg(col(column)).alias(f"__avg_{idx}")
+            ])
+        
+        # Duplicate estimate from the distinct count of a full-row hash (map columns cannot be hashed)
+        hashable_columns = [col(f.name) for f in df.schema.fields if not isinstance(f.dataType, MapType)]
+        if hashable_columns:
+            profile_exprs.append(
+                approx_count_distinct(xxhash64(*hashable_columns), rsd=duplicate_rsd).alias("__distinct_rows")
+            )
+        
+        return profile_exprs, numeric_columns
+    
+    @staticmethod
+    def estimated_duplicates(total_rows: int, distinct_estimate: int, relative_error: float) -> Dict[str, any]:
+        """Duplicate count fields of a quality report from a distinct-row estimate
+        
+        The estimate's error is a fraction of the row count, as large as a typical duplicate threshold,
+        so a count within DUPLICATE_ERROR_SIGMAS standard errors is reported as 0 rather than failing
+        unique data with phantom duplicates; the bound is reported with it.
+        """
+        error_bound = math.ceil(DataQualityValidator.DUPLICATE_ERROR_SIGMAS * relative_error * total_rows)
+        duplicates = max(total_rows - min(distinct_estimate, total_rows), 0)
+        return {
+            'duplicate_count': duplicates if duplicates > error_bound else 0,
+            'duplicate_count_estimated': True,
+            'duplicate_error_bound': error_bound
+        }
+    
+    @staticmethod
+    def spark_hll_relative_error(rsd: float) -> float:
+        """Actual standard error of approx_count_distinct: HyperLogLog++ rounds rsd up to a register count"""
+        precision = max(4, math.ceil(2.0 * math.log(1.106 / rsd, 2)))
+        return 1.04 / math.sqrt(1 << precision)
+    
+    @staticmethod
+    def check_data_quality(df: DataFrame, exact_duplicates: bool = False,
+                           duplicate_rsd: float = 0.01) -> Dict[str, any]:
+        """Comprehensive data quality checks computed in a single aggregation pass
+        
+        duplicate_rsd below 0.01 is not worth it: HyperLogLog++ keeps its registers in the
+        aggregation buffer, whose generated code and memory grow with 1/rsd^2 (0.002 exhausts a
+        local driver's heap) - use exact_duplicates when the estimate is too coarse.
+        """
+        profile_exprs, numeric_columns = DataQualityValidator._build_profile_expressions(df, duplicate_rsd)
+        profile = df.agg(*profile_exprs).collect()[0].asDict()
+        total_rows = profile["__total_rows"]
         
         quality_report = {
             'total_rows': total_rows,
             'null_counts': {},
             'duplicate_count': 0,
+            'duplicate_count_estimated': False,
+            'duplicate_error_bound': 0,
             'column_stats': {}
         }
         
-        # Check for nulls in each column
-        for column in df.columns:
-            null_count = df.filter(col(column).isNull() | isnan(col(column))).count()
+        # Null counts per column
+        for idx, column in enumerate(df.columns):
+            null_count = profile[f"__nulls_{idx}"]
             quality_report['null_counts'][column] = {
                 'count': null_count,
                 'percentage': (null_count / total_rows * 100) if total_rows > 0 else 0
             }
         
-        # Check for duplicates
+        # Duplicates - approximate by default, exact distinct costs an additional full shuffle
         if total_rows > 0:
-            unique_rows = df.distinct().count()
-            quality_report['duplicate_count'] = total_rows - unique_rows
+            if exact_duplicates:
+                quality_report['duplicate_count'] = max(total_rows - df.distinct().count(), 0)
+            elif "__distinct_rows" in profile:
+                quality_report.update(DataQualityValidator.estimated_duplicates(
+                    total_rows, profile["__distinct_rows"], DataQualityValidator.spark_hll_relative_error(duplicate_rsd)
+                ))
         
         # Basic column statistics for numeric columns
-        numeric_columns = [f.name for f in df.schema.fields if f.dataType in [IntegerType(), DoubleType()]]
-        if numeric_columns:
-            stats_df = df.select([
-                spark_min(col(c)).alias(f"{c}_min"),
-                spark_max(col(c)).alias(f"{c}_max"), 
-                avg(col(c)).alias(f"{c}_avg")
-                for c in numeric_columns
-            ]).collect()[0]
-            
-            for col_name in numeric_columns:
-                quality_report['column_stats'][col_name] = {
-                    'min': stats_df[f"{col_name}_min"],
-                    'max': stats_df[f"{col_name}_max"],
-                    'avg': stats_df[f"{col_name}_avg"]
-                }
+        for idx, col_name in enumerate(numeric_columns):
+            quality_report['column_stats'][col_name] = {
+                'min': profile[f"__min_{idx}"],
+                'max': profile[f"__max_{idx}"],
+                'avg': profile[f"__avg_{idx}"]
+            }
         
         return quality_report
-
-
-class SparkOptimizer:
-    """Advanced Spark optimization utilities"""
     
     @staticmethod
-    def optimize_spark_session(spark: SparkSession, config: SparkJobConfig) -> SparkSession:
-        """Apply advanced Spark optimizations"""
-        
-        # Adaptive Query Execution
-        if config.enable_adaptive_query:
-            spark.conf.set("spark.sql.adaptive.enabled", "true")
-            spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
-            spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
-            spark.conf.set("spark.sql.adaptive.localShuffleReader.enabled", "true")
-            spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128MB")
-        
-        # Dynamic allocation
-        spark.conf.set("spark.dynamicAllocation.enabled", "true")
-        spark.conf.set("spark.dynamicAllocation.minExecutors", "2")
-        spark.conf.set("spark.dynamicAllocation.maxExecutors", "100")
-        spark.conf.set("spark.dynamicAllocation.initialExecutors", "10")
+    def build_profile_sketch(df: DataFrame, dataset: str, partition: str,
+                             precision: int = 12, compression: float = 100.0) -> ProfileSketch:
+        """Profile a partition into a mergeable sketch in one pass over the data
         
-        # Serialization optimization
-        spark.conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-        spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+        Values are hashed into HyperLogLog register codes in SQL, as GrainAggregator does for the
+        aggregate sketches; the Python workers only fold code and value arrays with numpy.
+        """
+        if pd is None:
+            raise RuntimeError("Sketch profiles require pandas")
+        schema = df.schema
         
-        # Memory optimization
-        spark.conf.set("spark.executor.memory", "8g")
-        spark.conf.set("spark.executor.memoryFraction", "0.8")
-        spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", "10000")
+        # 60 bits of xxhash64 feed the register codes: it hashes the native values, several times
+        # faster than the md5 of their strings the aggregates keep for parity with duckdb
+        mask = (1 << 60) - 1
+        hashed = df.select(
+            *[expr(f"CASE WHEN `{f.name}` IS NOT NULL THEN xxhash64(`{f.name}`) & {mask} END").alias(f"h{i}")
+              for i, f in enumerate(schema.fields)],
+            *[col(f.name).cast(DoubleType()).alias(f"v{i}") for i, f in enumerate(schema.fields) if isinstance(f.dataType, NumericType)],
+            expr(f"xxhash64(*) & {mask}").alias("h")
+        )
+        coded = hashed.select(
+            *[expr(GrainAggregator.register_code(f"h{i}", precision=precision)).alias(f"c{i}") for i in range(len(schema.fields))],
+            *[c for c in hashed.columns if c.startswith("v")],
+            expr(GrainAggregator.register_code("h", precision=ProfileSketch.ROW_PRECISION)).alias("r")
+        )
         
-        # File optimization
-        if config.max_records_per_file:
-            spark.conf.set("spark.sql.files.maxRecordsPerFile", str(config.max_records_per_file))
+        # Partial sketches leave the Python workers as JSON, one row per partition, and are merged here
+        def sketch_partition(batches):
+            sketch = ProfileSketch.empty(dataset, partition, schema, precision, compression)
+            for batch in batches:
+                sketch.add_batch(batch)
+            yield pd.DataFrame({"sketch": [json.dumps(sketch.to_dict())]})
         
-        return spark
+        merged = ProfileSketch.empty(dataset, partition, schema, precision, compression)
+        for row in coded.mapInPandas(sketch_partition, "sketch STRING").collect():
+            merged.merge(ProfileSketch.from_dict(json.loads(row['sketch'])))
+        return merged
     
     @staticmethod
-    def handle_data_skew(df: DataFrame, skewed_columns: List[str]) -> DataFrame:
-        """Handle data skew by salting technique"""
-        if not skewed_columns:
-            return df
+    def evaluate_quality_thresholds(quality_report: Dict[str, any],
+                                    thresholds: Dict[str, any]) -> Tuple[bool, List[str]]:
+        """Check a quality report (exact or sketch-based) against pipeline quality thresholds"""
+        errors = []
+        total_rows = quality_report['total_rows']
         
-        # Add salt column to distribute skewed data
-        salt_df = df.withColumn("salt", (expr("hash(rand())") % 100).cast("string"))
+        if 'min_row_count' in thresholds and total_rows < thresholds['min_row_count']:
+            errors.append(f"Row count {total_rows} below minimum {thresholds['min_row_count']}")
         
-        # Create salted key for skewed columns
-        for col_name in skewed_columns:
-            if col_name in df.columns:
-                salt_df = salt_df.withColumn(
-                    f"{col_name}_salted", 
-                    concat_ws("_", col(col_name), col("salt"))
-                )
+        if 'max_null_percentage' in thresholds:
+            for column, nulls in quality_report['null_counts'].items():
+                if nulls['percentage'] > thresholds['max_null_percentage']:
+                    errors.append(f"Null percentage for {column} is {nulls['percentage']:.2f}%, "
+                                  f"above {thresholds['max_null_percentage']}%")
+        
+        if 'max_duplicate_percentage' in thresholds and total_rows > 0:
+            duplicate_percentage = quality_report['duplicate_count'] / total_rows * 100
+            bound_percentage = quality_report.get('duplicate_error_bound', 0) / total_rows * 100
+            if quality_report.get('duplicate_count_estimated') and bound_percentage >= thresholds['max_duplicate_percentage']:
+                logger.warning(f"Duplicate estimate is only accurate to ±{bound_percentage:.2f}%, coarser than the "
+                               f"{thresholds['max_duplicate_percentage']}% threshold - use --exact-duplicates to gate on it")
+            if duplicate_percentage > thresholds['max_duplicate_percentage']:
+                errors.append(f"Duplicate percentage {duplicate_percentage:.2f}% above "
+                              f"{thresholds['max_duplicate_percentage']}%")
         
-        return salt_df
+        return len(errors) == 0, errors
+
+
+class SparkOptimizer:
+    """Advanced Spark optimization utilities"""
+    
+    @staticmethod
+    def optimize_spark_session(spark: SparkSession, config: SparkJobConfig) -> SparkSession:
+        """Apply advanced Spark optimizations (runtime confs only - static ones are set by SparkSessionFactory)"""
+        SparkSessionFactory.apply_runtime_configs(spark, config)
+        return spark
     
     @staticmethod
     def optimize_joins(left_df: DataFrame, right_df: DataFrame, 
-                      join_keys: List[str], join_type: str = "inner") -> DataFrame:
-        """Optimize join operations with broadcast and bucketing"""
-        
-        # Estimate DataFrame sizes
-        left_size = left_df.count()
-        right_size = right_df.count()
-        
-        # Use broadcast join for smaller DataFrames (< 200MB worth of rows)
-        broadcast_threshold = 1000000  # Approximate row threshold for broadcast
-        
-        if right_size < broadcast_threshold and right_size < left_size:
-            logger.info(f"Using broadcast join - broadcasting right DataFrame ({right_size} rows)")
-            return left_df.join(broadcast(right_df), join_keys, join_type)
-        elif left_size < broadcast_threshold and left_size < right_size:
-            logger.info(f"Using broadcast join - broadcasting left DataFrame ({left_size} rows)")
-            return broadcast(left_df).join(right_df, join_keys, join_type)
-        else:
-            logger.info("Using shuffle join - both DataFrames are large")
-            return left_df.join(right_df, join_keys, join_type)
+                      join_keys: List[str], join_type: str = "inner",
+                      broadcast_threshold_bytes: int = DEFAULT_BROADCAST_THRESHOLD_BYTES,
+                      skew_handler: Optional['SkewJoinHandler'] = None) -> DataFrame:
+        """Optimize join operations with strategy hints chosen from metadata size estimates"""
+        planner = JoinPlanner(left_df.sparkSession, broadcast_threshold_bytes)
+        if skew_handler is not None:
+            return skew_handler.join(planner, left_df, right_df, join_keys, join_type)
+        return planner.join(left_df, right_df, join_keys, join_type)
+    
+    @staticmethod
+    def count_plan_nodes(df: DataFrame, node_name: str = "Exchange") -> int:
+        """Count physical plan nodes by operator name (plans the query, runs no Spark job)"""
+        plan_string = df._jdf.queryExecution().executedPlan().toString()
+        count = 0
+        for line in plan_string.splitlines():
+            operator = line.lstrip(" :+-|").split(" ")[0]
+            # Whole-stage codegen prefixes operators with "*(n) "
+            if operator.startswith("*("):
+                operator = line.split(") ", 1)[1].split(" ")[0]
+            if operator == node_name:
+                count += 1
+        return count
 
 
-class ETLJobProcessor:
-    """Main ETL job processor with advanced patterns"""
+class JoinPlanner:
+    """Join strategy selection from metadata size estimates - never triggers a Spark action"""
     
-    def __init__(self, spark: SparkSession, config: SparkJobConfig):
+    # Join types for which each side may be used as the build (hashed/broadcast) side
+    BUILD_SIDES = {
+        "inner": ("left", "right"), "cross": ("left", "right"),
+        "left": ("right",), "leftouter": ("right",), "left_outer": ("right",),
+        "leftsemi": ("right",), "left_semi": ("right",), "semi": ("right",),
+        "leftanti": ("right",), "left_anti": ("right",), "anti": ("right",),
+        "right": ("left",), "rightouter": ("left",), "right_outer": ("left",),
+    }
+    
+    def __init__(self, spark: SparkSession, broadcast_threshold_bytes: int,
+                 footer_sample_files: int = 32):
         self.spark = spark
-        self.config = config
-        self.validator = DataQualityValidator()
-        self.optimizer = SparkOptimizer()
+        self.broadcast_threshold_bytes = broadcast_threshold_bytes
+        self.footer_sample_files = footer_sample_files
+        self.shuffle_partitions = int(spark.conf.get("spark.sql.shuffle.partitions"))
+        self.unknown_size = spark._jsparkSession.sessionState().conf().defaultSizeInBytes()
+    
+    @staticmethod
+    def estimate_row_width(df: DataFrame) -> int:
+        """Estimated in-memory width of one row from the schema's default type sizes"""
+        return int(df._jdf.schema().defaultSize())
+    
+    def _plan_statistics(self, df: DataFrame) -> Tuple[Optional[int], Optional[int]]:
+        """Size and row count from the optimized logical plan (file sizes, Delta snapshot size, CBO stats)"""
+        stats = df._jdf.queryExecution().optimizedPlan().stats()
+        # py4j hands scala BigInt back as a Python int, str() also covers a JavaObject
+        size_in_bytes = int(str(stats.sizeInBytes()))
+        row_count = int(str(stats.rowCount().get())) if stats.rowCount().isDefined() else None
+        if size_in_bytes >= self.unknown_size:
+            size_in_bytes = None
+        return size_in_bytes, row_count
     
-    def read_data_with_optimization(self, path: str, format: str = "parquet") -> DataFrame:
-        """Read data with optimization settings"""
+    def _footer_row_count(self, df: DataFrame) -> Optional[int]:
+        """Row count extrapolated from a sample of parquet footers of the scanned files"""
+        if pq is None:
+            return None
         
-        read_options = {
-            "path": path,
-            "mergeSchema": "true",
-            "recursiveFileLookup": "true"
-        }
+        input_files = [LocalFileSystemBackend._local_path(f) for f in df.inputFiles()]
+        if not input_files or not all(os.path.exists(f) for f in input_files):
+            return None
         
-        if format.lower() == "parquet":
-            # Parquet optimization
-            read_options.update({
-                "pushDownPredicate": "true",
-                "pushDownAggregate": "true"
-            })
-        elif format.lower() == "delta":
-            # Delta Lake optimization
-            read_options.update({
-                "versionAsOf": "latest",
-                "readChangeFeed": "false"
-            })
+        sample = input_files[:self.footer_sample_files]
+        sampled_rows = sum(pq.read_metadata(f).num_rows for f in sample)
+        sampled_bytes = sum(os.path.getsize(f) for f in sample)
+        total_bytes = sum(os.path.getsize(f) for f in input_files)
+        return int(sampled_rows * total_bytes / sampled_bytes) if sampled_bytes else sampled_rows
+    
+    def estimate_size(self, df: DataFrame) -> Dict[str, any]:
+        """Estimate DataFrame size in bytes, preferring row counts times row width when known"""
+        row_width = self.estimate_row_width(df)
+        size_in_bytes, row_count = self._plan_statistics(df)
+        source = "plan_statistics"
         
-        df = self.spark.read.format(format).options(**read_options).load(path)
+        if row_count is None and size_in_bytes is None:
+            row_count = self._footer_row_count(df)
+            source = "parquet_footers" if row_count is not None else "unknown"
         
-        # Apply intelligent caching based on data size and usage pattern
-        if self.config.cache_level != "NONE":
-            cache_level = getattr(StorageLevel, self.config.cache_level)
-            df = df.cache() if cache_level == StorageLevel.MEMORY_ONLY else df.persist(cache_level)
-            
-            # Trigger caching
-            row_count = df.count()
-            logger.info(f"Cached DataFrame with {row_count} rows at level {self.config.cache_level}")
+        if row_count is not None:
+            size_in_bytes = row_count * row_width
         
-        return df
+        return {'bytes': size_in_bytes, 'rows': row_count, 'row_width': row_width, 'source': source}
     
-    def write_data_with_optimization(self, df: DataFrame, path: str, 
-                                   format: str = "parquet", mode: str = "overwrite") -> None:
-        """Write data with optimization settings"""
+    def plan(self, left_df: DataFrame, right_df: DataFrame, join_type: str = "inner") -> Dict[str, any]:
+        """Choose the join strategy and build side"""
+        estimates = {'left': self.estimate_size(left_df), 'right': self.estimate_size(right_df)}
+        build_sides = self.BUILD_SIDES.get(join_type.lower().replace(" ", ""), ())
         
-        writer = df.write.mode(mode).format(format)
+        known = [side for side in build_sides if estimates[side]['bytes'] is not None]
+        if not known:
+            # No usable metadata - leave the decision to Spark and AQE runtime statistics
+            return {'strategy': 'auto', 'build_side': None, 'estimates': estimates}
         
-        # Apply partitioning if specified
-        if self.config.partition_columns:
-            logger.info(f"Partitioning by columns: {self.config.partition_columns}")
-            writer = writer.partitionBy(*self.config.partition_columns)
+        build_side = min(known, key=lambda side: estimates[side]['bytes'])
+        stream_side = 'right' if build_side == 'left' else 'left'
+        build_bytes = estimates[build_side]['bytes']
+        stream_bytes = estimates[stream_side]['bytes']
         
-        # Apply bucketing if specified
-        if self.config.bucket_columns and self.config.num_buckets > 0:
-            logger.info(f"Bucketing by columns: {self.config.bucket_columns}, buckets: {self.config.num_buckets}")
-            writer = writer.bucketBy(self.config.num_buckets, *self.config.bucket_columns)
+        if build_bytes <= self.broadcast_threshold_bytes:
+            strategy = 'broadcast'
+        elif (build_bytes / self.shuffle_partitions <= self.broadcast_threshold_bytes
+              and stream_bytes is not None and build_bytes * 3 <= stream_bytes):
+            # Each shuffle partition of the build side fits a hash map and is much smaller than the stream side
+            strategy = 'shuffle_hash'
+        else:
+            strategy = 'sort_merge'
         
-        # Optimize file sizes
-        if self.config.coalesce_partitions > 0:
-            df = df.coalesce(self.config.coalesce_partitions)
-            logger.info(f"Coalesced to {self.config.coalesce_partitions} partitions")
+        return {'strategy': strategy, 'build_side': build_side, 'estimates': estimates}
+    
+    def join(self, left_df: DataFrame, right_df: DataFrame,
+             join_keys: List[str], join_type: str = "inner") -> DataFrame:
+        """Join with a broadcast hint when the planned build side is small enough"""
+        join_plan = self.plan(left_df, right_df, join_type)
+        estimates = join_plan['estimates']
+        logger.info(
+            f"Join plan: {join_plan['strategy']} (build side: {join_plan['build_side']}) - "
+            f"left ~{estimates['left']['bytes']} bytes/{estimates['left']['rows']} rows via {estimates['left']['source']}, "
+            f"right ~{estimates['right']['bytes']} bytes/{estimates['right']['rows']} rows via {estimates['right']['source']}"
+        )
         
-        # Format-specific optimizations
-        if format.lower() == "parquet":
-            writer = writer.option("compression", "snappy")
-        elif format.lower() == "delta":
-            writer = writer.option("overwriteSchema", "true")
-            writer = writer.option("optimizeWrite", "true")
-            writer = writer.option("autoCompact", "true")
+        # shuffle_hash and sort_merge are not pinned: a merge or shuffle_hash hint would stop AQE
+        # from switching the join to a broadcast once runtime sizes are known
+        if join_plan['strategy'] == 'broadcast':
+            left_df, right_df = (broadcast(left_df), right_df) if join_plan['build_side'] == 'left' else (left_df, broadcast(right_df))
         
-        # Write with error handling
-        try:
-            writer.save(path)
-            logger.info(f"Successfully wrote data to {path}")
-        except Exception as e:
-            logger.error(f"Failed to write data to {path}: {str(e)}")
-            raise
+        return left_df.join(right_df, join_keys, join_type)
+
+
+class SkewJoinHandler:
+    """Salted joins for hot keys found by sampling the stream side of a shuffle join"""
     
-    def transform_customer_data(self, df: DataFrame) -> DataFrame:
-        """Transform customer data with advanced techniques"""
+    # Side that may be salted per join type - the other side is replicated, so it must not be preserved
+    SALTABLE_SIDES = {
+        "inner": ("left", "right"),
+        "left": ("left",), "leftouter": ("left",), "left_outer": ("left",),
+        "leftsemi": ("left",), "left_semi": ("left",), "semi": ("left",),
+        "leftanti": ("left",), "left_anti": ("left",), "anti": ("left",),
+        "right": ("right",), "rightouter": ("right",), "right_outer": ("right",),
+    }
+    
+    def __init__(self, spark: SparkSession, hot_key_threshold: float = 0.05,
+                 salt_buckets: int = 16, sample_fraction: float = 0.01,
+                 max_hot_keys: int = 100, seed: int = 42):
+        self.spark = spark
+        self.hot_key_threshold = hot_key_threshold
+        self.salt_buckets = salt_buckets
+        self.sample_fraction = sample_fraction
+        self.max_hot_keys = max_hot_keys
+        self.seed = seed
+        self.reports = []
+    
+    def detect_hot_keys(self, df: DataFrame, join_keys: List[str]) -> List[Dict[str, any]]:
+        """Keys holding at least hot_key_threshold of a row sample (one Spark job)"""
+        observation = Observation("skew_sample")
+        sampled = df.sample(withReplacement=False, fraction=self.sample_fraction, seed=self.seed) \
+            .observe(observation, spark_count(lit(1)).alias("rows"))
         
-        logger.info("Starting customer data transformation")
+        non_null = None
+        for key in join_keys:
+            condition = col(key).isNotNull()
+            non_null = condition if non_null is None else non_null & condition
         
-        # Data cleaning and standardization
-        cleaned_df = df.select(
-            col("customer_id"),
-            trim(upper(col("first_name"))).alias("first_name"),
-            trim(upper(col("last_name"))).alias("last_name"),
-            lower(trim(col("email"))).alias("email"),
-            regexp_replace(col("phone"), r"[^\d]", "").alias("phone_cleaned"),
-            trim(upper(col("country"))).alias("country"),
-            col("registration_date").cast(TimestampType()).alias("registration_timestamp"),
-            col("age"),
-            coalesce(col("lifetime_value"), lit(0.0)).alias("lifetime_value")
-        ).filter(
-            # Data quality filters
-            col("customer_id").isNotNull() &
-            col("email").contains("@") &
-            col("age").between(13, 120) &
-            col("registration_date").isNotNull()
-        )
+        top_keys = sampled.filter(non_null).groupBy(*join_keys).count() \
+            .orderBy(col("count").desc()).limit(self.max_hot_keys).collect()
+        sampled_rows = observation.get.get("rows", 0)
+        if not sampled_rows:
+            return []
         
-        # Feature engineering with window functions
-        window_spec = Window.partitionBy("country").orderBy(col("registration_timestamp").desc())
+        return [
+            {'key': {k: row[k] for k in join_keys}, 'sample_fraction': row['count'] / sampled_rows}
+            for row in top_keys
+            if row['count'] / sampled_rows >= self.hot_key_threshold
+        ]
+    
+    @staticmethod
+    def _hot_key_condition(join_keys: List[str], hot_keys: List[Dict[str, any]]):
+        """Boolean column that is true only for rows carrying one of the hot keys"""
+        if len(join_keys) == 1:
+            key = join_keys[0]
+            condition = col(key).isin([hot['key'][key] for hot in hot_keys])
+        else:
+            condition = None
+            for hot in hot_keys:
+                match = None
+                for key in join_keys:
+                    key_match = col(key) == lit(hot['key'][key])
+                    match = key_match if match is None else match & key_match
+                condition = match if condition is None else condition | match
+        # Null keys are never hot; coalesce keeps them out of both filters' null semantics
+        return coalesce(condition, lit(False))
+    
+    def join(self, planner: 'JoinPlanner', left_df: DataFrame, right_df: DataFrame,
+             join_keys: List[str], join_type: str = "inner") -> DataFrame:
+        """Join with hot keys salted on the skewed side and replicated on the other side"""
+        normalized_type = join_type.lower().replace(" ", "")
+        join_plan = planner.plan(left_df, right_df, join_type)
+        saltable = self.SALTABLE_SIDES.get(normalized_type, ())
+        if join_plan['strategy'] == 'broadcast' or not saltable:
+            # Broadcast joins do not shuffle the stream side, so skew cannot build a hot partition
+            return planner.join(left_df, right_df, join_keys, join_type)
         
-        enriched_df = cleaned_df.withColumn(
-            "customer_rank_in_country", rank().over(window_spec)
-        ).withColumn(
-            "days_since_registration", 
-            expr("datediff(current_date(), date(registration_timestamp))")
+        estimates = join_plan['estimates']
+        if len(saltable) > 1 and estimates['right']['bytes'] is not None and \
+                (estimates['left']['bytes'] is None or estimates['right']['bytes'] > estimates['left']['bytes']):
+            skewed_side = 'right'
+        else:
+            skewed_side = saltable[0]
+        skewed_df, other_df = (left_df, right_df) if skewed_side == 'left' else (right_df, left_df)
+        
+        hot_keys = self.detect_hot_keys(skewed_df, join_keys)
+        if not hot_keys:
+            logger.info(f"No hot join keys on {join_keys} above {self.hot_key_threshold:.1%} of the sample")
+            return planner.join(left_df, right_df, join_keys, join_type)
+        
+        self.reports.append({'join_keys': join_keys, 'skewed_side': skewed_side, 'hot_keys': hot_keys})
+        logger.warning(
+            f"Salting {len(hot_keys)} hot join key(s) on the {skewed_side} side into {self.salt_buckets} buckets: " +
+            ", ".join(f"{hot['key']} ({hot['sample_fraction']:.1%})" for hot in hot_keys)
+        )
+        
+        is_hot = self._hot_key_condition(join_keys, hot_keys)
+        salt_column = "__skew_salt"
+        
+        # Hot rows spread over salt buckets; every bucket sees all matching rows of the other side.
+        # The salt is a hash of the row, not rand(), so a retried task puts each row in the same bucket
+        skewed_hot = skewed_df.filter(is_hot).withColumn(
+            salt_column, expr(f"pmod(xxhash64(*), {self.salt_buckets})").cast("int")
+        )
+        other_hot = other_df.filter(is_hot).withColumn(
+            salt_column, explode(array([lit(i) for i in range(self.salt_buckets)]))
+        )
+        
+        if skewed_side == 'left':
+            hot_joined = skewed_hot.join(other_hot, join_keys + [salt_column], join_type)
+        else:
+            hot_joined = other_hot.join(skewed_hot, join_keys + [salt_column], join_type)
+        hot_joined = hot_joined.drop(salt_column)
+        
+        rest_left = left_df.filter(~is_hot)
+        rest_right = right_df.filter(~is_hot)
+        rest_joined = planner.join(rest_left, rest_right, join_keys, join_type)
+        
+        return rest_joined.unionByName(hot_joined)
+
+
+class BloomJoinPrefilter:
+    """Drops stream-side rows whose join key cannot match the (filtered) build side before the shuffle"""
+    
+    def __init__(self, spark: SparkSession, fpp: float = 0.01, max_num_bits: int = DEFAULT_BLOOM_MAX_NUM_BITS):
+        self.spark = spark
+        self.fpp = fpp
+        self.max_num_bits = max_num_bits
+        self.reports: List[Dict[str, any]] = []
+    
+    @staticmethod
+    def optimal_num_bits(expected_items: int, fpp: float) -> int:
+        """Bit size BloomFilter.create picks for the expected items and fpp"""
+        return int(-expected_items * math.log(fpp) / (math.log(2) ** 2))
+    
+    def build(self, df: DataFrame, key: str) -> Optional[bytes]:
+        """Serialized JVM Bloom filter over xxhash64 of the build side's keys (two Spark jobs: key count, then build)
+        
+        None when the filter would exceed max_num_bits: it is embedded as a literal in the filter
+        expression, so it travels with every task and is held by each of them.
+        """
+        keys = df.select(xxhash64(col(key)).alias("key_hash")).where(col(key).isNotNull())
+        expected_items = max(keys.count(), 1)
+        num_bits = self.optimal_num_bits(expected_items, self.fpp)
+        if num_bits > self.max_num_bits:
+            logger.info(f"Skipping the Bloom prefilter on {key}: {expected_items:,} keys need {num_bits:,} bits "
+                        f"at fpp {self.fpp}, above the {self.max_num_bits:,} bit cap")
+            return None
+        
+        # DataFrameStatFunctions.bloomFilter puts LongType values with putLong, the encoding might_contain probes
+        bloom = keys._jdf.stat().bloomFilter("key_hash", expected_items, self.fpp)
+        stream = self.spark._jvm.java.io.ByteArrayOutputStream()
+        bloom.writeTo(stream)
+        serialized = bytes(stream.toByteArray())
+        logger.info(f"Bloom filter on {key}: {expected_items:,} keys, {bloom.bitSize():,} bits, "
+                    f"fpp {self.fpp}, {len(serialized):,} bytes")
+        return serialized
+    
+    def might_contain(self, serialized: bytes, key: str) -> Column:
+        """Catalyst's BloomFilterMightContain, the runtime-filter probe - evaluated in the JVM, no Python round trip"""
+        jvm = self.spark._jvm
+        expressions = jvm.org.apache.spark.sql.catalyst.expressions
+        bloom_literal = expressions.Literal.create(bytearray(serialized), jvm.org.apache.spark.sql.types.DataTypes.BinaryType)
+        probe = expressions.BloomFilterMightContain(bloom_literal, xxhash64(col(key))._jc.expr())
+        # xxhash64 of a null key is the seed, so nulls are dropped explicitly
+        return col(key).isNotNull() & Column(jvm.org.apache.spark.sql.Column(probe))
+    
+    def apply(self, stream_df: DataFrame, build_df: DataFrame, key: str) -> DataFrame:
+        """Stream side filtered by the build side's Bloom filter, with observed rows in and out
+        (unfiltered when the filter would exceed the size cap)"""
+        serialized = self.build(build_df, key)
+        if serialized is None:
+            return stream_df
+        might_contain = self.might_contain(serialized, key)
+        
+        before, after = Observation(), Observation()
+        report = {'key': key, 'fpp': self.fpp, 'before': before, 'after': after}
+        self.reports.append(report)
+        return stream_df.observe(before, spark_count(lit(1)).alias("rows")) \
+            .filter(might_contain) \
+            .observe(after, spark_count(lit(1)).alias("rows"))
+    
+    def pruned_rows(self) -> List[Dict[str, any]]:
+        """Rows dropped by each prefilter - available once the filtered frame was computed"""
+        summaries = []
+        for report in self.reports:
+            rows_in = report['before'].get.get('rows', 0)
+            rows_out = report['after'].get.get('rows', 0)
+            summaries.append({'key': report['key'], 'fpp': report['fpp'], 'rows_in': rows_in,
+                              'rows_pruned': rows_in - rows_out})
+        return summaries
+
+
+class GrainAggregator:
+    """All declared aggregate grains from one GROUPING SETS pass, with mergeable distinct-count sketches
+    
+    Distinct customers and merchants are HyperLogLog sketches stored as sorted arrays of
+    register * 64 + rank codes, one per non-empty register. Sketches of finer rows merge into a
+    coarser row by concatenation, so coarser grains can be rolled up from a finer stored table.
+    The hash is the leading 60 bits of md5, which the duckdb engine computes identically.
+    """
+    
+    PRECISION = 12
+    REGISTERS = 1 << PRECISION
+    
+    # Measures of every grain table, after its dimensions
+    OUTPUT_COLUMNS = [
+        "transaction_count", "total_amount", "avg_amount", "max_amount", "min_amount",
+        "unique_customers", "unique_merchants", "successful_transactions", "failed_transactions",
+        "success_rate", "avg_amount_per_customer", "customer_sketch", "merchant_sketch"
+    ]
+    
+    AGGREGATE_SQL = """
+        WITH hashed AS (
+            SELECT
+                date_format(transaction_timestamp, 'yyyy-MM-dd') AS transaction_date,
+                transaction_country,
+                payment_method,
+                amount,
+                status,
+                CAST(conv(substr(md5(customer_id), 1, 15), 16, 10) AS BIGINT) AS customer_hash,
+                CAST(conv(substr(md5(merchant_id), 1, 15), 16, 10) AS BIGINT) AS merchant_hash
+            FROM {{transactions}}
+        ),
+        coded AS (
+            SELECT *, {customer_code} AS customer_code, {merchant_code} AS merchant_code
+            FROM hashed
+        )
+        SELECT
+            {dimension_columns}{grain_id} AS grain_id,
+            count(*) AS transaction_count,
+            sum(amount) AS total_amount,
+            max(amount) AS max_amount,
+            min(amount) AS min_amount,
+            sum(CASE WHEN status = 'COMPLETED' THEN 1 ELSE 0 END) AS successful_transactions,
+            sum(CASE WHEN status = 'FAILED' THEN 1 ELSE 0 END) AS failed_transactions,
+            collect_set(customer_code) AS customer_codes,
+            collect_set(merchant_code) AS merchant_codes
+        FROM coded
+        {group_by}
+    """
+    
+    def __init__(self, grains: Dict[str, List[str]]):
+        self.grains = grains
+        # Grouping columns in first-declared order - grain ids are numbered against them
+        self.dimensions: List[str] = []
+        for dimensions in grains.values():
+            self.dimensions += [d for d in dimensions if d not in self.dimensions]
+    
+    def grain_id(self, dimensions: List[str]) -> int:
+        """grouping_id() of a grain: one bit per grouping column left out, the first column most significant"""
+        width = len(self.dimensions)
+        return sum(1 << (width - 1 - i) for i, d in enumerate(self.dimensions) if d not in dimensions)
+    
+    def grouping_sets(self) -> List[str]:
+        sets = []
+        for dimensions in self.grains.values():
+            grouping_set = f"({', '.join(dimensions)})"
+            if grouping_set not in sets:
+                sets.append(grouping_set)
+        return sets
+    
+    @classmethod
+    def register_code(cls, hash_column: str, shift_right: str = "shiftright({}, {})",
+                      precision: Optional[int] = None) -> str:
+        """Register index and rank (trailing zeros + 1 of the remaining bits) of a hashed value"""
+        precision = precision or cls.PRECISION
+        rest = shift_right.format(hash_column, precision)
+        return (f"CAST(({hash_column} & {(1 << precision) - 1}) * 64 + CASE WHEN {rest} = 0 THEN {61 - precision} "
+                f"ELSE CAST(round(log2({rest} & -{rest})) AS INT) + 1 END AS INT)")
+    
+    @classmethod
+    def estimate(cls, sketch_size: str, harmonic_sum: str) -> str:
+        """HyperLogLog estimate from the filled registers and the sum of 2^-rank over them, with
+        the linear-counting correction for small cardinalities"""
+        m = cls.REGISTERS
+        alpha_m2 = 0.7213 / (1 + 1.079 / m) * m * m
+        zeros = f"({m} - {sketch_size})"
+        raw = f"CAST({alpha_m2!r} AS DOUBLE) / ({harmonic_sum} + {zeros})"
+        return (f"CAST(round(CASE WHEN {raw} <= {2.5 * m} AND {zeros} > 0 "
+                f"THEN {m} * ln(CAST({m} AS DOUBLE) / {zeros}) ELSE {raw} END) AS BIGINT)")
+    
+    def aggregate(self, transactions: DataFrame) -> DataFrame:
+        """Additive measures and raw sketch codes of every grain, tagged with grain_id (one scan, one shuffle)"""
+        if self.dimensions:
+            group_by = f"GROUP BY {', '.join(self.dimensions)} GROUPING SETS ({', '.join(self.grouping_sets())})"
+            grain_id = "grouping_id()"
+        else:
+            group_by, grain_id = "", "0"
+        query = self.AGGREGATE_SQL.format(
+            customer_code=self.register_code("customer_hash"),
+            merchant_code=self.register_code("merchant_hash"),
+            dimension_columns="".join(f"{d}, " for d in self.dimensions),
+            grain_id=grain_id,
+            group_by=group_by
+        )
+        return transactions.sparkSession.sql(query, transactions=transactions)
+    
+    def finalize(self, df: DataFrame, dimensions: List[str]) -> DataFrame:
+        """Sketches reduced to one code per register, then estimates and ratios"""
+        for name in ("customer", "merchant"):
+            ordered = f"__{name}_codes_sorted"
+            df = df.withColumn(ordered, array_sort(col(f"{name}_codes"))).withColumn(
+                f"{name}_sketch",
+                # The highest rank of a register is the last of its run in the sorted codes
+                expr(f"filter({ordered}, (code, i) -> i + 1 = size({ordered}) OR get({ordered}, i + 1) DIV 64 != code DIV 64)")
+            ).withColumn(
+                f"unique_{name}s",
+                expr(self.estimate(f"size({name}_sketch)",
+                                   f"aggregate({name}_sketch, CAST(0 AS DOUBLE), (acc, code) -> acc + pow(2, -(code % 64)))"))
+            )
+        return df.withColumn(
+            "avg_amount", expr("total_amount / transaction_count")
+        ).withColumn(
+            "success_rate", expr("successful_transactions / transaction_count")
+        ).withColumn(
+            "avg_amount_per_customer", expr("total_amount / nullif(unique_customers, 0)")
+        ).select(*dimensions, *self.OUTPUT_COLUMNS)
+    
+    def split(self, grouped: DataFrame) -> Dict[str, DataFrame]:
+        """One frame per declared grain from the grouping-sets result"""
+        return {
+            name: self.finalize(grouped.filter(col("grain_id") == self.grain_id(dimensions)), dimensions)
+            for name, dimensions in self.grains.items()
+        }
+    
+    def rollup(self, df: DataFrame, dimensions: List[str]) -> DataFrame:
+        """A coarser grain from the rows of a finer grain table, without rescanning transactions"""
+        grouped = df.groupBy(*dimensions).agg(
+            spark_sum("transaction_count").alias("transaction_count"),
+            spark_sum("total_amount").alias("total_amount"),
+            spark_max("max_amount").alias("max_amount"),
+            spark_min("min_amount").alias("min_amount"),
+            spark_sum("successful_transactions").alias("successful_transactions"),
+            spark_sum("failed_transactions").alias("failed_transactions"),
+            flatten(collect_list("customer_sketch")).alias("customer_codes"),
+            flatten(collect_list("merchant_sketch")).alias("merchant_codes")
+        )
+        return self.finalize(grouped, dimensions)
+
+
+class DeltaLogReader:
+    """Reads Delta transaction log entries straight from storage (driver-side, no Spark jobs)"""
+    
+    def __init__(self, spark: SparkSession, table_path: str):
+        self.log_path = f"{table_path.rstrip('/')}/_delta_log"
+        self.backend = get_filesystem_backend(spark, self.log_path)
+    
+    def _commit_path(self, version: int) -> str:
+        return f"{self.log_path}/{version:020d}.json"
+    
+    def latest_version(self) -> int:
+        """Latest committed version, or -1 if the path is not a Delta table yet"""
+        version = -1
+        checkpoint_marker = f"{self.log_path}/_last_checkpoint"
+        if self.backend.exists(checkpoint_marker):
+            version = json.loads(self.backend.read_text(checkpoint_marker))['version']
+        
+        # Only the commits written after the last checkpoint need to be probed
+        while self.backend.exists(self._commit_path(version + 1)):
+            version += 1
+        return version
+    
+    def read_commit(self, version: int) -> List[Dict[str, any]]:
+        content = self.backend.read_text(self._commit_path(version))
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    
+    def commit_info(self, version: int) -> Dict[str, any]:
+        for action in self.read_commit(version):
+            if 'commitInfo' in action:
+                return action['commitInfo']
+        return {}
+
+
+class PipelineMetrics:
+    """Output row and byte counts collected as a side effect of the writes (no extra Spark jobs)"""
+    
+    def __init__(self, spark: SparkSession):
+        self.spark = spark
+        self.outputs: Dict[str, Dict[str, any]] = {}
+    
+    @staticmethod
+    def _logical_row_bytes(df: DataFrame):
+        """Per-row byte size: actual length of strings/binaries plus default sizes of fixed-width columns"""
+        jschema = df._jdf.schema()
+        fixed_width = 0
+        row_bytes = None
+        for field in df.schema.fields:
+            if isinstance(field.dataType, (StringType, BinaryType)):
+                field_bytes = coalesce(octet_length(col(field.name)), lit(0))
+                row_bytes = field_bytes if row_bytes is None else row_bytes + field_bytes
+            else:
+                fixed_width += jschema.apply(field.name).dataType().defaultSize()
+        return lit(fixed_width) if row_bytes is None else row_bytes + lit(fixed_width)
+    
+    def instrument(self, df: DataFrame, format: str) -> Tuple[DataFrame, Optional[Observation]]:
+        """Attach observed metrics to the DataFrame that is about to be written"""
+        if format.lower() == "delta":
+            # Delta commits record exact output rows/bytes, read back from the log after the write
+            return df, None
+        
+        observation = Observation()
+        observed_df = df.observe(
+            observation,
+            spark_count(lit(1)).alias("rows"),
+            spark_sum(self._logical_row_bytes(df)).alias("bytes")
+        )
+        return observed_df, observation
+    
+    def record(self, name: str, path: str, format: str,
+               observation: Optional[Observation] = None) -> Dict[str, any]:
+        """Collect the metrics of a completed write"""
+        if observation is not None:
+            observed = observation.get
+            metrics = {'rows': observed.get('rows') or 0, 'bytes': observed.get('bytes') or 0,
+                       'source': 'observed_metrics'}
+        else:
+            reader = DeltaLogReader(self.spark, path)
+            version = reader.latest_version()
+            operation_metrics = reader.commit_info(version).get('operationMetrics', {})
+            metrics = {
+                'rows': int(operation_metrics.get('numOutputRows', 0)),
+                'bytes': int(operation_metrics.get('numOutputBytes', 0)),
+                'source': f"delta_commit_v{version}"
+            }
+        
+        self.outputs[name] = metrics
+        logger.info(f"Output metrics for {name}: {metrics['rows']:,} rows, {metrics['bytes']:,} bytes ({metrics['source']})")
+        return metrics
+    
+    def record_merge(self, name: str, path: str) -> Dict[str, any]:
+        """Collect inserted/updated/unchanged counts of a completed MERGE from its commit"""
+        reader = DeltaLogReader(self.spark, path)
+        version = reader.latest_version()
+        operation_metrics = reader.commit_info(version).get('operationMetrics', {})
+        
+        def metric(key: str) -> int:
+            return int(operation_metrics.get(key, 0))
+        
+        inserted = metric('numTargetRowsInserted')
+        updated = metric('numTargetRowsUpdated')
+        deleted = metric('numTargetRowsDeleted')
+        metrics = {
+            'rows': inserted + updated,
+            'bytes': metric('numTargetBytesAdded'),
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': deleted,
+            # Matched source rows identical to the target - skipped by the update condition
+            'unchanged': metric('numSourceRows') - inserted - updated - deleted,
+            'copied': metric('numTargetRowsCopied'),
+            'files_added': metric('numTargetFilesAdded'),
+            'files_removed': metric('numTargetFilesRemoved'),
+            'source': f"delta_commit_v{version}"
+        }
+        
+        self.outputs[name] = metrics
+        logger.info(
+            f"Merge metrics for {name}: {inserted:,} inserted, {updated:,} updated, {deleted:,} deleted, "
+            f"{metrics['unchanged']:,} unchanged, "
+            f"{metrics['copied']:,} copied across {metrics['files_removed']} rewritten file(s) ({metrics['source']})"
+        )
+        return metrics
+
+
+class OutputPlanner:
+    """Sizes output files towards a target by repartitioning on the partition columns before the write"""
+    
+    def __init__(self, spark: SparkSession, target_file_bytes: int,
+                 sample_rows: int = 10000, compression_ratio: float = 0.4):
+        self.spark = spark
+        self.target_file_bytes = target_file_bytes
+        self.sample_rows = sample_rows
+        # Encoded (compressed columnar) bytes per logical byte when no previous write is known
+        self.compression_ratio = compression_ratio
+    
+    def _file_row_bytes(self, df: DataFrame, path: str, format: str) -> Tuple[float, str]:
+        """Bytes per row on disk - from the previous Delta commit, else a sample scaled by compression"""
+        if format.lower() == "delta":
+            reader = DeltaLogReader(self.spark, path)
+            version = reader.latest_version()
+            if version >= 0:
+                operation_metrics = reader.commit_info(version).get('operationMetrics', {})
+                rows = int(operation_metrics.get('numOutputRows', 0))
+                if rows > 0:
+                    return int(operation_metrics.get('numOutputBytes', 0)) / rows, f"delta_commit_v{version}"
+        
+        sampled = df.limit(self.sample_rows).agg(
+            avg(PipelineMetrics._logical_row_bytes(df)).alias("row_bytes")
+        ).collect()[0]['row_bytes']
+        if not sampled:
+            return float(JoinPlanner.estimate_row_width(df)) * self.compression_ratio, "schema_default_size"
+        return sampled * self.compression_ratio, "sample"
+    
+    def plan(self, df: DataFrame, path: str, format: str,
+             partition_columns: List[str], max_records_per_file: Optional[int] = None) -> Dict[str, any]:
+        """Number of write tasks and records per file that put each file near the target size"""
+        row_bytes, row_source = self._file_row_bytes(df, path, format)
+        records_per_file = max(int(self.target_file_bytes / max(row_bytes, 1.0)), 1)
+        if max_records_per_file:
+            records_per_file = min(records_per_file, max_records_per_file)
+        
+        estimates = JoinPlanner(self.spark, 0).estimate_size(df)
+        estimated_rows = estimates['rows']
+        if estimated_rows is None and estimates['bytes'] is not None:
+            estimated_rows = int(estimates['bytes'] / max(estimates['row_width'], 1))
+        
+        num_partitions = None
+        if estimated_rows is not None:
+            num_partitions = max(math.ceil(estimated_rows / records_per_file), 1)
+        
+        return {
+            'partition_columns': partition_columns,
+            'num_partitions': num_partitions,
+            'max_records_per_file': records_per_file,
+            'file_row_bytes': round(row_bytes, 1),
+            'row_bytes_source': row_source,
+            'estimated_rows': estimated_rows
+        }
+    
+    @staticmethod
+    def _rebalance(df: DataFrame, partition_columns: List[str]) -> DataFrame:
+        """REBALANCE hint on the partition columns - through SQL, as DataFrame.hint passes strings as literals"""
+        if not partition_columns:
+            return df.hint("rebalance")
+        columns = ", ".join(f"`{c}`" for c in partition_columns)
+        return df.sparkSession.sql(f"SELECT /*+ REBALANCE({columns}) */ * FROM {{df}}", df=df)
+    
+    def apply(self, df: DataFrame, output_plan: Dict[str, any]) -> DataFrame:
+        """Repartition so the output is written by about num_partitions tasks, also within one partition value"""
+        partition_columns = output_plan['partition_columns']
+        num_partitions = output_plan['num_partitions']
+        
+        if num_partitions is None:
+            # Unknown size - let AQE size the shuffle partitions at runtime
+            return self._rebalance(df, partition_columns)
+        if partition_columns:
+            if self.spark.conf.get("spark.sql.adaptive.enabled", "true") == "true":
+                # AQE splits a partition value larger than the advisory size across several tasks
+                return self._rebalance(df, partition_columns)
+            # Hashing on the values alone sends each value to one task - a single task for a constant
+            # processing_date - so a row-hash bucket spreads every value over up to num_partitions tasks
+            bucket = expr(f"pmod(xxhash64(*), {num_partitions})")
+            return df.repartition(num_partitions, *[col(c) for c in partition_columns], bucket)
+        return df.repartition(num_partitions)
+    
+    def file_size_report(self, path: str, format: str) -> Dict[str, any]:
+        """Distribution of the file sizes produced by the last write (driver-side, no Spark jobs)"""
+        if format.lower() == "delta":
+            reader = DeltaLogReader(self.spark, path)
+            version = reader.latest_version()
+            sizes = [action['add']['size'] for action in reader.read_commit(version) if 'add' in action] if version >= 0 else []
+        else:
+            backend = get_filesystem_backend(self.spark, path)
+            sizes = [f['size'] for f in backend.list_files(path)]
+        
+        if not sizes:
+            return {'files': 0}
+        
+        sizes.sort()
+        return {
+            'files': len(sizes),
+            'min_bytes': sizes[0],
+            'p50_bytes': sizes[len(sizes) // 2],
+            'p90_bytes': sizes[min(int(len(sizes) * 0.9), len(sizes) - 1)],
+            'max_bytes': sizes[-1],
+            'mean_bytes': sum(sizes) // len(sizes),
+            'small_files': sum(1 for size in sizes if size < self.target_file_bytes / 4),
+            'target_bytes': self.target_file_bytes
+        }
+
+
+class DeltaUpsertWriter:
+    """MERGE of a batch into a Delta table on a declared key, pruned to the files the batch can touch"""
+    
+    # Processing metadata changes on every run and must not turn unchanged rows into updates
+    METADATA_COLUMNS = ("processed_timestamp", "created_timestamp", "processing_date", "data_source")
+    
+    def __init__(self, spark: SparkSession, partition_columns: List[str]):
+        self.spark = spark
+        self.partition_columns = partition_columns
+    
+    def _pruning_predicates(self, df: DataFrame, merge_keys: List[str]) -> List[str]:
+        """Literal predicates on the target from the batch's key ranges and partition values (one Spark job)"""
+        # Partition values only prune correctly when a key cannot move between partitions
+        partition_keys = [c for c in self.partition_columns if c in merge_keys]
+        range_keys = [k for k in merge_keys if k not in partition_keys]
+        
+        aggregations = []
+        for key in range_keys:
+            aggregations += [spark_min(key).alias(f"min_{key}"), spark_max(key).alias(f"max_{key}")]
+        for column in partition_keys:
+            aggregations.append(collect_set(column).alias(f"values_{column}"))
+        if not aggregations:
+            return []
+        bounds = df.agg(*aggregations).collect()[0]
+        
+        predicates = []
+        for key in range_keys:
+            low, high = bounds[f"min_{key}"], bounds[f"max_{key}"]
+            if low is not None:
+                # Delta skips files whose min/max statistics fall outside the range
+                predicates.append(f"t.`{key}` BETWEEN {_sql_literal(low)} AND {_sql_literal(high)}")
+        for column in partition_keys:
+            values = bounds[f"values_{column}"]
+            if values:
+                predicates.append(f"t.`{column}` IN ({', '.join(_sql_literal(v) for v in values)})")
+        return predicates
+    
+    def merge(self, df: DataFrame, path: str, merge_keys: List[str],
+              change_columns: Optional[List[str]] = None) -> None:
+        """Insert new keys, update rows whose change_columns differ (default: every non-key column), leave the rest alone"""
+        if DeltaTable is None:
+            raise RuntimeError("Upsert writes require the delta-spark Python package")
+        
+        # MERGE rejects several source rows matching one target row
+        df = df.dropDuplicates(merge_keys)
+        join_condition = [f"t.`{key}` <=> s.`{key}`" for key in merge_keys]
+        merge_condition = " AND ".join(join_condition + self._pruning_predicates(df, merge_keys))
+        
+        compared = [c for c in (change_columns or df.columns) if c not in merge_keys and c not in self.METADATA_COLUMNS]
+        changed_condition = " OR ".join(f"NOT (t.`{c}` <=> s.`{c}`)" for c in compared) or None
+        
+        logger.info(f"Merging into {path} on {merge_condition}")
+        target = DeltaTable.forPath(self.spark, path)
+        target.alias("t").merge(df.alias("s"), merge_condition) \
+            .whenMatchedUpdateAll(condition=changed_condition) \
+            .whenNotMatchedInsertAll() \
+            .execute()
+
+
+class SchemaDriftDetector:
+    """Detects input schema drift from cached fingerprints of every input file's footer"""
+    
+    def __init__(self, spark: SparkSession, cache_path: str):
+        self.spark = spark
+        self.cache_path = cache_path.rstrip('/')
+        self.backend = get_filesystem_backend(spark, self.cache_path)
+    
+    def _cache_file(self, dataset: str) -> str:
+        return f"{self.cache_path}/{dataset}.json"
+    
+    def file_schema(self, path: str) -> StructType:
+        """Spark schema of one parquet footer, read on the driver - no job per file"""
+        jvm = self.spark._jvm
+        hadoop_conf = self.spark._jsc.hadoopConfiguration()
+        input_file = jvm.org.apache.parquet.hadoop.util.HadoopInputFile.fromPath(jvm.org.apache.hadoop.fs.Path(path), hadoop_conf)
+        reader = jvm.org.apache.parquet.hadoop.ParquetFileReader.open(input_file)
+        try:
+            parquet_schema = reader.getFooter().getFileMetaData().getSchema()
+        finally:
+            reader.close()
+        converter = jvm.org.apache.spark.sql.execution.datasources.parquet.ParquetToSparkSchemaConverter(
+            self.spark._jsparkSession.sessionState().conf()
+        )
+        # Spark reads every parquet column as nullable, so the fingerprint matches the read schema
+        return StructType.fromJson(json.loads(converter.convert(parquet_schema).asNullable().json()))
+    
+    def check(self, dataset: str, files: List[Dict[str, any]], contract: StructType,
+              listed: Optional[List[Dict[str, any]]] = None) -> None:
+        """Validate every input file not checked before against the contract
+        
+        A file written by another producer can land next to conforming ones, so each new footer is
+        fingerprinted and every distinct fingerprint validated once. Checked paths are kept while
+        they are still in the listing (the files themselves when none is given).
+        """
+        if not files:
+            return
+        
+        cache_file = self._cache_file(dataset)
+        cached = json.loads(self.backend.read_text(cache_file)) if self.backend.exists(cache_file) else {}
+        checked = set(cached.get('checked_paths', []))
+        new_files = sorted((f for f in files if f['path'] not in checked), key=lambda f: (f['mtime'], f['path']))
+        if not new_files:
+            return
+        
+        known = set(cached.get('fingerprints', []))
+        fingerprint = cached.get('fingerprint')
+        for file in new_files:
+            schema = self.file_schema(file['path'])
+            fingerprint = hashlib.sha256(schema.json().encode("utf-8")).hexdigest()
+            if fingerprint in known:
+                continue
+            
+            valid, errors = DataQualityValidator.validate_schema(
+                self.spark.createDataFrame([], schema), contract, allow_extra_nested_fields=True
+            )
+            if not valid:
+                raise ValueError(f"Schema contract violated by {file['path']}: {'; '.join(errors)}")
+            
+            known.add(fingerprint)
+            extra_columns = sorted(set(schema.fieldNames()) - set(contract.fieldNames()))
+            logger.info(f"Schema fingerprint for {dataset} changed to {fingerprint[:12]} in {file['path']} - "
+                        f"contract satisfied, columns outside the contract: {extra_columns}")
+        
+        listed_paths = {f['path'] for f in (listed if listed is not None else files)}
+        self.backend.write_text(cache_file, json.dumps({
+            'dataset': dataset,
+            'fingerprint': fingerprint,
+            'fingerprints': sorted(known),
+            'checked_paths': sorted((checked & listed_paths) | {f['path'] for f in new_files}),
+            'checked_at': datetime.now().isoformat()
+        }, indent=2))
+        logger.info(f"Checked the schema of {len(new_files)} new {dataset} files")
+
+
+class FileIndexManifest:
+    """Cached listing of a dataset prefix (paths, sizes, mtimes, partition values) refreshed incrementally
+    
+    Without directory mtimes (S3/ABFS) only the newest partitions are re-listed, so files backfilled
+    into older ones are found by the full listing taken every full_relist_hours or on a full refresh.
+    """
+    
+    def __init__(self, spark: SparkSession, index_path: str, refresh_recent_partitions: int = 2,
+                 full_relist_hours: float = 24, full_refresh: bool = False):
+        self.spark = spark
+        self.index_path = index_path.rstrip('/')
+        self.refresh_recent_partitions = refresh_recent_partitions
+        self.full_relist_hours = full_relist_hours
+        self.full_refresh = full_refresh
+        self.state_backend = get_filesystem_backend(spark, self.index_path)
+    
+    def _manifest_path(self, dataset: str) -> str:
+        return f"{self.index_path}/{dataset}.json"
+    
+    @staticmethod
+    def partition_values(relative_path: str) -> Dict[str, str]:
+        """Hive-style key=value directory segments of a file path"""
+        segments = relative_path.split('/')[:-1]
+        return dict(segment.split('=', 1) for segment in segments if '=' in segment)
+    
+    def _load(self, dataset: str) -> Dict[str, any]:
+        path = self._manifest_path(dataset)
+        if not self.state_backend.exists(path):
+            return {'dataset': dataset, 'directories': {}}
+        return json.loads(self.state_backend.read_text(path))
+    
+    def _walk(self, backend, path: str, relative: str, mtime: int, cached: Dict[str, any],
+              refreshed: Dict[str, any]) -> int:
+        """Record the files directly under a directory and descend into its partition directories.
+        
+        A directory's mtime only moves when its direct children change, so intermediate levels
+        (year=, month=) are always listed - they hold few entries - while leaf partitions are
+        re-listed only when their own mtime moved. Returns the number of directories listed.
+        """
+        entries = backend.list_dir(path)
+        directories = sorted((e for e in entries if e['is_dir'] and not _is_hidden_path(e['name'])), key=lambda e: e['name'])
+        refreshed[relative] = {
+            'mtime': mtime,
+            'leaf': not directories,
+            'files': [[e['path'], e['size'], e['mtime']] for e in entries if not e['is_dir'] and not _is_hidden_path(e['name'])]
+        }
+        
+        # Object stores report no directory mtime, so the newest partitions at each level are always re-listed
+        recent = {e['name'] for e in directories[-self.refresh_recent_partitions:]} if self.refresh_recent_partitions > 0 else set()
+        listed = 1
+        for entry in directories:
+            child = f"{relative}/{entry['name']}" if relative else entry['name']
+            previous = cached.get(child)
+            unchanged = previous is not None and previous.get('leaf') and entry['mtime'] > 0 and previous['mtime'] == entry['mtime']
+            sealed = previous is not None and entry['mtime'] == 0 and entry['name'] not in recent
+            if unchanged:
+                refreshed[child] = previous
+            elif sealed:
+                refreshed.update({key: value for key, value in cached.items() if key == child or key.startswith(f"{child}/")})
+            else:
+                listed += self._walk(backend, entry['path'], child, entry['mtime'], cached, refreshed)
+        return listed
+    
+    def refresh(self, dataset: str, root: str) -> List[Dict[str, any]]:
+        """Re-list only changed or recent leaf partitions and return the full file list"""
+        root = root.rstrip('/')
+        backend = get_filesystem_backend(self.spark, root)
+        manifest = self._load(dataset)
+        
+        now = datetime.now()
+        full_listed_at = manifest.get('full_listed_at')
+        full_listing = self.full_refresh or full_listed_at is None or \
+            now - datetime.fromisoformat(full_listed_at) >= timedelta(hours=self.full_relist_hours)
+        if full_listing:
+            logger.info(f"Listing every directory of {dataset} (last full listing: {full_listed_at or 'never'})")
+            manifest['full_listed_at'] = now.isoformat()
+        
+        # Keyed on relative directory path; '' holds the files directly under the root
+        refreshed = {}
+        relisted = self._walk(backend, root, '', 0, {} if full_listing else manifest['directories'], refreshed)
+        
+        manifest['directories'] = refreshed
+        manifest['updated_at'] = now.isoformat()
+        self.state_backend.write_text(self._manifest_path(dataset), json.dumps(manifest))
+        
+        files = []
+        for directory in refreshed.values():
+            for path, size, mtime in directory['files']:
+                relative_path = path.split(root.split('://')[-1], 1)[-1].lstrip('/')
+                files.append({'path': path, 'size': size, 'mtime': mtime,
+                              'partition_values': self.partition_values(relative_path)})
+        
+        logger.info(f"File index for {dataset}: {len(files)} files, listed {relisted} of {len(refreshed)} directories")
+        return files
+
+
+class IncrementalFileTracker:
+    """High-water-mark bookkeeping of processed input files, one small JSON manifest per dataset
+    
+    A file can surface with an mtime below the watermark (S3 Last-Modified is the upload start, so
+    a slow multipart upload lands late). Files within lookback_ms below the watermark are therefore
+    still listed as candidates and told apart by path from the processed ones kept in the state.
+    """
+    
+    def __init__(self, spark: SparkSession, state_path: str, full_refresh: bool = False,
+                 lookback_ms: int = 24 * 60 * 60 * 1000):
+        self.state_path = state_path.rstrip('/')
+        self.full_refresh = full_refresh
+        self.lookback_ms = lookback_ms
+        self.backend = get_filesystem_backend(spark, self.state_path)
+        self._pending: Dict[str, Dict[str, any]] = {}
+    
+    def _manifest_path(self, dataset: str) -> str:
+        return f"{self.state_path}/{dataset}.json"
+    
+    def load_state(self, dataset: str) -> Dict[str, any]:
+        path = self._manifest_path(dataset)
+        if self.full_refresh or not self.backend.exists(path):
+            return {'dataset': dataset, 'high_water_mark': -1, 'processed_paths': [], 'files_processed': 0}
+        return json.loads(self.backend.read_text(path))
+    
+    def new_files(self, dataset: str, files: List[Dict[str, any]]) -> List[Dict[str, any]]:
+        """Unprocessed files from the lookback window onwards; the advanced state is held until commit()"""
+        state = self.load_state(dataset)
+        watermark = state['high_water_mark']
+        if 'processed_paths' in state:
+            horizon = watermark - self.lookback_ms
+            processed = set(state['processed_paths'])
+        else:
+            # State written before the lookback only knows the paths at the watermark itself
+            horizon = watermark
+            processed = set(state.get('files_at_watermark', []))
+        
+        new = [f for f in files if f['mtime'] >= horizon and f['path'] not in processed]
+        late = [f for f in new if f['mtime'] < watermark]
+        logger.info(f"{dataset}: {len(new)} new of {len(files)} input files (high-water mark {watermark})")
+        if late:
+            logger.warning(f"{dataset}: {len(late)} file(s) arrived with an mtime below the high-water mark")
+        
+        if new:
+            new_watermark = max(watermark, max(f['mtime'] for f in new))
+            known = processed | {f['path'] for f in new}
+            # Only paths still inside the next run's lookback window need remembering
+            window = sorted(f['path'] for f in files if f['path'] in known and f['mtime'] >= new_watermark - self.lookback_ms)
+            self._pending[dataset] = {
+                'dataset': dataset,
+                'high_water_mark': new_watermark,
+                'lookback_ms': self.lookback_ms,
+                'processed_paths': window,
+                'files_processed': state['files_processed'] + len(new),
+                'updated_at': datetime.now().isoformat()
+            }
+        return new
+    
+    def discard(self, dataset: str) -> None:
+        """Keep a dataset's new files pending for the next run"""
+        self._pending.pop(dataset, None)
+    
+    def commit(self) -> None:
+        """Persist the advanced watermarks once the outputs are safely written"""
+        for dataset, state in self._pending.items():
+            self.backend.write_text(self._manifest_path(dataset), json.dumps(state, indent=2))
+            logger.info(f"Advanced {dataset} high-water mark to {state['high_water_mark']}")
+        self._pending.clear()
+
+
+class StageMetricsCollector:
+    """Per-step executor metrics: jobs are tagged with a job group per step and their stages read from the REST API"""
+    
+    METRIC_FIELDS = {
+        'executor_run_time_ms': 'executorRunTime',
+        'executor_cpu_time_ns': 'executorCpuTime',
+        'jvm_gc_time_ms': 'jvmGcTime',
+        'input_bytes': 'inputBytes',
+        'output_bytes': 'outputBytes',
+        'shuffle_read_bytes': 'shuffleReadBytes',
+        'shuffle_write_bytes': 'shuffleWriteBytes',
+        'memory_bytes_spilled': 'memoryBytesSpilled',
+        'disk_bytes_spilled': 'diskBytesSpilled',
+    }
+    
+    def __init__(self, spark: SparkSession, job_name: str, report_path: str,
+                 settle_timeout_seconds: float = 10.0):
+        self.spark = spark
+        self.job_name = job_name
+        self.report_path = report_path.rstrip('/')
+        self.settle_timeout_seconds = settle_timeout_seconds
+        self.steps: Dict[str, Dict[str, any]] = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def step(self, name: str):
+        """Tag every Spark job started by this thread inside the block with the step's job group"""
+        sc = self.spark.sparkContext
+        group_id = f"{self.job_name}:{name}"
+        sc.setJobGroup(group_id, name, interruptOnCancel=False)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            wall_time = time.monotonic() - start
+            # Job groups are thread-local properties - clear them so later jobs are not attributed here
+            sc.setLocalProperty("spark.jobGroup.id", None)
+            sc.setLocalProperty("spark.job.description", None)
+            with self._lock:
+                entry = self.steps.setdefault(name, {'group_id': group_id, 'wall_time_seconds': 0.0})
+                entry['wall_time_seconds'] = round(entry['wall_time_seconds'] + wall_time, 3)
+    
+    def _stage_ids(self, group_id: str) -> List[int]:
+        tracker = self.spark.sparkContext.statusTracker()
+        stage_ids = []
+        for job_id in tracker.getJobIdsForGroup(group_id):
+            job_info = tracker.getJobInfo(job_id)
+            if job_info is not None:
+                stage_ids.extend(job_info.stageIds)
+        return sorted(set(stage_ids))
+    
+    def _fetch_stage(self, base_url: str, stage_id: int) -> Optional[Dict[str, any]]:
+        """Latest attempt of a stage, waiting briefly for the listener bus to finish its metrics"""
+        deadline = time.monotonic() + self.settle_timeout_seconds
+        while True:
+            with urlopen(f"{base_url}/stages/{stage_id}", timeout=10) as response:
+                attempts = json.loads(response.read().decode("utf-8"))
+            latest = max(attempts, key=lambda a: a.get('attemptId', 0)) if attempts else None
+            if latest is None or latest.get('status') != 'ACTIVE' or time.monotonic() >= deadline:
+                return latest
+            time.sleep(0.2)
+    
+    def collect(self) -> Dict[str, Dict[str, any]]:
+        """Sum the stage metrics of each step's jobs (skipped stages reused a shuffle and cost nothing)"""
+        sc = self.spark.sparkContext
+        base_url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}" if sc.uiWebUrl else None
+        
+        with self._lock:
+            steps = {name: dict(entry) for name, entry in self.steps.items()}
+        
+        for name, entry in steps.items():
+            stage_ids = self._stage_ids(entry['group_id'])
+            entry['stages'] = len(stage_ids)
+            if base_url is None:
+                entry['source'] = 'status_tracker'
+                continue
+            
+            totals = {metric: 0 for metric in self.METRIC_FIELDS}
+            completed = skipped = 0
+            for stage_id in stage_ids:
+                try:
+                    stage = self._fetch_stage(base_url, stage_id)
+                except (URLError, OSError) as e:
+                    logger.warning(f"Stage metrics unavailable for stage {stage_id}: {e}")
+                    continue
+                if stage is None or stage.get('status') == 'SKIPPED':
+                    skipped += 1
+                    continue
+                completed += 1
+                for metric, field in self.METRIC_FIELDS.items():
+                    totals[metric] += int(stage.get(field) or 0)
+            
+            entry.update(totals)
+            entry.update({'completed_stages': completed, 'skipped_stages': skipped, 'source': 'rest_api'})
+        return steps
+    
+    def write_report(self, extra: Optional[Dict[str, any]] = None) -> Dict[str, any]:
+        """Write the per-step metrics as JSON next to the outputs"""
+        report = {
+            'job_name': self.job_name,
+            'application_id': self.spark.sparkContext.applicationId,
+            'generated_at': datetime.now().isoformat(),
+            'steps': self.collect()
+        }
+        if extra:
+            report.update(extra)
+        
+        report_file = f"{self.report_path}/{self.job_name}_{report['application_id']}.json"
+        get_filesystem_backend(self.spark, report_file).write_text(report_file, json.dumps(report, indent=2, default=str))
+        logger.info(f"Stage metrics report written to {report_file}")
+        for name, entry in report['steps'].items():
+            logger.info(
+                f"Step {name}: {entry['wall_time_seconds']}s wall, {entry.get('executor_run_time_ms', 0):,} ms executor, "
+                f"{entry.get('jvm_gc_time_ms', 0):,} ms GC, {entry.get('input_bytes', 0):,} B input, "
+                f"{entry.get('shuffle_read_bytes', 0):,}/{entry.get('shuffle_write_bytes', 0):,} B shuffle r/w, "
+                f"{entry.get('disk_bytes_spilled', 0):,} B spilled"
+            )
+        return report
+
+
+class MaterializationPolicy:
+    """Truncates lineage at declared stage boundaries and logs what each materialization cost"""
+    
+    POLICIES = ("none", "local_checkpoint", "checkpoint", "delta")
+    
+    def __init__(self, spark: SparkSession, policy: str, staging_path: str,
+                 checkpoint_dir: Optional[str] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown materialization policy: {policy}")
+        if policy == "checkpoint":
+            if not checkpoint_dir:
+                raise ValueError("The checkpoint materialization policy requires --checkpoint-path")
+            spark.sparkContext.setCheckpointDir(checkpoint_dir)
+        self.spark = spark
+        self.policy = policy
+        self.staging_path = staging_path.rstrip('/')
+        self.costs: Dict[str, Dict[str, any]] = {}
+    
+    @property
+    def stores_in_executors(self) -> bool:
+        """Local checkpoints live in the block managers, so caching the result again would store it twice"""
+        return self.policy == "local_checkpoint"
+    
+    def materialize(self, name: str, df: DataFrame) -> DataFrame:
+        """Materialize eagerly and return the DataFrame that reads the materialized data"""
+        if self.policy == "none":
+            return df
+        
+        start = time.monotonic()
+        cost = {'policy': self.policy}
+        if self.policy == "local_checkpoint":
+            # Fast, but lost executors mean recomputing from the source
+            df = df.localCheckpoint(eager=True)
+        elif self.policy == "checkpoint":
+            # Reliable storage survives executor loss; the checkpoint directory must be set
+            df = df.checkpoint(eager=True)
+        else:
+            # Write-and-reread keeps a queryable copy and gives the planner exact file statistics
+            path = f"{self.staging_path}/{name}"
+            df.write.format("delta").mode("overwrite").option("overwriteSchema", "true").save(path)
+            reader = DeltaLogReader(self.spark, path)
+            operation_metrics = reader.commit_info(reader.latest_version()).get('operationMetrics', {})
+            cost['bytes'] = int(operation_metrics.get('numOutputBytes', 0))
+            cost['rows'] = int(operation_metrics.get('numOutputRows', 0))
+            df = self.spark.read.format("delta").load(path)
+        
+        cost['seconds'] = round(time.monotonic() - start, 3)
+        self.costs[name] = cost
+        logger.info(f"Materialized {name} with {self.policy}: {cost}")
+        return df
+
+
+class TaskGraph:
+    """Runs dependent driver-side steps on a thread pool, each branch in its own FAIR scheduler pool"""
+    
+    def __init__(self, spark: SparkSession, max_workers: int = 4):
+        self.spark = spark
+        self.max_workers = max(max_workers, 1)
+        self.tasks: Dict[str, Dict[str, any]] = {}
+    
+    def add(self, name: str, fn, depends_on: Tuple[str, ...] = (), branch: Optional[str] = None) -> None:
+        """Register a step; fn receives a dict with the results of its dependencies"""
+        unknown = [dep for dep in depends_on if dep not in self.tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown task(s) {unknown}")
+        self.tasks[name] = {'fn': fn, 'depends_on': tuple(depends_on), 'branch': branch or name}
+    
+    def _execute(self, name: str, inputs: Dict[str, any]) -> Dict[str, any]:
+        task = self.tasks[name]
+        sc = self.spark.sparkContext
+        # Pools are thread-local properties of the submitting thread
+        sc.setLocalProperty("spark.scheduler.pool", task['branch'])
+        start = time.monotonic()
+        try:
+            result = task['fn'](inputs)
+            outcome = {'status': 'succeeded', 'result': result}
+        except Exception as e:
+            # Logged with its traceback here; the exception itself is re-raised (chained) by run()
+            logger.exception(f"Task {name} failed: {str(e)}")
+            outcome = {'status': 'failed', 'error': e}
+        finally:
+            sc.setLocalProperty("spark.scheduler.pool", None)
+        end = time.monotonic()
+        outcome.update({'branch': task['branch'], 'start': start, 'end': end, 'seconds': round(end - start, 3)})
+        return outcome
+    
+    def run(self) -> Dict[str, Dict[str, any]]:
+        """Run every task once its dependencies succeeded; dependents of failures are skipped"""
+        outcomes: Dict[str, Dict[str, any]] = {}
+        pending = dict(self.tasks)
+        running = {}
+        start = time.monotonic()
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="pipeline-task") as executor:
+            while pending or running:
+                for name in list(pending):
+                    deps = pending[name]['depends_on']
+                    if any(outcomes.get(dep, {}).get('status') in ('failed', 'skipped') for dep in deps):
+                        outcomes[name] = {'status': 'skipped', 'branch': pending.pop(name)['branch'], 'seconds': 0.0}
+                    elif all(outcomes.get(dep, {}).get('status') == 'succeeded' for dep in deps):
+                        inputs = {dep: outcomes[dep]['result'] for dep in deps}
+                        running[executor.submit(self._execute, name, inputs)] = name
+                        pending.pop(name)
+                
+                if running:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        outcomes[running.pop(future)] = future.result()
+        
+        self._log_timing(outcomes, time.monotonic() - start)
+        failed = {name: outcome['error'] for name, outcome in outcomes.items() if outcome['status'] == 'failed'}
+        if failed:
+            skipped = [name for name, outcome in outcomes.items() if outcome['status'] == 'skipped']
+            summary = {name: f"{type(error).__name__}: {error}" for name, error in failed.items()}
+            raise RuntimeError(f"Pipeline tasks failed: {summary}" + (f" (skipped: {skipped})" if skipped else "")) \
+                from next(iter(failed.values()))
+        return outcomes
+    
+    @staticmethod
+    def _log_timing(outcomes: Dict[str, Dict[str, any]], wall_time: float) -> None:
+        branches: Dict[str, List[Dict[str, any]]] = {}
+        for outcome in outcomes.values():
+            if 'start' in outcome:
+                branches.setdefault(outcome['branch'], []).append(outcome)
+        
+        summaries = []
+        for branch, branch_outcomes in branches.items():
+            span = max(o['end'] for o in branch_outcomes) - min(o['start'] for o in branch_outcomes)
+            busy = sum(o['seconds'] for o in branch_outcomes)
+            summaries.append(f"{branch} {span:.1f}s span/{busy:.1f}s busy")
+        logger.info(f"Task graph finished in {wall_time:.1f}s wall time: {', '.join(summaries)}")
+
+
+class WriteScheduler:
+    """Submits independent output writes concurrently, each in its own FAIR scheduler pool"""
+    
+    def __init__(self, spark: SparkSession, max_workers: int = 3):
+        self.spark = spark
+        self.max_workers = max(max_workers, 1)
+    
+    def run(self, writes: List[Tuple[str, any]]) -> Dict[str, Dict[str, any]]:
+        """Run (name, write callable) pairs; a failed output does not cancel the others"""
+        graph = TaskGraph(self.spark, self.max_workers)
+        for name, write in writes:
+            graph.add(name, lambda _, write=write: write())
+        
+        outcomes = graph.run()
+        return {name: {'metrics': outcome['result'], 'seconds': outcome['seconds']} for name, outcome in outcomes.items()}
+
+
+class CacheManager:
+    """Reference-counted DataFrame cache driven by the declared consumers of each pipeline frame"""
+    
+    def __init__(self, spark: SparkSession, actions: List[Tuple[str, List[str]]],
+                 preferred_level: str = "MEMORY_AND_DISK", memory_headroom: float = 0.5):
+        self.spark = spark
+        self.preferred_level = preferred_level
+        self.memory_headroom = memory_headroom
+        self.action_inputs = dict(actions)
+        
+        # A frame is consumed once by every action that reads it
+        self.consumers: Dict[str, int] = {}
+        for _, inputs in actions:
+            for name in inputs:
+                self.consumers[name] = self.consumers.get(name, 0) + 1
+        
+        self._entries: Dict[str, Dict[str, any]] = {}
+        self.stats = {'persisted': 0, 'skipped': 0, 'hits': 0, 'released': 0, 'evicted_partitions': 0}
+        # Actions may consume frames from several driver threads at once
+        self._lock = threading.RLock()
+    
+    def _available_storage_memory(self) -> Optional[int]:
+        """Remaining storage memory summed over the block managers of all executors"""
+        try:
+            status = self.spark.sparkContext._jsc.sc().getExecutorMemoryStatus()
+            remaining = 0
+            iterator = status.values().iterator()
+            while iterator.hasNext():
+                remaining += iterator.next()._2()
+            return remaining
+        except Exception as e:
+            logger.warning(f"Could not read executor memory status: {str(e)}")
+            return None
+    
+    def _choose_storage_level(self, df: DataFrame) -> Tuple[StorageLevel, str]:
+        """Preferred level unless the estimated size crowds storage memory, then serialized/disk levels"""
+        preferred = self.preferred_level
+        estimated_bytes = JoinPlanner(self.spark, 0).estimate_size(df)['bytes']
+        available = self._available_storage_memory()
+        
+        if estimated_bytes is not None and available:
+            if estimated_bytes > available:
+                preferred = "DISK_ONLY"
+            elif estimated_bytes > available * self.memory_headroom and preferred in ("MEMORY_ONLY", "MEMORY_AND_DISK_DESER"):
+                preferred = "MEMORY_AND_DISK"
+        
+        return getattr(StorageLevel, preferred), preferred
+    
+    def register(self, name: str, df: DataFrame, stored: bool = False) -> DataFrame:
+        """Persist the frame only if more than one action consumes it and it is not stored already"""
+        with self._lock:
+            return self._register(name, df, stored)
+    
+    def _register(self, name: str, df: DataFrame, stored: bool) -> DataFrame:
+        consumers = self.consumers.get(name, 0)
+        if consumers <= 1 or self.preferred_level == "NONE" or stored:
+            self._entries[name] = {'df': df, 'remaining': consumers, 'persisted': False, 'uses': 0}
+            self.stats['skipped'] += 1
+            logger.info(f"Not caching {name}: {consumers} consumer(s)")
+            return df
+        
+        storage_level, level_name = self._choose_storage_level(df)
+        df = df.persist(storage_level)
+        self._entries[name] = {'df': df, 'remaining': consumers, 'persisted': True, 'uses': 0}
+        self.stats['persisted'] += 1
+        logger.info(f"Caching {name} at {level_name} for {consumers} consumers")
+        return df
+    
+    def _record_evictions(self) -> None:
+        """Cached partitions that the block managers have dropped (memory pressure)"""
+        missing = 0
+        for info in self.spark.sparkContext._jsc.sc().getRDDStorageInfo():
+            missing += info.numPartitions() - info.numCachedPartitions()
+        self.stats['evicted_partitions'] = max(self.stats['evicted_partitions'], missing)
+    
+    def shared_inputs(self, actions: List[str]) -> List[str]:
+        """Frames read by more than one of the given actions"""
+        counts: Dict[str, int] = {}
+        for action in actions:
+            for name in self.action_inputs.get(action, []):
+                counts[name] = counts.get(name, 0) + 1
+        return [name for name, count in counts.items() if count > 1]
+    
+    def warm(self, names: List[str]) -> None:
+        """Fill the cache of persisted frames up front so concurrent consumers do not each compute them"""
+        for name in names:
+            entry = self._entries.get(name)
+            if entry is None or not entry['persisted'] or entry.get('warm'):
+                continue
+            start = time.monotonic()
+            entry['df'].write.format("noop").mode("overwrite").save()
+            entry['warm'] = True
+            logger.info(f"Materialized shared {name} in {time.monotonic() - start:.1f}s")
+    
+    @contextmanager
+    def consume(self, action: str):
+        """Scope of one pipeline action; its inputs are released when it completes"""
+        with self._lock:
+            inputs = [name for name in self.action_inputs.get(action, []) if name in self._entries]
+            for name in inputs:
+                entry = self._entries[name]
+                entry['uses'] += 1
+                if entry['persisted'] and entry['uses'] > 1:
+                    self.stats['hits'] += 1
+        
+        yield
+        
+        with self._lock:
+            for name in inputs:
+                entry = self._entries[name]
+                entry['remaining'] -= 1
+                if entry['persisted'] and entry['remaining'] <= 0:
+                    self._record_evictions()
+                    entry['df'].unpersist(blocking=False)
+                    entry['persisted'] = False
+                    self.stats['released'] += 1
+                    logger.info(f"Released cached {name} after its last consumer ({action})")
+
+
+class ETLJobProcessor:
+    """Main ETL job processor with advanced patterns"""
+    
+    # Actions of run_etl_pipeline and the intermediate frames each one reads
+    # (one write_<grain> action per declared aggregate grain is added in __init__)
+    PIPELINE_ACTIONS = [
+        ("quality_customers", ["customer_raw"]),
+        ("quality_transactions", ["transaction_raw"]),
+        ("write_customers", ["customer_processed", "customer_raw"]),
+        ("write_transactions", ["transaction_processed", "transaction_raw", "customer_processed"]),
+    ]
+    
+    # Added by every transform; never carried across a join
+    PROCESSING_METADATA_COLUMNS = ("processed_timestamp", "data_source", "processing_date")
+    
+    # Frames after which lineage is truncated by the materialization policy
+    MATERIALIZATION_BOUNDARIES = ("customer_processed", "transaction_processed")
+    
+    def __init__(self, spark: SparkSession, config: SparkJobConfig):
+        self.spark = spark
+        self.config = config
+        self.validator = DataQualityValidator()
+        self.optimizer = SparkOptimizer()
+        self.metrics = PipelineMetrics(spark)
+        self.stage_metrics = StageMetricsCollector(spark, config.job_name, config.metrics_path)
+        self.output_planner = OutputPlanner(spark, config.target_file_size_bytes)
+        self.upsert_writer = DeltaUpsertWriter(spark, config.partition_columns)
+        self.write_scheduler = WriteScheduler(spark, config.write_concurrency)
+        self.materializer = MaterializationPolicy(
+            spark, config.materialization, config.materialization_path, config.checkpoint_path
+        )
+        self.grain_aggregator = GrainAggregator({name: AGGREGATE_GRAINS[name] for name in config.aggregate_grains})
+        grain_actions = [] if config.incremental_aggregates else [
+            (f"write_{name}", ["aggregate_grains", "transaction_processed"]) for name in config.aggregate_grains
+        ]
+        self.cache = CacheManager(spark, self.PIPELINE_ACTIONS + grain_actions, config.cache_level)
+        self.schema_drift = SchemaDriftDetector(spark, config.schema_cache_path)
+        self.bloom_prefilter = BloomJoinPrefilter(spark, config.bloom_fpp, config.bloom_max_num_bits) if config.bloom_prefilter else None
+        self.skew_handler = SkewJoinHandler(
+            spark, config.skew_threshold, config.skew_salt_buckets, config.skew_sample_fraction
+        ) if config.skew_join else None
+        self.file_index = FileIndexManifest(
+            spark, config.file_index_path, config.file_index_refresh_partitions,
+            config.file_index_full_relist_hours, config.full_refresh
+        )
+        # Full input listing per dataset from the last read, before incremental filtering
+        self.indexed_files: Dict[str, List[Dict[str, any]]] = {}
+        self.ingestion = IncrementalFileTracker(
+            spark, config.state_path, config.full_refresh, config.incremental_lookback_ms
+        ) if config.incremental else None
+        self.aggregate_refresher = ChangeFeedAggregateRefresher(self) if config.incremental_aggregates else None
+    
+    def read_data_with_optimization(self, path: str, format: str = "parquet",
+                                    files: Optional[List[str]] = None,
+                                    schema: Optional[StructType] = None,
+                                    version: Optional[int] = None,
+                                    changes_from: Optional[int] = None,
+                                    changes_to: Optional[int] = None) -> DataFrame:
+        """Read data with optimization settings, optionally restricted to an explicit file list
+        
+        For Delta tables, version pins a snapshot and changes_from/changes_to read the change
+        data feed of that (inclusive) version range instead of a snapshot.
+        """
+        
+        read_options = {
+            "recursiveFileLookup": "true"
+        }
+        
+        # A schema contract replaces inference and projects only the contracted columns
+        if schema is None:
+            read_options["mergeSchema"] = "true"
+        
+        if format.lower() == "parquet":
+            # Parquet optimization
+            read_options.update({
+                "pushDownPredicate": "true",
+                "pushDownAggregate": "true"
+            })
+        elif format.lower() == "delta":
+            # The latest snapshot is the default - there is no "latest" version to pass
+            if changes_from is not None:
+                read_options.update({
+                    "readChangeFeed": "true",
+                    "startingVersion": str(changes_from)
+                })
+                if changes_to is not None:
+                    read_options["endingVersion"] = str(changes_to)
+            elif version is not None:
+                read_options["versionAsOf"] = str(version)
+        
+        # Caching is decided by the cache manager from the pipeline's consumers
+        reader = self.spark.read.format(format).options(**read_options)
+        if schema is not None:
+            reader = reader.schema(schema)
+        return reader.load(files) if files is not None else reader.load(path)
+    
+    def read_input(self, dataset: str) -> Optional[DataFrame]:
+        """Read a raw input dataset from its cached file index - only new arrivals in incremental mode"""
+        path = f"{self.config.input_path}/{dataset}/"
+        files = self.file_index.refresh(dataset, path)
+        self.indexed_files[dataset] = files
+        if self.ingestion is not None:
+            files = self.ingestion.new_files(dataset, files)
+        
+        if not files:
+            return None
+        
+        contract = SCHEMA_CONTRACTS.get(dataset)
+        if contract is not None:
+            self.schema_drift.check(dataset, files, contract, listed=self.indexed_files[dataset])
+        return self.read_data_with_optimization(path, "parquet", files=[f['path'] for f in files], schema=contract)
+    
+    def load_processed(self, name: str) -> Optional[DataFrame]:
+        """Already written output an incremental run builds on, None for full runs or a first load"""
+        if self.ingestion is None or self.config.full_refresh:
+            return None
+        
+        existing_path = f"{self.config.output_path}/{name}/"
+        if DeltaLogReader(self.spark, existing_path).latest_version() < 0:
+            return None
+        return self.spark.read.format("delta").load(existing_path)
+    
+    def rerank_customers(self, customer_processed: DataFrame) -> DataFrame:
+        """Every customer of the countries a batch touches, re-ranked against the processed table
+        
+        A batch-only rank would rank new arrivals among themselves; the countries a changed
+        customer left are re-ranked too. The upsert rewrites only rows whose rank moved.
+        """
+        existing = self.load_processed("processed_customers")
+        if existing is None:
+            return customer_processed
+        
+        changed_ids = customer_processed.select("customer_id")
+        countries = existing.join(changed_ids, "customer_id", "left_semi").select("country") \
+            .unionByName(customer_processed.select("country")).distinct() \
+            .withColumnRenamed("country", "affected_country")
+        dimension = existing.join(changed_ids, "customer_id", "left_anti").unionByName(customer_processed)
+        affected = dimension.join(
+            broadcast(countries), dimension["country"].eqNullSafe(countries["affected_country"]), "left_semi"
+        )
+        return self.rank_customers(affected.drop("customer_rank_in_country")).select(*customer_processed.columns)
+    
+    def load_transaction_history(self, transaction_raw: DataFrame) -> Optional[DataFrame]:
+        """Earlier cleaned transactions of the customers in a batch, for their per-customer windows"""
+        existing = self.load_processed("processed_transactions")
+        if existing is None:
+            return None
+        
+        cleaned = self.clean_transactions(transaction_raw)
+        return existing.join(cleaned.select("customer_id").distinct(), "customer_id", "left_semi") \
+            .select(*cleaned.columns)
+    
+    def load_customer_dimension(self, customer_processed: Optional[DataFrame]) -> Optional[DataFrame]:
+        """Customers to join transactions against - new arrivals merged over the already processed table"""
+        existing = self.load_processed("processed_customers")
+        if existing is None:
+            return customer_processed
+        
+        if customer_processed is None:
+            return existing
+        return existing.join(customer_processed.select("customer_id"), "customer_id", "left_anti") \
+            .unionByName(customer_processed)
+    
+    def write_data_with_optimization(self, df: DataFrame, path: str, 
+                                   format: str = "parquet", mode: str = "overwrite",
+                                   name: Optional[str] = None) -> Dict[str, any]:
+        """Write data with optimization settings and return the output metrics of the write"""
+        
+        name = name or path.rstrip('/').split('/')[-1]
+        
+        if mode == "upsert":
+            if format.lower() != "delta":
+                raise ValueError(f"Upsert writes require the delta format, got {format}")
+            if DeltaLogReader(self.spark, path).latest_version() >= 0:
+                try:
+                    self.upsert_writer.merge(df, path, OUTPUT_MERGE_KEYS[name], OUTPUT_CHANGE_COLUMNS.get(name))
+                    logger.info(f"Successfully merged data into {path}")
+                except Exception as e:
+                    logger.error(f"Failed to merge data into {path}: {str(e)}")
+                    raise
+                metrics = self.metrics.record_merge(name, path)
+                metrics['file_sizes'] = self.output_planner.file_size_report(path, format)
+                logger.info(f"File sizes for {name}: {metrics['file_sizes']}")
+                return metrics
+            # First load - nothing to merge into
+            mode = "overwrite"
+        
+        replace_where = None
+        if mode == "replace_partitions":
+            if not self.config.partition_columns:
+                raise ValueError("replace_partitions writes require --partition-columns")
+            if format.lower() == "delta" and DeltaLogReader(self.spark, path).latest_version() >= 0:
+                replace_where = self.partition_replace_predicate(df, self.config.partition_columns)
+                logger.info(f"Replacing partitions of {path} where {replace_where}")
+        
+        # Shape the data before the writer is built from it
+        if self.config.coalesce_partitions > 0:
+            df = df.coalesce(self.config.coalesce_partitions)
+            max_records_per_file = self.config.max_records_per_file
+            logger.info(f"Coalesced to {self.config.coalesce_partitions} partitions")
+        else:
+            output_plan = self.output_planner.plan(
+                df, path, format, self.config.partition_columns, self.config.max_records_per_file
+            )
+            df = self.output_planner.apply(df, output_plan)
+            max_records_per_file = output_plan['max_records_per_file']
+            logger.info(f"Output plan for {name}: {output_plan}")
+        
+        df, observation = self.metrics.instrument(df, format)
+        writer = df.write.mode("overwrite" if mode == "replace_partitions" else mode).format(format)
+        if max_records_per_file:
+            writer = writer.option("maxRecordsPerFile", str(max_records_per_file))
+        
+        # Apply partitioning if specified
+        if self.config.partition_columns:
+            logger.info(f"Partitioning by columns: {self.config.partition_columns}")
+            writer = writer.partitionBy(*self.config.partition_columns)
+        
+        # Apply bucketing if specified
+        if self.config.bucket_columns and self.config.num_buckets > 0:
+            logger.info(f"Bucketing by columns: {self.config.bucket_columns}, buckets: {self.config.num_buckets}")
+            writer = writer.bucketBy(self.config.num_buckets, *self.config.bucket_columns)
+        
+        # Format-specific optimizations
+        if format.lower() == "parquet":
+            writer = writer.option("compression", "snappy")
+            if mode == "replace_partitions":
+                # Only the partitions present in the data are replaced
+                writer = writer.option("partitionOverwriteMode", "dynamic")
+        elif format.lower() == "delta":
+            if mode == "overwrite":
+                writer = writer.option("overwriteSchema", "true")
+            elif replace_where is not None:
+                writer = writer.option("replaceWhere", replace_where)
+            writer = writer.option("optimizeWrite", "true")
+            writer = writer.option("autoCompact", "true")
+        
+        # Write with error handling
+        try:
+            writer.save(path)
+            logger.info(f"Successfully wrote data to {path}")
+        except Exception as e:
+            logger.error(f"Failed to write data to {path}: {str(e)}")
+            raise
+        
+        metrics = self.metrics.record(name, path, format, observation)
+        metrics['file_sizes'] = self.output_planner.file_size_report(path, format)
+        logger.info(f"File sizes for {name}: {metrics['file_sizes']}")
+        return metrics
+    
+    @staticmethod
+    def partition_replace_predicate(df: DataFrame, partition_columns: List[str]) -> str:
+        """replaceWhere predicate matching exactly the partitions present in the data (one Spark job)"""
+        partitions = df.select(*partition_columns).distinct().collect()
+        if not partitions:
+            # Nothing to replace - a predicate no partition satisfies keeps the write a no-op
+            return "false"
+        
+        if len(partition_columns) == 1:
+            column = partition_columns[0]
+            values = ", ".join(_sql_literal(row[column]) for row in partitions if row[column] is not None)
+            predicate = f"`{column}` IN ({values})" if values else "false"
+            if any(row[column] is None for row in partitions):
+                predicate = f"({predicate} OR `{column}` IS NULL)"
+            return predicate
+        
+        return " OR ".join(
+            "(" + " AND ".join(
+                f"`{c}` IS NULL" if row[c] is None else f"`{c}` = {_sql_literal(row[c])}" for c in partition_columns
+            ) + ")"
+            for row in partitions
+        )
+    
+    def load_raw(self, dataset: str, frame: str) -> Optional[DataFrame]:
+        """Read a raw input and register it with the cache manager"""
+        logger.info(f"Reading raw {dataset} data")
+        with self.stage_metrics.step(f"read_{dataset}"):
+            df = self.read_input(dataset)
+        return None if df is None else self.cache.register(frame, df)
+    
+    def profile_raw(self, df: Optional[DataFrame], dataset: str) -> Optional[Dict[str, any]]:
+        """Data quality check of a raw input (its first cache consumer)"""
+        if df is None:
+            return None
+        action = f"quality_{dataset}"
+        with self.stage_metrics.step(action), self.cache.consume(action):
+            quality = self.run_quality_check(df, dataset)
+        duplicates = f"{quality['duplicate_count']}"
+        if quality.get('duplicate_count_estimated'):
+            duplicates += f" (estimated, ±{quality['duplicate_error_bound']})"
+        logger.info(f"{dataset.capitalize()} data quality: {quality['total_rows']} rows, {duplicates} duplicates")
+        return quality
+    
+    def build_customers(self, customer_raw: Optional[DataFrame]) -> Optional[DataFrame]:
+        if customer_raw is None:
+            return None
+        logger.info("Transforming customer data")
+        with self.stage_metrics.step("transform_customers"):
+            return self.materialize_boundary(
+                "customer_processed", self.rerank_customers(self.transform_customer_data(customer_raw))
+            )
+    
+    def build_transactions(self, transaction_raw: Optional[DataFrame],
+                           customer_processed: Optional[DataFrame]) -> Tuple[Optional[DataFrame], Optional[DataFrame]]:
+        """Processed transactions and their analytical aggregates"""
+        if transaction_raw is None:
+            return None, None
+        
+        customer_dimension = self.load_customer_dimension(customer_processed)
+        if customer_dimension is None:
+            # Leave the transaction files pending until customers exist to join them against
+            logger.warning("No customer data available yet - deferring new transactions to a later run")
+            if self.ingestion is not None:
+                self.ingestion.discard("transactions")
+            return None, None
+        
+        logger.info("Transforming transaction data")
+        with self.stage_metrics.step("transform_transactions"):
+            transaction_processed = self.materialize_boundary(
+                "transaction_processed", self.transform_transaction_data(
+                    transaction_raw, customer_dimension, self.load_transaction_history(transaction_raw)
+                )
+            )
+            
+            if self.aggregate_refresher is not None:
+                # Aggregates are refreshed from the change feed once the transactions are written
+                return transaction_processed, None
+            
+            # Create analytical aggregates - the grouping-sets result is shared by every grain table
+            grouped = self.cache.register("aggregate_grains", self.grain_aggregator.aggregate(transaction_processed))
+            analytical_aggregates = self.create_analytical_aggregates(transaction_processed, grouped)
+        return transaction_processed, analytical_aggregates
+    
+    def _output_writer(self, name: str, action: str, df: DataFrame, mode: str):
+        """Write callable for one output, run on a scheduler thread"""
+        def write() -> Dict[str, any]:
+            logger.info(f"Writing {name}")
+            with self.stage_metrics.step(action), self.cache.consume(action):
+                return self.write_data_with_optimization(
+                    df, f"{self.config.output_path}/{name}/", format="delta", mode=mode
+                )
+        return write
+    
+    def materialize_boundary(self, name: str, df: DataFrame) -> DataFrame:
+        """Apply the materialization policy at a stage boundary, then cache for the remaining consumers"""
+        if name in self.MATERIALIZATION_BOUNDARIES:
+            df = self.materializer.materialize(name, df)
+        return self.cache.register(name, df, stored=self.materializer.stores_in_executors)
+    
+    def run_quality_check(self, df: DataFrame, dataset: str) -> Dict[str, any]:
+        """Profile a raw input with the configured quality mode"""
+        if self.config.quality_mode == "sketch":
+            return self.profile_with_sketches(df, dataset)
+        return self.validator.check_data_quality(df, exact_duplicates=self.config.exact_duplicates)
+    
+    def profile_with_sketches(self, df: DataFrame, dataset: str) -> Dict[str, any]:
+        """Profile the current data_date partition into a sidecar sketch and check rolling windows"""
+        
+        store = SketchStore(self.spark, self.config.sketch_path)
+        partition = self.config.data_date
+        sketch = None if self.config.refresh_sketches else store.load(dataset, partition)
+        
+        if sketch is None:
+            # Only today's partition is scanned; earlier days come from their sidecars. The reads do
+            # not discover partitions, so the day is isolated by its data_date=<date> files
+            partition_files = [f['path'] for f in self.indexed_files.get(dataset, [])
+                               if f['partition_values'].get('data_date') == partition]
+            if not partition_files:
+                # A sidecar of the whole input would be merged into every rolling window once per day
+                logger.warning(f"No data_date={partition} files for {dataset} - profiling exactly, without a sidecar")
+                return self.validator.check_data_quality(df, exact_duplicates=self.config.exact_duplicates)
+            partition_df = self.read_data_with_optimization(
+                f"{self.config.input_path}/{dataset}/", "parquet",
+                files=partition_files, schema=SCHEMA_CONTRACTS.get(dataset)
+            )
+            sketch = self.validator.build_profile_sketch(partition_df, dataset, partition)
+            store.save(sketch)
+            logger.info(f"Saved profile sketch for {dataset} partition {partition} to {store.sidecar_path(dataset, partition)}")
+        else:
+            logger.info(f"Reusing profile sketch for {dataset} partition {partition}")
+        
+        # Rolling profiles are merged from sidecars only
+        for window_days in (7, 30):
+            window = store.load_window(dataset, partition, window_days)
+            passed, errors = self.validator.evaluate_quality_thresholds(
+                window.to_quality_report(), self.config.quality_thresholds
+            )
+            if passed:
+                logger.info(f"{dataset} {window_days}-day profile ({len(window.partitions)} partitions) within quality thresholds")
+            else:
+                logger.warning(f"{dataset} {window_days}-day profile breaches quality thresholds: {'; '.join(errors)}")
+        
+        return sketch.to_quality_report()
+    
+    def transform_customer_data(self, df: DataFrame) -> DataFrame:
+        """Transform customer data with advanced techniques"""
+        
+        logger.info("Starting customer data transformation")
+        
+        # Data cleaning and standardization
+        cleaned_df = df.select(
+            col("customer_id"),
+            trim(upper(col("first_name"))).alias("first_name"),
+            trim(upper(col("last_name"))).alias("last_name"),
+            lower(trim(col("email"))).alias("email"),
+            regexp_replace(col("phone"), r"[^\d]", "").alias("phone_cleaned"),
+            trim(upper(col("country"))).alias("country"),
+            col("registration_date").cast(TimestampType()).alias("registration_timestamp"),
+            col("age"),
+            coalesce(col("lifetime_value"), lit(0.0)).alias("lifetime_value")
+        ).filter(
+            # Data quality filters
+            col("customer_id").isNotNull() &
+            col("email").contains("@") &
+            col("age").between(13, 120) &
+            col("registration_date").isNotNull()
+        )
+        
+        # Feature engineering with window functions
+        enriched_df = self.rank_customers(cleaned_df).withColumn(
+            "days_since_registration", 
+            expr("datediff(current_date(), date(registration_timestamp))")
         ).withColumn(
             "age_group",
             when(col("age") < 25, "Young")
@@ -332,262 +2770,1603 @@ class ETLJobProcessor:
             .otherwise("Low Value")
         )
         
-        # Add data processing metadata
-        processed_df = enriched_df.withColumn(
-            "processed_timestamp", current_timestamp()
-        ).withColumn(
-            "data_source", lit("customer_etl_job")
-        ).withColumn(
-            "processing_date", lit(self.config.data_date)
+        # Add data processing metadata
+        processed_df = enriched_df.withColumn(
+            "processed_timestamp", current_timestamp()
+        ).withColumn(
+            "data_source", lit("customer_etl_job")
+        ).withColumn(
+            "processing_date", lit(self.config.data_date)
+        )
+        
+        logger.info("Customer data transformation completed")
+        return processed_df
+    
+    @staticmethod
+    def rank_customers(df: DataFrame) -> DataFrame:
+        """Rank customers within their country, most recently registered first"""
+        window_spec = Window.partitionBy("country").orderBy(col("registration_timestamp").desc())
+        return df.withColumn("customer_rank_in_country", rank().over(window_spec))
+    
+    def transform_transaction_data(self, df: DataFrame, customer_df: DataFrame,
+                                   history: Optional[DataFrame] = None) -> DataFrame:
+        """Transform transaction data with join optimization
+        
+        history holds earlier cleaned transactions of the same customers (incremental runs); they are
+        transformed again so the per-customer windows cover each customer's full history.
+        """
+        
+        logger.info("Starting transaction data transformation")
+        
+        cleaned_transactions = self.clean_transactions(df)
+        if history is not None:
+            # A re-delivered transaction replaces its earlier version
+            cleaned_transactions = history.join(
+                cleaned_transactions.select("transaction_id"), "transaction_id", "left_anti"
+            ).unionByName(cleaned_transactions)
+        
+        # Join with customer data using optimized join; the customer side's processing
+        # metadata would otherwise duplicate the columns added below
+        customer_attributes = customer_df.drop(*self.PROCESSING_METADATA_COLUMNS)
+        
+        # Transactions of customers that did not survive cleaning are dropped before the shuffle
+        if self.bloom_prefilter is not None:
+            join_plan = JoinPlanner(self.spark, self.config.broadcast_threshold_bytes).plan(
+                cleaned_transactions, customer_attributes
+            )
+            if join_plan['strategy'] == 'broadcast':
+                logger.info("Skipping the Bloom prefilter - the customer join is broadcast and does not shuffle transactions")
+            else:
+                cleaned_transactions = self.bloom_prefilter.apply(cleaned_transactions, customer_attributes, "customer_id")
+        enriched_transactions = self.optimizer.optimize_joins(
+            cleaned_transactions, customer_attributes, ["customer_id"], "inner",
+            broadcast_threshold_bytes=self.config.broadcast_threshold_bytes,
+            skew_handler=self.skew_handler
+        )
+        
+        # Sequence features and per-customer aggregates share one partition/order spec, so
+        # Spark evaluates them in a single Window operator over one exchange and sort on
+        # customer_id; the aggregates use a whole-partition frame instead of a groupBy + join
+        window_customer = Window.partitionBy("customer_id").orderBy("transaction_timestamp", "transaction_id")
+        customer_frame = window_customer.rowsBetween(Window.unboundedPreceding, Window.unboundedFollowing)
+        
+        final_transactions = self.derive_transaction_features(enriched_transactions.select(
+            "*",
+            row_number().over(window_customer).alias("transaction_sequence"),
+            lag("transaction_timestamp").over(window_customer).alias("previous_transaction_timestamp"),
+            spark_count("*").over(customer_frame).alias("total_transactions"),
+            spark_sum("amount").over(customer_frame).alias("total_amount"),
+            avg("amount").over(customer_frame).alias("avg_transaction_amount"),
+            spark_max("transaction_timestamp").over(customer_frame).alias("last_transaction_date"),
+            spark_min("transaction_timestamp").over(customer_frame).alias("first_transaction_date"),
+            size(collect_set("merchant_id").over(customer_frame)).alias("unique_merchants_count")
+        ))
+        
+        # --mode plan-check asserts this count (and the single Window) against plan_baseline.json
+        logger.info(
+            f"Transaction feature stage planned with "
+            f"{SparkOptimizer.count_plan_nodes(final_transactions, 'Exchange')} shuffle exchange(s)"
+        )
+        
+        # Add processing metadata
+        processed_transactions = final_transactions.withColumn(
+            "processed_timestamp", current_timestamp()
+        ).withColumn(
+            "data_source", lit("transaction_etl_job")
+        ).withColumn(
+            "processing_date", lit(self.config.data_date)
+        )
+        
+        logger.info("Transaction data transformation completed")
+        return processed_transactions
+    
+    @staticmethod
+    def clean_transactions(df: DataFrame) -> DataFrame:
+        """Clean and standardize raw transactions (shared by the batch and streaming pipelines)"""
+        return df.select(
+            col("transaction_id"),
+            col("user_id").alias("customer_id"),  # Standardize column name
+            col("amount").cast(DoubleType()),
+            col("merchant_id"),
+            to_timestamp(col("timestamp") / 1000).alias("transaction_timestamp"),  # Convert from milliseconds
+            upper(trim(col("status"))).alias("status"),
+            lower(trim(col("payment_method"))).alias("payment_method"),
+            col("location.country").alias("transaction_country")
+        ).filter(
+            # Data quality filters
+            col("transaction_id").isNotNull() &
+            col("customer_id").isNotNull() &
+            (col("amount") > 0) &
+            (col("amount") < 100000) &  # Reasonable transaction limit
+            col("transaction_timestamp").isNotNull() &
+            col("status").isin(["COMPLETED", "PENDING", "FAILED", "CANCELLED"])
+        )
+    
+    @staticmethod
+    def derive_transaction_features(df: DataFrame) -> DataFrame:
+        """Row-level features from the per-customer columns (window- or state-computed)"""
+        return df.withColumn(
+            "days_since_last_transaction",
+            expr("datediff(transaction_timestamp, previous_transaction_timestamp)")
+        ).withColumn(
+            "amount_deviation_from_avg",
+            col("amount") - col("avg_transaction_amount")
+        ).withColumn(
+            "customer_lifetime_days",
+            expr("datediff(last_transaction_date, first_transaction_date) + 1")
+        ).withColumn(
+            "avg_transactions_per_day",
+            expr("total_transactions / greatest(customer_lifetime_days, 1)")
+        ).withColumn(
+            "is_weekend",
+            expr("dayofweek(transaction_timestamp) in (1, 7)")  # Sunday = 1, Saturday = 7
+        ).withColumn(
+            "transaction_hour", hour("transaction_timestamp")
+        ).withColumn(
+            "is_high_value",
+            col("amount") > 1000
+        ).drop("previous_transaction_timestamp")
+    
+    def create_analytical_aggregates(self, transaction_df: DataFrame,
+                                     grouped: Optional[DataFrame] = None) -> Dict[str, DataFrame]:
+        """Create analytical aggregates for reporting - one table per declared grain, from one pass
+        
+        grouped is the grouping-sets result when the caller already holds it (e.g. cached).
+        """
+        
+        logger.info(f"Creating analytical aggregates for grains {list(self.grain_aggregator.grains)}")
+        
+        if grouped is None:
+            grouped = self.grain_aggregator.aggregate(transaction_df)
+        
+        final_aggregates = {
+            name: self.add_aggregate_metadata(aggregates)
+            for name, aggregates in self.grain_aggregator.split(grouped).items()
+        }
+        
+        logger.info("Analytical aggregates created")
+        return final_aggregates
+    
+    def add_aggregate_metadata(self, aggregates: DataFrame) -> DataFrame:
+        """Add processing metadata to an aggregate grain table"""
+        return aggregates.withColumn(
+            "created_timestamp", current_timestamp()
+        ).withColumn(
+            "data_source", lit("analytical_aggregates")
+        ).withColumn(
+            "processing_date", lit(self.config.data_date)
+        )
+    
+    def run_etl_pipeline(self) -> None:
+        """Run the complete ETL pipeline"""
+        
+        pipeline_start = datetime.now()
+        logger.info(f"Starting ETL pipeline: {self.config.job_name}")
+        logger.info(f"Environment: {self.config.environment}")
+        logger.info(f"Processing date: {self.config.data_date}")
+        
+        # Incremental runs upsert customers on customer_id and transactions on transaction_id: the
+        # re-ranked countries and re-windowed customers replace their previous versions, and a batch
+        # re-read after a failed run merges onto its own rows instead of duplicating them.
+        # Aggregates are refreshed from the change feed
+        write_modes = {}
+        if self.config.write_mode != "auto":
+            write_mode = self.config.write_mode
+        elif self.ingestion is not None and not self.config.full_refresh:
+            write_mode = "append"
+            write_modes["processed_customers"] = "upsert"
+            write_modes["processed_transactions"] = "upsert"
+        else:
+            write_mode = "overwrite"
+        no_output = {'rows': 0, 'bytes': 0}
+        customer_metrics = transaction_metrics = no_output
+        
+        try:
+            # Set checkpoint directory if provided
+            if self.config.checkpoint_path:
+                self.spark.sparkContext.setCheckpointDir(self.config.checkpoint_path)
+            
+            # Reads, quality checks and transforms as a task graph: the two input branches run
+            # side by side, and transactions wait for the customers they are joined against
+            graph = TaskGraph(self.spark, self.config.driver_concurrency)
+            graph.add("read_customers", lambda _: self.load_raw("customers", "customer_raw"), branch="customers")
+            graph.add("quality_customers", lambda r: self.profile_raw(r["read_customers"], "customers"),
+                      depends_on=("read_customers",), branch="customers")
+            graph.add("transform_customers", lambda r: self.build_customers(r["read_customers"]),
+                      depends_on=("read_customers", "quality_customers"), branch="customers")
+            graph.add("read_transactions", lambda _: self.load_raw("transactions", "transaction_raw"), branch="transactions")
+            graph.add("quality_transactions", lambda r: self.profile_raw(r["read_transactions"], "transactions"),
+                      depends_on=("read_transactions",), branch="transactions")
+            graph.add("transform_transactions",
+                      lambda r: self.build_transactions(r["read_transactions"], r["transform_customers"]),
+                      depends_on=("read_transactions", "quality_transactions", "transform_customers"),
+                      branch="transactions")
+            outcomes = graph.run()
+            
+            if outcomes["read_customers"]['result'] is None and outcomes["read_transactions"]['result'] is None:
+                logger.info("No input files to process")
+                return
+            
+            customer_processed = outcomes["transform_customers"]['result']
+            transaction_processed, analytical_aggregates = outcomes["transform_transactions"]['result']
+            
+            # Write processed data - independent outputs are written concurrently
+            outputs = []
+            if customer_processed is not None:
+                outputs.append(("processed_customers", "write_customers", customer_processed))
+            if transaction_processed is not None:
+                outputs.append(("processed_transactions", "write_transactions", transaction_processed))
+                for name, aggregates in (analytical_aggregates or {}).items():
+                    outputs.append((name, f"write_{name}", aggregates))
+            
+            # Shared parents are computed once before the writes compete for them
+            with self.stage_metrics.step("materialize_shared"):
+                self.cache.warm(self.cache.shared_inputs([action for _, action, _ in outputs]))
+            write_results = self.write_scheduler.run([
+                (name, self._output_writer(name, action, df, write_modes.get(name, write_mode)))
+                for name, action, df in outputs
+            ])
+            customer_metrics = write_results.get("processed_customers", {}).get('metrics', no_output)
+            transaction_metrics = write_results.get("processed_transactions", {}).get('metrics', no_output)
+            
+            # Incremental aggregates read the change feed of the transactions just written
+            if self.aggregate_refresher is not None:
+                with self.stage_metrics.step("refresh_aggregates"):
+                    refreshed = self.aggregate_refresher.refresh()
+                write_results.update({name: {'metrics': metrics} for name, metrics in refreshed.items()})
+            
+            # Outputs are durable - only now advance the ingestion high-water marks
+            if self.ingestion is not None:
+                self.ingestion.commit()
+            
+            # Final report from the metrics collected during the writes - no recomputation
+            logger.info("="*50)
+            logger.info("ETL PIPELINE COMPLETED SUCCESSFULLY")
+            logger.info("="*50)
+            logger.info(f"Processed customers: {customer_metrics['rows']:,} rows, {customer_metrics['bytes']:,} bytes")
+            logger.info(f"Processed transactions: {transaction_metrics['rows']:,} rows, {transaction_metrics['bytes']:,} bytes")
+            for name in self.grain_aggregator.grains:
+                aggregate_metrics = write_results.get(name, {}).get('metrics', no_output)
+                logger.info(f"Aggregates {name}: {aggregate_metrics['rows']:,} rows, {aggregate_metrics['bytes']:,} bytes")
+            if self.skew_handler is not None:
+                logger.info(f"Skewed join keys salted: {self.skew_handler.reports or 'none'}")
+            if self.bloom_prefilter is not None and transaction_processed is not None:
+                logger.info(f"Bloom prefilter: {self.bloom_prefilter.pruned_rows() or 'not applied'}")
+            logger.info(f"Total processing time: {datetime.now() - pipeline_start}")
+            logger.info("="*50)
+            
+        except Exception as e:
+            logger.error(f"ETL pipeline failed: {str(e)}")
+            raise
+        
+        finally:
+            # Cleanup anything still cached (e.g. after a failure)
+            self.spark.catalog.clearCache()
+            logger.info(f"Cleaned up cached data - cache stats: {self.cache.stats}")
+            if self.materializer.costs:
+                logger.info(f"Materialization costs: {self.materializer.costs}")
+            
+            try:
+                self.stage_metrics.write_report({'data_date': self.config.data_date, 'outputs': self.metrics.outputs})
+            except Exception as e:
+                logger.warning(f"Could not write stage metrics report: {str(e)}")
+
+
+class ChangeFeedAggregateRefresher:
+    """Refreshes the aggregate grains from the Delta change data feed of processed_transactions
+    
+    Only the finest-grain groups touched by changes since the last processed version are
+    recomputed and merged; coarser grains are rolled up from the finest table's sketches.
+    """
+    
+    FINEST_GRAIN = "analytical_aggregates"
+    SOURCE = "processed_transactions"
+    
+    def __init__(self, processor: 'ETLJobProcessor'):
+        self.processor = processor
+        self.spark = processor.spark
+        self.config = processor.config
+        self.dimensions = AGGREGATE_GRAINS[self.FINEST_GRAIN]
+        self.state_path = f"{self.config.state_path.rstrip('/')}/aggregates_change_feed.json"
+        self.backend = get_filesystem_backend(self.spark, self.state_path)
+    
+    def _table_path(self, name: str) -> str:
+        return f"{self.config.output_path}/{name}/"
+    
+    def load_state(self) -> Dict[str, any]:
+        if self.config.full_refresh or not self.backend.exists(self.state_path):
+            return {'source': self.SOURCE, 'last_version': -1}
+        return json.loads(self.backend.read_text(self.state_path))
+    
+    def save_state(self, version: int, mode: str) -> None:
+        state = {'source': self.SOURCE, 'last_version': version, 'mode': mode, 'updated_at': datetime.now().isoformat()}
+        self.backend.write_text(self.state_path, json.dumps(state, indent=2))
+        logger.info(f"Aggregates refreshed up to {self.SOURCE} version {version}")
+    
+    def enable_change_feed(self, path: str) -> None:
+        """Turn on the change data feed of an existing table (a no-op commit is avoided)"""
+        properties = self.spark.sql(f"DESCRIBE DETAIL delta.`{path}`").first()['properties'] or {}
+        if properties.get('delta.enableChangeDataFeed', 'false').lower() != 'true':
+            self.spark.sql(f"ALTER TABLE delta.`{path}` SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+            logger.info(f"Enabled the change data feed of {path}")
+    
+    def affected_groups(self, changes_from: int, changes_to: int) -> DataFrame:
+        """Finest-grain keys of every changed row - pre-images too, so groups a row left are refreshed"""
+        changes = self.processor.read_data_with_optimization(
+            self._table_path(self.SOURCE), "delta", changes_from=changes_from, changes_to=changes_to
+        )
+        return changes.select(
+            date_format("transaction_timestamp", "yyyy-MM-dd").alias("transaction_date"),
+            "transaction_country",
+            "payment_method"
+        ).distinct()
+    
+    def recompute(self, snapshot: DataFrame, affected: DataFrame) -> DataFrame:
+        """Affected groups aggregated from the current snapshot, flagged for deletion when now empty"""
+        # A literal range on the changed dates lets Delta skip files by their timestamp statistics;
+        # the semi-join on the formatted date below cannot
+        low, high = affected.agg(spark_min("transaction_date"), spark_max("transaction_date")).first()
+        if low is not None:
+            snapshot = snapshot.filter(
+                f"(transaction_timestamp >= CAST({_sql_literal(low)} AS TIMESTAMP) AND "
+                f"transaction_timestamp < CAST({_sql_literal(high)} AS TIMESTAMP) + INTERVAL 1 DAY) "
+                f"OR transaction_timestamp IS NULL"
+            )
+        scoped = snapshot.join(
+            broadcast(affected),
+            (date_format(snapshot["transaction_timestamp"], "yyyy-MM-dd").eqNullSafe(affected["transaction_date"]))
+            & snapshot["transaction_country"].eqNullSafe(affected["transaction_country"])
+            & snapshot["payment_method"].eqNullSafe(affected["payment_method"]),
+            "left_semi"
+        )
+        grains = GrainAggregator({self.FINEST_GRAIN: self.dimensions})
+        recomputed = self.processor.add_aggregate_metadata(grains.split(grains.aggregate(scoped))[self.FINEST_GRAIN])
+        
+        join_condition = [affected[d].eqNullSafe(recomputed[d]) for d in self.dimensions]
+        return affected.join(recomputed, join_condition, "left").select(
+            *[affected[d] for d in self.dimensions],
+            *[recomputed[c] for c in recomputed.columns if c not in self.dimensions],
+            recomputed["transaction_count"].isNull().alias("__deleted")
+        )
+    
+    def merge(self, updates: DataFrame) -> Dict[str, any]:
+        path = self._table_path(self.FINEST_GRAIN)
+        columns = [c for c in updates.columns if c != "__deleted"]
+        assignments = {c: f"s.`{c}`" for c in columns}
+        condition = " AND ".join(f"t.`{d}` <=> s.`{d}`" for d in self.dimensions)
+        
+        logger.info(f"Merging refreshed aggregate groups into {path}")
+        DeltaTable.forPath(self.spark, path).alias("t").merge(updates.alias("s"), condition) \
+            .whenMatchedDelete(condition="s.__deleted") \
+            .whenMatchedUpdate(set=assignments) \
+            .whenNotMatchedInsert(condition="NOT s.__deleted", values=assignments) \
+            .execute()
+        return self.processor.metrics.record_merge(self.FINEST_GRAIN, path)
+    
+    def _write(self, name: str, df: DataFrame) -> Dict[str, any]:
+        return self.processor.write_data_with_optimization(df, self._table_path(name), format="delta", mode="overwrite")
+    
+    def refresh(self) -> Dict[str, Dict[str, any]]:
+        """Bring every configured grain up to the latest version of processed_transactions"""
+        if DeltaTable is None:
+            raise RuntimeError("Incremental aggregates require the delta-spark Python package")
+        
+        source_path = self._table_path(self.SOURCE)
+        if DeltaLogReader(self.spark, source_path).latest_version() < 0:
+            logger.info(f"No {self.SOURCE} table yet - nothing to aggregate")
+            return {}
+        # Versions committed before this are not in the feed; a first refresh rebuilds anyway
+        self.enable_change_feed(source_path)
+        
+        latest = DeltaLogReader(self.spark, source_path).latest_version()
+        last_version = self.load_state()['last_version']
+        if last_version >= latest:
+            logger.info(f"Aggregates already reflect {self.SOURCE} version {latest}")
+            return {}
+        
+        snapshot = self.processor.read_data_with_optimization(source_path, "delta", version=latest)
+        results = {}
+        mode = "incremental"
+        if last_version < 0 or DeltaLogReader(self.spark, self._table_path(self.FINEST_GRAIN)).latest_version() < 0:
+            mode = "full"
+        else:
+            try:
+                # Read once for the date range and the semi-join
+                affected = self.affected_groups(last_version + 1, latest).persist(StorageLevel.MEMORY_AND_DISK)
+                try:
+                    results[self.FINEST_GRAIN] = self.merge(self.recompute(snapshot, affected))
+                finally:
+                    affected.unpersist()
+            except Exception as e:
+                # e.g. versions from before the feed was enabled, or a vacuumed change range
+                logger.warning(f"Change feed refresh from version {last_version + 1} failed, rebuilding: {str(e)}")
+                mode = "full"
+        
+        grains = self.processor.grain_aggregator
+        if mode == "full":
+            logger.info(f"Rebuilding aggregates from {self.SOURCE} version {latest}")
+            # Every grain table is split from one grouping-sets result - computed once, not per write
+            grouped = grains.aggregate(snapshot).persist(StorageLevel.MEMORY_AND_DISK)
+            try:
+                for name, df in self.processor.create_analytical_aggregates(snapshot, grouped).items():
+                    results[name] = self._write(name, df)
+            finally:
+                grouped.unpersist()
+        else:
+            # Coarser grains are rolled up from the merged finest table, not from transactions
+            finest = self.spark.read.format("delta").load(self._table_path(self.FINEST_GRAIN))
+            for name, dimensions in grains.grains.items():
+                if name != self.FINEST_GRAIN:
+                    results[name] = self._write(name, self.processor.add_aggregate_metadata(
+                        grains.rollup(finest, dimensions)
+                    ))
+        
+        self.save_state(latest, mode)
+        return results
+
+
+class StreamingTransactionPipeline:
+    """Transaction features as a Structured Streaming query over the transactions file source
+    
+    Cleaning and row-level features are the batch pipeline's. The per-customer window columns are
+    replaced by running values kept in the state store (applyInPandasWithState): each transaction
+    sees the customer's totals up to and including itself, not over the whole batch.
+    """
+    
+    OUTPUT_NAME = "streaming_transactions"
+    
+    # Per-customer running state; timestamps as pandas nanoseconds to stay time-zone neutral
+    STATE_SCHEMA = StructType([
+        StructField("transaction_count", LongType()),
+        StructField("total_amount", DoubleType()),
+        StructField("first_timestamp_ns", LongType()),
+        StructField("last_timestamp_ns", LongType()),
+        StructField("merchants", ArrayType(StringType()))
+    ])
+    
+    # Same names and types as the window columns of transform_transaction_data
+    FEATURE_FIELDS = [
+        StructField("transaction_sequence", IntegerType()),
+        StructField("previous_transaction_timestamp", TimestampType()),
+        StructField("total_transactions", LongType()),
+        StructField("total_amount", DoubleType()),
+        StructField("avg_transaction_amount", DoubleType()),
+        StructField("last_transaction_date", TimestampType()),
+        StructField("first_transaction_date", TimestampType()),
+        StructField("unique_merchants_count", IntegerType())
+    ]
+    
+    def __init__(self, processor: 'ETLJobProcessor'):
+        self.processor = processor
+        self.spark = processor.spark
+        self.config = processor.config
+    
+    def customer_dimension(self) -> DataFrame:
+        """Processed customers when the batch pipeline has written them, else the raw customer input"""
+        path = f"{self.config.output_path}/processed_customers/"
+        if DeltaLogReader(self.spark, path).latest_version() >= 0:
+            return self.spark.read.format("delta").load(path)
+        
+        customers = self.processor.read_input("customers")
+        if customers is None:
+            raise ValueError(f"Streaming needs customers: no table at {path} and no customer input files")
+        logger.info("No processed_customers table - joining streamed transactions against the raw customer input")
+        return self.processor.transform_customer_data(customers)
+    
+    def read_stream(self) -> DataFrame:
+        return self.spark.readStream.format("parquet") \
+            .schema(SCHEMA_CONTRACTS["transactions"]) \
+            .option("recursiveFileLookup", "true") \
+            .option("maxFilesPerTrigger", str(self.config.streaming_max_files_per_trigger)) \
+            .load(f"{self.config.input_path}/transactions/")
+    
+    def build(self, raw_transactions: DataFrame, customer_df: DataFrame) -> DataFrame:
+        """Cleaned, enriched and featured transactions from a streaming frame of raw transactions"""
+        cleaned = self.processor.clean_transactions(raw_transactions) \
+            .withWatermark("transaction_timestamp", self.config.streaming_watermark)
+        
+        # Stream-static join: the customer side is re-read by every micro-batch
+        customer_attributes = customer_df.drop(*ETLJobProcessor.PROCESSING_METADATA_COLUMNS)
+        enriched = cleaned.join(customer_attributes, "customer_id", "inner")
+        
+        input_columns = enriched.columns
+        output_schema = StructType(enriched.schema.fields + self.FEATURE_FIELDS)
+        output_columns = output_schema.fieldNames()
+        ttl_ms = self.config.streaming_state_ttl_days * 24 * 60 * 60 * 1000
+        
+        def customer_features(key, batches, state):
+            if state.hasTimedOut:
+                # No transactions for the TTL (in event time) - forget the customer
+                state.remove()
+                return
+            
+            if state.exists:
+                count, total, first_ns, last_ns, merchants = state.get
+                merchants = set(merchants)
+            else:
+                count, total, first_ns, last_ns, merchants = 0, 0.0, None, None, set()
+            
+            for batch in batches:
+                batch = batch.sort_values(["transaction_timestamp", "transaction_id"]).reset_index(drop=True)
+                timestamps = batch["transaction_timestamp"]
+                running_count = pd.Series(range(count + 1, count + len(batch) + 1))
+                running_total = total + batch["amount"].cumsum()
+                first = timestamps.cummin()
+                last = timestamps.cummax()
+                previous = timestamps.shift(1)
+                if last_ns is not None:
+                    previous.iloc[0] = pd.Timestamp(last_ns)
+                    first = first.clip(upper=pd.Timestamp(first_ns))
+                    last = last.clip(lower=pd.Timestamp(last_ns))
+                
+                unique_merchants = []
+                for merchant in batch["merchant_id"]:
+                    if merchant is not None and not pd.isna(merchant):
+                        merchants.add(merchant)
+                    unique_merchants.append(len(merchants))
+                
+                batch["transaction_sequence"] = running_count
+                batch["previous_transaction_timestamp"] = previous
+                batch["total_transactions"] = running_count
+                batch["total_amount"] = running_total
+                batch["avg_transaction_amount"] = running_total / running_count
+                batch["last_transaction_date"] = last
+                batch["first_transaction_date"] = first
+                batch["unique_merchants_count"] = unique_merchants
+                
+                count, total = count + len(batch), float(running_total.iloc[-1])
+                first_ns, last_ns = first.iloc[-1].value, last.iloc[-1].value
+                yield batch[output_columns]
+            
+            state.update((count, total, first_ns, last_ns, sorted(merchants)))
+            # TTL from the customer's last event - the first batch's watermark is still 0, which would
+            # expire every customer without events in the next batch; never set below the watermark
+            state.setTimeoutTimestamp(max(last_ns // 1_000_000 + ttl_ms, state.getCurrentWatermarkMs()))
+        
+        featured = enriched.groupBy("customer_id").applyInPandasWithState(
+            customer_features, output_schema, self.STATE_SCHEMA, "append", GroupStateTimeout.EventTimeTimeout
+        ).select(*input_columns, *[f.name for f in self.FEATURE_FIELDS])
+        
+        return self.processor.derive_transaction_features(featured).withColumn(
+            "processed_timestamp", current_timestamp()
+        ).withColumn(
+            "data_source", lit("transaction_streaming_job")
+        ).withColumn(
+            "processing_date", lit(self.config.data_date)
+        )
+    
+    def start(self):
+        """Start the query; availableNow processes everything pending (in maxFilesPerTrigger batches) and stops"""
+        # Per-customer state outgrows the JVM heap of the default provider on large customer bases
+        self.spark.conf.set(
+            "spark.sql.streaming.stateStore.providerClass",
+            "org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider"
+        )
+        path = f"{self.config.output_path}/{self.OUTPUT_NAME}/"
+        featured = self.build(self.read_stream(), self.customer_dimension())
+        
+        writer = featured.writeStream.format(self.config.streaming_format) \
+            .outputMode("append") \
+            .option("checkpointLocation", self.config.streaming_checkpoint_path)
+        if self.config.partition_columns:
+            writer = writer.partitionBy(*self.config.partition_columns)
+        
+        trigger = self.config.streaming_trigger
+        if trigger == "availableNow":
+            writer = writer.trigger(availableNow=True)
+        else:
+            writer = writer.trigger(processingTime=self.config.streaming_interval)
+        
+        logger.info(f"Starting streaming query ({trigger}) into {path}")
+        return writer.start(path)
+    
+    def run(self) -> None:
+        query = self.start()
+        try:
+            query.awaitTermination()
+        finally:
+            if query.isActive:
+                query.stop()
+            logger.info(f"Streaming query finished - last progress: {json.dumps(query.lastProgress)}")
+
+
+class SyntheticDataGenerator:
+    """Deterministic customers/transactions matching the raw input contracts, for benchmarks and local runs"""
+    
+    BASE_CUSTOMERS = 10000
+    BASE_TRANSACTIONS = 100000
+    HOT_CUSTOMERS = 10
+    
+    FIRST_NAMES = ["anna", "ben", "carla", "david", "elena", "farid", "grace", "hiro", "ines", "jamal"]
+    LAST_NAMES = ["smith", "garcia", "chen", "muller", "rossi", "kowalski", "silva", "tanaka", "okafor", "novak"]
+    COUNTRIES = ["US", "GB", "DE", "FR", "ES", "IT", "PL", "BR", "JP", "IN"]
+    # Repeated entries weight the draw: mostly completed, some pending/failed, rare cancelled
+    STATUSES = ["completed"] * 7 + ["pending", "failed", "cancelled"]
+    PAYMENT_METHODS = ["Card", "card ", "PAYPAL", "bank_transfer", "wallet"]
+    
+    def __init__(self, spark: SparkSession, scale_factor: float = 1.0, skew: float = 0.0,
+                 null_rate: float = 0.0, seed: int = 42, data_date: Optional[str] = None):
+        self.spark = spark
+        self.scale_factor = scale_factor
+        self.skew = skew
+        self.null_rate = null_rate
+        self.seed = seed
+        self.data_date = data_date or datetime.now().strftime('%Y-%m-%d')
+    
+    @property
+    def num_customers(self) -> int:
+        return max(int(self.BASE_CUSTOMERS * self.scale_factor), self.HOT_CUSTOMERS)
+    
+    @property
+    def num_transactions(self) -> int:
+        return max(int(self.BASE_TRANSACTIONS * self.scale_factor), 1)
+    
+    def _uniform_sql(self, salt: int) -> str:
+        """Uniform [0, 1) from a hash of the row id - identical across runs and partitionings"""
+        return f"(pmod(xxhash64(id, {self.seed}, {salt}), 1000000) / 1000000.0)"
+    
+    def _uniform(self, salt: int):
+        return expr(self._uniform_sql(salt))
+    
+    def _pick(self, values: List[str], salt: int):
+        options = ", ".join(_sql_literal(v) for v in values)
+        return expr(f"element_at(array({options}), cast(pmod(xxhash64(id, {self.seed}, {salt}), {len(values)}) + 1 as int))")
+    
+    def _nullable(self, column, salt: int):
+        return when(self._uniform(salt) < self.null_rate, lit(None)).otherwise(column)
+    
+    def customers(self) -> DataFrame:
+        """Customers with the columns and types of the customers contract"""
+        ids = self.spark.range(self.num_customers)
+        first_name = self._pick(self.FIRST_NAMES, 1)
+        df = ids.select(
+            expr("concat('C', lpad(cast(id as string), 10, '0'))").alias("customer_id"),
+            first_name.alias("first_name"),
+            self._pick(self.LAST_NAMES, 2).alias("last_name"),
+            self._nullable(expr("concat('user', cast(id as string), '@example.com')"), 3).alias("email"),
+            self._nullable(expr(f"concat('+1 (555) ', lpad(cast(pmod(xxhash64(id, {self.seed}, 4), 10000000) as string), 7, '0'))"), 5).alias("phone"),
+            self._nullable(self._pick(self.COUNTRIES, 6), 7).alias("country"),
+            expr(f"cast(date_sub(date'{self.data_date}', cast(pmod(xxhash64(id, {self.seed}, 8), 1500) as int)) as string)")
+                .alias("registration_date"),
+            self._nullable((self._uniform(9) * 80 + 13).cast("int"), 10).alias("age"),
+            self._nullable(spark_round(expr(f"pow(10, {self._uniform_sql(11)} * 5)"), 2), 12).alias("lifetime_value")
+        )
+        return self._conform(df, "customers")
+    
+    def transactions(self) -> DataFrame:
+        """Transactions with millisecond timestamps and nested location; skew routes a share to a few hot customers"""
+        ids = self.spark.range(self.num_transactions)
+        customer_index = when(
+            self._uniform(20) < self.skew, expr(f"pmod(xxhash64(id, {self.seed}, 21), {self.HOT_CUSTOMERS})")
+        ).otherwise(expr(f"pmod(xxhash64(id, {self.seed}, 22), {self.num_customers})"))
+        end_ms = int(datetime.strptime(self.data_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() * 1000) + 86400000
+        
+        df = ids.select(
+            expr("concat('T', lpad(cast(id as string), 12, '0'))").alias("transaction_id"),
+            concat(lit("C"), lpad(customer_index.cast("string"), 10, "0")).alias("user_id"),
+            self._nullable(spark_round(expr(f"pow(10, {self._uniform_sql(23)} * 4)"), 2), 24).alias("amount"),
+            expr(f"concat('M', cast(pmod(xxhash64(id, {self.seed}, 25), 1000) as string))").alias("merchant_id"),
+            self._nullable(expr(f"{end_ms} - cast({self._uniform_sql(26)} * {30 * 86400000} as bigint)"), 27).alias("timestamp"),
+            self._pick(self.STATUSES, 28).alias("status"),
+            self._nullable(self._pick(self.PAYMENT_METHODS, 29), 30).alias("payment_method"),
+            struct(self._nullable(self._pick(self.COUNTRIES, 31), 32).alias("country")).alias("location")
         )
-        
-        logger.info(f"Customer data transformation completed. Final count: {processed_df.count()}")
-        return processed_df
+        return self._conform(df, "transactions")
+    
+    @staticmethod
+    def _conform(df: DataFrame, dataset: str) -> DataFrame:
+        """Cast to the contract types so the data reads back exactly like the real inputs"""
+        contract = SCHEMA_CONTRACTS[dataset]
+        return df.select(*[col(field.name).cast(field.dataType).alias(field.name) for field in contract.fields])
+    
+    def write(self, input_path: str) -> None:
+        """Write both datasets where read_input expects them"""
+        for dataset, df in (("customers", self.customers()), ("transactions", self.transactions())):
+            path = f"{input_path.rstrip('/')}/{dataset}/"
+            df.write.mode("overwrite").parquet(path)
+            logger.info(f"Generated synthetic {dataset} at {path} (scale factor {self.scale_factor})")
+
+
+class BenchmarkRunner:
+    """Times each transform stage on synthetic data with a noop sink and stores the results per commit"""
+    
+    STAGES = ("transform_customers", "transform_transactions", "create_aggregates")
+    
+    def __init__(self, processor: 'ETLJobProcessor', results_path: str, iterations: int = 3):
+        self.processor = processor
+        self.spark = processor.spark
+        self.results_path = results_path.rstrip('/')
+        self.iterations = iterations
+    
+    @staticmethod
+    def current_commit() -> str:
+        """Commit being benchmarked - from CI variables, else the local checkout"""
+        for variable in ("GIT_COMMIT", "GITHUB_SHA"):
+            if os.environ.get(variable):
+                return os.environ[variable]
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return "unknown"
+    
+    @staticmethod
+    def _materialize(df: DataFrame) -> DataFrame:
+        """Cache and fill an input so its cost stays out of the timed stage"""
+        df = df.cache()
+        df.write.format("noop").mode("overwrite").save()
+        return df
+    
+    def _time(self, build) -> Dict[str, float]:
+        timings = []
+        for _ in range(self.iterations):
+            start = time.monotonic()
+            build().write.format("noop").mode("overwrite").save()
+            timings.append(time.monotonic() - start)
+        timings.sort()
+        return {'min_seconds': round(timings[0], 3), 'median_seconds': round(timings[len(timings) // 2], 3)}
     
-    def transform_transaction_data(self, df: DataFrame, customer_df: DataFrame) -> DataFrame:
-        """Transform transaction data with join optimization"""
+    def run_scale(self, generator: SyntheticDataGenerator) -> Dict[str, any]:
+        """Time the three transform stages at one scale factor"""
+        processor = self.processor
+        customers = self._materialize(generator.customers())
+        transactions = self._materialize(generator.transactions())
         
-        logger.info("Starting transaction data transformation")
+        results = {}
+        results['transform_customers'] = self._time(lambda: processor.transform_customer_data(customers))
+        customer_processed = self._materialize(processor.transform_customer_data(customers))
         
-        # Clean and standardize transaction data
-        cleaned_transactions = df.select(
-            col("transaction_id"),
-            col("user_id").alias("customer_id"),  # Standardize column name
-            col("amount").cast(DoubleType()),
-            col("merchant_id"),
-            to_timestamp(col("timestamp") / 1000).alias("transaction_timestamp"),  # Convert from milliseconds
-            upper(trim(col("status"))).alias("status"),
-            lower(trim(col("payment_method"))).alias("payment_method"),
-            col("location.country").alias("transaction_country")
-        ).filter(
-            # Data quality filters
-            col("transaction_id").isNotNull() &
-            col("customer_id").isNotNull() &
-            col("amount") > 0 &
-            col("amount") < 100000 &  # Reasonable transaction limit
-            col("timestamp").isNotNull() &
-            col("status").isin(["COMPLETED", "PENDING", "FAILED", "CANCELLED"])
+        results['transform_transactions'] = self._time(
+            lambda: processor.transform_transaction_data(transactions, customer_processed)
         )
+        transaction_processed = self._materialize(processor.transform_transaction_data(transactions, customer_processed))
         
-        # Aggregate transaction metrics per customer
-        customer_aggregates = cleaned_transactions.groupBy("customer_id").agg(
-            spark_count("*").alias("total_transactions"),
-            spark_sum("amount").alias("total_amount"),
-            avg("amount").alias("avg_transaction_amount"),
-            spark_max("transaction_timestamp").alias("last_transaction_date"),
-            spark_min("transaction_timestamp").alias("first_transaction_date"),
-            collect_list("merchant_id").alias("merchants_list")
-        ).withColumn(
-            "unique_merchants_count", size(expr("array_distinct(merchants_list)"))
-        ).withColumn(
-            "customer_lifetime_days", 
-            expr("datediff(last_transaction_date, first_transaction_date) + 1")
-        ).withColumn(
-            "avg_transactions_per_day",
-            expr("total_transactions / greatest(customer_lifetime_days, 1)")
-        )
+        # The grouping-sets pass computes every grain; splitting into tables only filters its result
+        results['create_aggregates'] = self._time(lambda: processor.grain_aggregator.aggregate(transaction_processed))
         
-        # Join with customer data using optimized join
-        enriched_transactions = self.optimizer.optimize_joins(
-            cleaned_transactions, customer_df, ["customer_id"], "inner"
-        )
+        for df in (customers, transactions, customer_processed, transaction_processed):
+            df.unpersist()
+        return {
+            'scale_factor': generator.scale_factor,
+            'customers': generator.num_customers,
+            'transactions': generator.num_transactions,
+            'stages': results
+        }
+    
+    def run(self, scale_factors: List[float], skew: float, null_rate: float,
+            compare_commit: Optional[str] = None) -> Dict[str, any]:
+        commit = self.current_commit()
+        report = {
+            'commit': commit,
+            'spark_version': self.spark.version,
+            'master': self.spark.sparkContext.master,
+            'skew': skew,
+            'null_rate': null_rate,
+            'iterations': self.iterations,
+            'generated_at': datetime.now().isoformat(),
+            'runs': []
+        }
+        for scale_factor in scale_factors:
+            generator = SyntheticDataGenerator(self.spark, scale_factor, skew, null_rate,
+                                               data_date=self.processor.config.data_date)
+            run = self.run_scale(generator)
+            report['runs'].append(run)
+            logger.info(f"Benchmark at scale factor {scale_factor}: {run['stages']}")
         
-        # Add transaction features
-        window_customer = Window.partitionBy("customer_id").orderBy("transaction_timestamp")
+        backend = get_filesystem_backend(self.spark, self.results_path)
+        results_file = f"{self.results_path}/{commit}.json"
+        backend.write_text(results_file, json.dumps(report, indent=2))
+        logger.info(f"Benchmark results written to {results_file}")
         
-        final_transactions = enriched_transactions.withColumn(
-            "transaction_sequence", row_number().over(window_customer)
-        ).withColumn(
-            "days_since_last_transaction",
-            expr("datediff(transaction_timestamp, lag(transaction_timestamp) over (partition by customer_id order by transaction_timestamp))")
-        ).withColumn(
-            "amount_deviation_from_avg",
-            expr("amount - avg(amount) over (partition by customer_id)")
-        ).withColumn(
-            "is_weekend",
-            expr("dayofweek(transaction_timestamp) in (1, 7)")  # Sunday = 1, Saturday = 7
-        ).withColumn(
-            "transaction_hour", hour("transaction_timestamp")
-        ).withColumn(
-            "is_high_value",
-            col("amount") > 1000
+        if compare_commit:
+            self.compare(report, compare_commit)
+        return report
+    
+    def compare(self, report: Dict[str, any], baseline_commit: str) -> None:
+        """Log median stage time ratios against the results stored for another commit"""
+        backend = get_filesystem_backend(self.spark, self.results_path)
+        baseline_file = f"{self.results_path}/{baseline_commit}.json"
+        if not backend.exists(baseline_file):
+            logger.warning(f"No benchmark results stored for {baseline_commit}")
+            return
+        
+        baseline = json.loads(backend.read_text(baseline_file))
+        baseline_runs = {run['scale_factor']: run for run in baseline['runs']}
+        for run in report['runs']:
+            previous = baseline_runs.get(run['scale_factor'])
+            if previous is None:
+                continue
+            for stage, timing in run['stages'].items():
+                before = previous['stages'].get(stage, {}).get('median_seconds')
+                if before:
+                    logger.info(
+                        f"SF {run['scale_factor']} {stage}: {before}s -> {timing['median_seconds']}s "
+                        f"({timing['median_seconds'] / before:.2f}x vs {baseline_commit})"
+                    )
+
+
+class PlanRegressionGuard:
+    """Compares the physical plan shape of each transform on fixture data against a checked-in baseline"""
+    
+    TRACKED_NODES = ("Exchange", "Sort", "BroadcastHashJoin", "SortMergeJoin", "ShuffledHashJoin", "Window")
+    FIXTURE_SCALE_FACTOR = 0.01
+    
+    def __init__(self, processor: 'ETLJobProcessor', baseline_path: str, fixture_path: str):
+        self.processor = processor
+        self.spark = processor.spark
+        self.baseline_path = baseline_path
+        self.fixture_path = fixture_path.rstrip('/')
+    
+    def _fixture_inputs(self) -> Dict[str, DataFrame]:
+        """Small deterministic inputs read back from parquet so scans and pushed filters match production"""
+        SyntheticDataGenerator(self.spark, self.FIXTURE_SCALE_FACTOR, data_date="2024-01-01").write(self.fixture_path)
+        return {
+            dataset: self.processor.read_data_with_optimization(
+                f"{self.fixture_path}/{dataset}/", "parquet", schema=SCHEMA_CONTRACTS[dataset]
+            )
+            for dataset in ("customers", "transactions")
+        }
+    
+    def formatted_plan(self, df: DataFrame) -> str:
+        return self.spark._jvm.PythonSQLUtils.explainString(df._jdf.queryExecution(), "formatted")
+    
+    def plan_shape(self, df: DataFrame) -> Dict[str, any]:
+        shape = {node: SparkOptimizer.count_plan_nodes(df, node) for node in self.TRACKED_NODES}
+        pushed = re.findall(r"PushedFilters: \[(.*?)\]\n", self.formatted_plan(df))
+        shape['pushed_filters'] = sorted(filters for filters in pushed if filters)
+        return shape
+    
+    def capture(self) -> Dict[str, Dict[str, any]]:
+        processor = self.processor
+        inputs = self._fixture_inputs()
+        customer_processed = processor.transform_customer_data(inputs['customers'])
+        transaction_processed = processor.transform_transaction_data(inputs['transactions'], customer_processed)
+        
+        transforms = {
+            'transform_customer_data': customer_processed,
+            'transform_transaction_data': transaction_processed,
+            'create_analytical_aggregates': processor.grain_aggregator.aggregate(transaction_processed)
+        }
+        shapes = {}
+        for name, df in transforms.items():
+            shapes[name] = self.plan_shape(df)
+            logger.info(f"Plan shape of {name}: {shapes[name]}")
+            logger.debug(f"Physical plan of {name}:\n{self.formatted_plan(df)}")
+        return shapes
+    
+    def check(self, update_baseline: bool = False) -> Dict[str, Dict[str, any]]:
+        """Fail when a plan shape differs from the baseline unless the baseline is being updated"""
+        shapes = self.capture()
+        backend = get_filesystem_backend(self.spark, self.baseline_path)
+        
+        if update_baseline:
+            backend.write_text(self.baseline_path, json.dumps({
+                'spark_version': self.spark.version,
+                'transforms': shapes
+            }, indent=2, sort_keys=True))
+            logger.info(f"Plan baseline updated at {self.baseline_path}")
+            return shapes
+        
+        if not backend.exists(self.baseline_path):
+            raise RuntimeError(f"No plan baseline at {self.baseline_path} - run with --update-plan-baseline to create it")
+        
+        baseline = json.loads(backend.read_text(self.baseline_path))
+        if baseline.get('spark_version') != self.spark.version:
+            logger.warning(f"Plan baseline was captured on Spark {baseline.get('spark_version')}, running {self.spark.version}")
+        
+        differences = []
+        for name, shape in shapes.items():
+            expected = baseline['transforms'].get(name)
+            if expected is None:
+                differences.append(f"{name}: not in baseline")
+                continue
+            for key in sorted(set(shape) | set(expected)):
+                if shape.get(key) != expected.get(key):
+                    differences.append(f"{name}.{key}: baseline {expected.get(key)}, now {shape.get(key)}")
+        
+        if differences:
+            raise RuntimeError("Physical plan shape changed without a baseline update:\n  " + "\n  ".join(differences))
+        logger.info("Physical plans match the baseline")
+        return shapes
+
+
+class DuckDBEngine:
+    """Single-node execution of the ETL transforms for small inputs - no JVM, same output schemas"""
+    
+    # The session must be UTC so timestamps, hours and dates match a UTC Spark session
+    CUSTOMER_SQL = """
+        WITH cleaned AS (
+            SELECT
+                customer_id,
+                upper(trim(first_name)) AS first_name,
+                upper(trim(last_name)) AS last_name,
+                lower(trim(email)) AS email,
+                regexp_replace(phone, '[^\\d]', '', 'g') AS phone_cleaned,
+                upper(trim(country)) AS country,
+                TRY_CAST(registration_date AS TIMESTAMP) AS registration_timestamp,
+                age,
+                coalesce(lifetime_value, 0.0) AS lifetime_value
+            FROM customers_raw
+            WHERE customer_id IS NOT NULL
+              AND contains(email, '@')
+              AND age BETWEEN 13 AND 120
+              AND registration_date IS NOT NULL
+        )
+        SELECT
+            *,
+            CAST(rank() OVER (PARTITION BY country ORDER BY registration_timestamp DESC NULLS LAST) AS INTEGER)
+                AS customer_rank_in_country,
+            CAST(date_diff('day', CAST(registration_timestamp AS DATE), current_date) AS INTEGER) AS days_since_registration,
+            CASE WHEN age < 25 THEN 'Young' WHEN age < 45 THEN 'Adult' WHEN age < 65 THEN 'Middle Age' ELSE 'Senior' END
+                AS age_group,
+            CASE WHEN lifetime_value > 10000 THEN 'High Value' WHEN lifetime_value > 1000 THEN 'Medium Value'
+                 ELSE 'Low Value' END AS ltv_category,
+            current_timestamp AS processed_timestamp,
+            'customer_etl_job' AS data_source,
+            $data_date AS processing_date
+        FROM cleaned
+    """
+    
+    TRANSACTION_SQL = """
+        WITH cleaned AS (
+            SELECT
+                transaction_id,
+                user_id AS customer_id,
+                CAST(amount AS DOUBLE) AS amount,
+                merchant_id,
+                epoch_ms("timestamp") AS transaction_timestamp,
+                upper(trim(status)) AS status,
+                lower(trim(payment_method)) AS payment_method,
+                location.country AS transaction_country
+            FROM transactions_raw
+        ),
+        filtered AS (
+            SELECT * FROM cleaned
+            WHERE transaction_id IS NOT NULL
+              AND customer_id IS NOT NULL
+              AND amount > 0
+              AND amount < 100000
+              AND transaction_timestamp IS NOT NULL
+              AND status IN ('COMPLETED', 'PENDING', 'FAILED', 'CANCELLED')
+        ),
+        enriched AS (
+            SELECT f.customer_id, f.* EXCLUDE (customer_id), c.* EXCLUDE (customer_id, processed_timestamp, data_source, processing_date)
+            FROM filtered f
+            JOIN customers_processed c ON f.customer_id = c.customer_id
+        ),
+        customer_stats AS (
+            SELECT customer_id, CAST(count(DISTINCT merchant_id) AS INTEGER) AS unique_merchants_count
+            FROM enriched GROUP BY customer_id
+        ),
+        featured AS (
+            SELECT
+                e.*,
+                CAST(row_number() OVER w AS INTEGER) AS transaction_sequence,
+                lag(transaction_timestamp) OVER w AS previous_transaction_timestamp,
+                count(*) OVER customer AS total_transactions,
+                sum(amount) OVER customer AS total_amount,
+                avg(amount) OVER customer AS avg_transaction_amount,
+                max(transaction_timestamp) OVER customer AS last_transaction_date,
+                min(transaction_timestamp) OVER customer AS first_transaction_date
+            FROM enriched e
+            WINDOW w AS (PARTITION BY customer_id ORDER BY transaction_timestamp, transaction_id),
+                   customer AS (PARTITION BY customer_id)
+        )
+        SELECT
+            f.* EXCLUDE (previous_transaction_timestamp),
+            s.unique_merchants_count,
+            CAST(date_diff('day', CAST(previous_transaction_timestamp AS DATE), CAST(transaction_timestamp AS DATE)) AS INTEGER)
+                AS days_since_last_transaction,
+            amount - avg_transaction_amount AS amount_deviation_from_avg,
+            CAST(date_diff('day', CAST(first_transaction_date AS DATE), CAST(last_transaction_date AS DATE)) + 1 AS INTEGER)
+                AS customer_lifetime_days,
+            CAST(total_transactions AS DOUBLE) / greatest(
+                date_diff('day', CAST(first_transaction_date AS DATE), CAST(last_transaction_date AS DATE)) + 1, 1
+            ) AS avg_transactions_per_day,
+            dayofweek(transaction_timestamp) IN (0, 6) AS is_weekend,
+            CAST(hour(transaction_timestamp) AS INTEGER) AS transaction_hour,
+            amount > 1000 AS is_high_value,
+            current_timestamp AS processed_timestamp,
+            'transaction_etl_job' AS data_source,
+            $data_date AS processing_date
+        FROM featured f
+        JOIN customer_stats s USING (customer_id)
+    """
+    
+    # Same grouping-sets pass and sketches as GrainAggregator, in duckdb syntax
+    GROUPING_SQL = """
+        WITH hashed AS (
+            SELECT
+                strftime(transaction_timestamp, '%Y-%m-%d') AS transaction_date,
+                transaction_country,
+                payment_method,
+                amount,
+                status,
+                ('0x' || substr(md5(customer_id), 1, 15))::BIGINT AS customer_hash,
+                ('0x' || substr(md5(merchant_id), 1, 15))::BIGINT AS merchant_hash
+            FROM transactions_processed
+        ),
+        coded AS (
+            SELECT *, {customer_code} AS customer_code, {merchant_code} AS merchant_code
+            FROM hashed
+        )
+        SELECT
+            {dimension_columns}{grain_id} AS grain_id,
+            count(*) AS transaction_count,
+            sum(amount) AS total_amount,
+            max(amount) AS max_amount,
+            min(amount) AS min_amount,
+            CAST(sum(CASE WHEN status = 'COMPLETED' THEN 1 ELSE 0 END) AS BIGINT) AS successful_transactions,
+            CAST(sum(CASE WHEN status = 'FAILED' THEN 1 ELSE 0 END) AS BIGINT) AS failed_transactions,
+            list_sort(coalesce(list(DISTINCT customer_code) FILTER (WHERE customer_code IS NOT NULL), [])) AS customer_codes,
+            list_sort(coalesce(list(DISTINCT merchant_code) FILTER (WHERE merchant_code IS NOT NULL), [])) AS merchant_codes
+        FROM coded
+        {group_by}
+    """
+    
+    GRAIN_SQL = """
+        WITH registers AS (
+            SELECT
+                *,
+                list_filter(customer_codes, (code, i) -> i = len(customer_codes) OR customer_codes[i + 1] // 64 != code // 64)
+                    AS customer_sketch,
+                list_filter(merchant_codes, (code, i) -> i = len(merchant_codes) OR merchant_codes[i + 1] // 64 != code // 64)
+                    AS merchant_sketch
+            FROM aggregate_grains
+            WHERE grain_id = {grain_id}
+        ),
+        estimated AS (
+            SELECT *, {customer_estimate} AS unique_customers, {merchant_estimate} AS unique_merchants
+            FROM registers
         )
+        SELECT
+            {dimension_columns}
+            transaction_count,
+            total_amount,
+            total_amount / transaction_count AS avg_amount,
+            max_amount,
+            min_amount,
+            unique_customers,
+            unique_merchants,
+            successful_transactions,
+            failed_transactions,
+            CAST(successful_transactions AS DOUBLE) / transaction_count AS success_rate,
+            total_amount / nullif(unique_customers, 0) AS avg_amount_per_customer,
+            customer_sketch,
+            merchant_sketch,
+            current_timestamp AS created_timestamp,
+            'analytical_aggregates' AS data_source,
+            $data_date AS processing_date
+        FROM estimated
+    """
+    
+    # Spark ordering of the customer columns added by the window stage, see transform_transaction_data
+    TRANSACTION_WINDOW_COLUMNS = [
+        "transaction_sequence", "total_transactions", "total_amount", "avg_transaction_amount",
+        "last_transaction_date", "first_transaction_date", "unique_merchants_count",
+        "days_since_last_transaction", "amount_deviation_from_avg", "customer_lifetime_days",
+        "avg_transactions_per_day", "is_weekend", "transaction_hour", "is_high_value",
+        "processed_timestamp", "data_source", "processing_date"
+    ]
+    
+    def __init__(self, config: SparkJobConfig):
+        if duckdb is None:
+            raise RuntimeError("The duckdb engine requires the duckdb Python package")
+        self.config = config
+        self.connection = duckdb.connect()
+        self.connection.execute("SET TimeZone = 'UTC'")
+        self.steps: Dict[str, Dict[str, any]] = {}
+    
+    @staticmethod
+    def filesystem(path: str):
+        """pyarrow filesystem and in-filesystem path of a local path or object store URI"""
+        if urlparse(path).scheme in ("", "file"):
+            return pafs.LocalFileSystem(), os.path.abspath(urlparse(path).path)
+        # Hadoop's s3a:// and s3n:// name the same buckets pyarrow reaches through s3://
+        return pafs.FileSystem.from_uri(re.sub(r"^s3[an]://", "s3://", path))
+    
+    @classmethod
+    def list_inputs(cls, input_path: str, dataset: str):
+        """Filesystem and visible parquet files (pyarrow FileInfo) of a raw input dataset"""
+        fs, root = cls.filesystem(f"{input_path.rstrip('/')}/{dataset}")
+        root = root.rstrip('/')
+        files = [
+            info for info in fs.get_file_info(pafs.FileSelector(root, recursive=True, allow_not_found=True))
+            if info.is_file and info.path.endswith(".parquet") and not _is_hidden_path(info.path[len(root):].lstrip('/'))
+        ]
+        return fs, sorted(files, key=lambda info: info.path)
+    
+    @classmethod
+    def input_bytes(cls, input_path: str) -> Optional[int]:
+        """Total size of the raw inputs from a listing of their filesystem, None when it cannot be listed"""
+        if pafs is None:
+            return None
+        try:
+            return sum(info.size for dataset in SCHEMA_CONTRACTS for info in cls.list_inputs(input_path, dataset)[1])
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Could not size the inputs at {input_path}: {str(e)}")
+            return None
+    
+    @classmethod
+    def select_engine(cls, config: SparkJobConfig) -> str:
+        """duckdb for small batch runs the fast path supports, otherwise spark
         
-        # Add processing metadata
-        processed_transactions = final_transactions.withColumn(
-            "processed_timestamp", current_timestamp()
-        ).withColumn(
-            "data_source", lit("transaction_etl_job")
-        ).withColumn(
-            "processing_date", lit(self.config.data_date)
+        The fast path runs exact quality checks, the transforms and the writes, and reports
+        per-step wall times and output metrics - but no sketch sidecars, schema drift checks,
+        executor stage metrics or materialization. auto therefore stays on spark whenever a
+        flag asks for something duckdb would silently drop.
+        """
+        if config.engine != "auto":
+            return config.engine
+        
+        unsupported = (
+            config.mode != "batch" or config.incremental or config.incremental_aggregates or config.skew_join
+            or config.write_mode not in ("auto", "overwrite", "append") or config.bucket_columns
+            or config.quality_mode != "exact" or config.materialization != "none" or config.bloom_prefilter
+            or config.coalesce_partitions or config.max_records_per_file
+            or config.target_file_size_bytes != DEFAULT_TARGET_FILE_SIZE_MB * 1024 * 1024
         )
+        if unsupported or duckdb is None or write_deltalake is None:
+            return "spark"
         
-        logger.info(f"Transaction data transformation completed. Final count: {processed_transactions.count()}")
-        return processed_transactions
+        input_bytes = cls.input_bytes(config.input_path)
+        if input_bytes is None or input_bytes > config.duckdb_max_input_bytes:
+            return "spark"
+        logger.info(f"Input is {input_bytes:,} bytes - using the duckdb engine")
+        return "duckdb"
+    
+    @contextmanager
+    def step(self, name: str):
+        """Wall time of one pipeline step, reported like StageMetricsCollector's steps"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.steps[name] = {'wall_time_seconds': round(time.monotonic() - start, 3)}
     
-    def create_analytical_aggregates(self, transaction_df: DataFrame) -> DataFrame:
-        """Create analytical aggregates for reporting"""
+    def _register_input(self, dataset: str) -> None:
+        """Expose a raw input as a view with the contract columns and types"""
+        fs, files = self.list_inputs(self.config.input_path, dataset)
+        if not files:
+            raise ValueError(f"No parquet input files for {dataset}")
         
-        logger.info("Creating analytical aggregates")
+        # Columns are matched by name across the footers (as mergeSchema does); missing ones read as nulls
+        paths = [info.path for info in files]
+        schema = pa.unify_schemas([pq.read_schema(path, filesystem=fs) for path in paths], promote_options="permissive")
+        self.connection.register(f"{dataset}_files", pads.dataset(paths, schema=schema, filesystem=fs, format="parquet"))
         
-        # Daily aggregates by country and payment method
-        daily_aggregates = transaction_df.groupBy(
-            date_format("transaction_timestamp", "yyyy-MM-dd").alias("transaction_date"),
-            "transaction_country",
-            "payment_method"
-        ).agg(
-            spark_count("*").alias("transaction_count"),
-            spark_sum("amount").alias("total_amount"),
-            avg("amount").alias("avg_amount"),
-            spark_max("amount").alias("max_amount"),
-            spark_min("amount").alias("min_amount"),
-            expr("count(distinct customer_id)").alias("unique_customers"),
-            expr("count(distinct merchant_id)").alias("unique_merchants"),
-            spark_sum(when(col("status") == "COMPLETED", 1).otherwise(0)).alias("successful_transactions"),
-            spark_sum(when(col("status") == "FAILED", 1).otherwise(0)).alias("failed_transactions")
-        ).withColumn(
-            "success_rate", 
-            expr("successful_transactions / transaction_count")
-        ).withColumn(
-            "avg_amount_per_customer",
-            expr("total_amount / unique_customers")
+        columns = ", ".join(
+            f'CAST("{field.name}" AS {self._duckdb_type(field.dataType)}) AS "{field.name}"'
+            for field in SCHEMA_CONTRACTS[dataset].fields
         )
+        self.connection.execute(f"CREATE OR REPLACE VIEW {dataset}_raw AS SELECT {columns} FROM {dataset}_files")
+    
+    def register_inputs(self) -> None:
+        self._register_input("customers")
+        self._register_input("transactions")
+    
+    def check_quality(self, dataset: str) -> Dict[str, any]:
+        """Profile of a registered raw input in the shape of DataQualityValidator.check_data_quality
         
-        # Add processing metadata
-        final_aggregates = daily_aggregates.withColumn(
-            "created_timestamp", current_timestamp()
-        ).withColumn(
-            "data_source", lit("analytical_aggregates")
-        ).withColumn(
-            "processing_date", lit(self.config.data_date)
-        )
+        Duplicates are always exact - a distinct count over a small input is cheap here.
+        """
+        fields = SCHEMA_CONTRACTS[dataset].fields
+        numeric_columns = [f.name for f in fields if isinstance(f.dataType, NumericType)]
         
-        logger.info(f"Analytical aggregates created. Final count: {final_aggregates.count()}")
-        return final_aggregates
+        expressions = ["count(*)"]
+        for field in fields:
+            null_condition = f'"{field.name}" IS NULL'
+            if isinstance(field.dataType, (DoubleType, FloatType)):
+                null_condition += f' OR isnan("{field.name}")'
+            expressions.append(f"count(*) FILTER (WHERE {null_condition})")
+        for column in numeric_columns:
+            expressions += [f'min("{column}")', f'max("{column}")', f'avg("{column}")']
+        profile = self.connection.execute(f"SELECT {', '.join(expressions)} FROM {dataset}_raw").fetchone()
+        unique_rows = self.connection.execute(f"SELECT count(*) FROM (SELECT DISTINCT * FROM {dataset}_raw)").fetchone()[0]
+        
+        total_rows = profile[0]
+        quality_report = {
+            'total_rows': total_rows,
+            'null_counts': {},
+            'duplicate_count': total_rows - unique_rows,
+            'duplicate_count_estimated': False,
+            'duplicate_error_bound': 0,
+            'column_stats': {}
+        }
+        for idx, field in enumerate(fields):
+            null_count = profile[1 + idx]
+            quality_report['null_counts'][field.name] = {
+                'count': null_count,
+                'percentage': (null_count / total_rows * 100) if total_rows > 0 else 0
+            }
+        offset = 1 + len(fields)
+        for idx, column in enumerate(numeric_columns):
+            low, high, mean = profile[offset + 3 * idx:offset + 3 * idx + 3]
+            quality_report['column_stats'][column] = {'min': low, 'max': high, 'avg': mean}
+        return quality_report
     
-    def run_etl_pipeline(self) -> None:
-        """Run the complete ETL pipeline"""
+    @classmethod
+    def _duckdb_type(cls, data_type) -> str:
+        if isinstance(data_type, StructType):
+            fields = ", ".join(f'"{f.name}" {cls._duckdb_type(f.dataType)}' for f in data_type.fields)
+            return f"STRUCT({fields})"
+        return {
+            StringType: "VARCHAR", IntegerType: "INTEGER", LongType: "BIGINT", DoubleType: "DOUBLE"
+        }[type(data_type)]
+    
+    def _query(self, sql: str):
+        """Run a transform into an Arrow table with zone-aware timestamps, as Spark writes them"""
+        relation = self.connection.execute(sql, {'data_date': self.config.data_date})
+        table = relation.fetch_arrow_table()
+        for index, field in enumerate(table.schema):
+            if pa.types.is_timestamp(field.type) and field.type.tz is None:
+                table = table.set_column(index, field.name, table.column(index).cast(pa.timestamp("us", tz="UTC")))
+        return table
+    
+    def transform(self) -> Dict[str, any]:
+        """The processed outputs and aggregate grain tables of the registered inputs as Arrow tables"""
+        with self.step("transform_customers"):
+            customers = self._query(self.CUSTOMER_SQL)
+        self.connection.register("customers_processed", customers)
         
-        logger.info(f"Starting ETL pipeline: {self.config.job_name}")
-        logger.info(f"Environment: {self.config.environment}")
-        logger.info(f"Processing date: {self.config.data_date}")
+        with self.step("transform_transactions"):
+            transactions = self._query(self.TRANSACTION_SQL)
+        leading = [name for name in transactions.column_names if name not in self.TRANSACTION_WINDOW_COLUMNS]
+        transactions = transactions.select(leading + self.TRANSACTION_WINDOW_COLUMNS)
+        self.connection.register("transactions_processed", transactions)
         
-        try:
-            # Set checkpoint directory if provided
-            if self.config.checkpoint_path:
-                self.spark.sparkContext.setCheckpointDir(self.config.checkpoint_path)
-            
-            # Read raw data
-            logger.info("Reading raw customer data")
-            customer_raw = self.read_data_with_optimization(
-                f"{self.config.input_path}/customers/", "parquet"
-            )
-            
-            logger.info("Reading raw transaction data")  
-            transaction_raw = self.read_data_with_optimization(
-                f"{self.config.input_path}/transactions/", "parquet"
-            )
-            
-            # Data quality validation
-            logger.info("Running data quality checks")
-            customer_quality = self.validator.check_data_quality(customer_raw)
-            transaction_quality = self.validator.check_data_quality(transaction_raw)
-            
-            logger.info(f"Customer data quality: {customer_quality['total_rows']} rows, "
-                       f"{customer_quality['duplicate_count']} duplicates")
-            logger.info(f"Transaction data quality: {transaction_quality['total_rows']} rows, "
-                       f"{transaction_quality['duplicate_count']} duplicates")
-            
-            # Transform data
-            logger.info("Transforming customer data")
-            customer_processed = self.transform_customer_data(customer_raw)
-            
-            # Checkpoint intermediate results for fault tolerance
-            if self.config.checkpoint_path:
-                customer_processed.checkpoint()
-            
-            logger.info("Transforming transaction data")
-            transaction_processed = self.transform_transaction_data(transaction_raw, customer_processed)
-            
-            # Create analytical aggregates
-            logger.info("Creating analytical aggregates")
-            analytical_aggregates = self.create_analytical_aggregates(transaction_processed)
-            
-            # Write processed data
-            logger.info("Writing processed customer data")
-            self.write_data_with_optimization(
-                customer_processed,
-                f"{self.config.output_path}/processed_customers/",
-                format="delta",
-                mode="overwrite"
-            )
-            
-            logger.info("Writing processed transaction data")
-            self.write_data_with_optimization(
-                transaction_processed,
-                f"{self.config.output_path}/processed_transactions/",
-                format="delta", 
-                mode="overwrite"
-            )
-            
-            logger.info("Writing analytical aggregates")
-            self.write_data_with_optimization(
-                analytical_aggregates,
-                f"{self.config.output_path}/analytical_aggregates/",
-                format="delta",
-                mode="overwrite"
+        with self.step("aggregate_grains"):
+            aggregates = self.aggregate_grains()
+        return {
+            'processed_customers': customers,
+            'processed_transactions': transactions,
+            **aggregates
+        }
+    
+    def aggregate_grains(self) -> Dict[str, any]:
+        """One Arrow table per declared grain from one grouping-sets pass over transactions_processed"""
+        grains = GrainAggregator({name: AGGREGATE_GRAINS[name] for name in self.config.aggregate_grains})
+        if grains.dimensions:
+            group_by = f"GROUP BY GROUPING SETS ({', '.join(grains.grouping_sets())})"
+            grain_id = f"grouping({', '.join(grains.dimensions)})"
+        else:
+            group_by, grain_id = "", "0"
+        grouped = self.connection.execute(self.GROUPING_SQL.format(
+            customer_code=GrainAggregator.register_code("customer_hash", "({} >> {})"),
+            merchant_code=GrainAggregator.register_code("merchant_hash", "({} >> {})"),
+            dimension_columns="".join(f"{d}, " for d in grains.dimensions),
+            grain_id=grain_id,
+            group_by=group_by
+        )).fetch_arrow_table()
+        self.connection.register("aggregate_grains", grouped)
+        
+        def estimate(name: str) -> str:
+            return GrainAggregator.estimate(
+                f"len({name}_sketch)",
+                f"coalesce(list_sum(list_transform({name}_sketch, code -> pow(2, -(code % 64)))), 0)"
             )
-            
-            # Final data quality report
-            final_customer_count = customer_processed.count()
-            final_transaction_count = transaction_processed.count()
-            final_aggregate_count = analytical_aggregates.count()
-            
-            logger.info("="*50)
-            logger.info("ETL PIPELINE COMPLETED SUCCESSFULLY")
-            logger.info("="*50)
-            logger.info(f"Processed customers: {final_customer_count:,}")
-            logger.info(f"Processed transactions: {final_transaction_count:,}")
-            logger.info(f"Analytical aggregates: {final_aggregate_count:,}")
-            logger.info(f"Total processing time: {datetime.now()}")
-            logger.info("="*50)
-            
+        
+        return {
+            name: self._query(self.GRAIN_SQL.format(
+                grain_id=grains.grain_id(dimensions),
+                customer_estimate=estimate("customer"),
+                merchant_estimate=estimate("merchant"),
+                dimension_columns="".join(f"{d}, " for d in dimensions)
+            ))
+            for name, dimensions in grains.grains.items()
+        }
+    
+    def run(self) -> Dict[str, Dict[str, any]]:
+        """Quality-check, transform and write the Delta outputs with delta-rs"""
+        pipeline_start = datetime.now()
+        logger.info(f"Starting ETL pipeline on the duckdb engine: {self.config.job_name}")
+        mode = "append" if self.config.write_mode == "append" else "overwrite"
+        
+        with self.step("read_inputs"):
+            self.register_inputs()
+        quality = {}
+        for dataset in ("customers", "transactions"):
+            with self.step(f"quality_{dataset}"):
+                quality[dataset] = self.check_quality(dataset)
+            logger.info(f"{dataset.capitalize()} data quality: {quality[dataset]['total_rows']} rows, "
+                        f"{quality[dataset]['duplicate_count']} duplicates")
+        
+        outputs = {}
+        for name, table in self.transform().items():
+            path = f"{self.config.output_path}/{name}/"
+            with self.step(f"write_{name}"):
+                write_deltalake(
+                    path, table, mode=mode,
+                    partition_by=self.config.partition_columns or None,
+                    schema_mode="overwrite" if mode == "overwrite" else None
+                )
+            outputs[name] = {'rows': table.num_rows, 'bytes': table.nbytes, 'source': 'arrow_table'}
+            logger.info(f"Wrote {name}: {table.num_rows:,} rows, {table.nbytes:,} bytes (in memory) to {path}")
+        
+        logger.info(f"Total processing time: {datetime.now() - pipeline_start}")
+        try:
+            self.write_report({'data_date': self.config.data_date, 'outputs': outputs, 'quality': quality})
         except Exception as e:
-            logger.error(f"ETL pipeline failed: {str(e)}")
-            raise
+            logger.warning(f"Could not write stage metrics report: {str(e)}")
+        return outputs
+    
+    def write_report(self, extra: Dict[str, any]) -> Dict[str, any]:
+        """Write the per-step metrics next to the outputs, in StageMetricsCollector's report layout"""
+        run_id = f"duckdb-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        report = {
+            'job_name': self.config.job_name,
+            'application_id': run_id,
+            'engine': 'duckdb',
+            'generated_at': datetime.now().isoformat(),
+            'steps': self.steps,
+            **extra
+        }
         
-        finally:
-            # Cleanup cached data
-            self.spark.catalog.clearCache()
-            logger.info("Cleaned up cached data")
+        fs, report_dir = self.filesystem(self.config.metrics_path)
+        fs.create_dir(report_dir, recursive=True)
+        report_file = f"{report_dir.rstrip('/')}/{self.config.job_name}_{run_id}.json"
+        with fs.open_output_stream(report_file) as stream:
+            stream.write(json.dumps(report, indent=2, default=str).encode("utf-8"))
+        logger.info(f"Stage metrics report written to {report_file}")
+        for name, entry in self.steps.items():
+            logger.info(f"Step {name}: {entry['wall_time_seconds']}s wall")
+        return report
 
 
-def create_spark_session(config: SparkJobConfig) -> SparkSession:
-    """Create optimized Spark session"""
+class EngineParityCheck:
+    """Runs the Spark and duckdb quality checks and transforms on the same inputs and compares them
+    
+    The distinct-count estimates of the aggregates are also checked against exact counts, so the
+    two engines cannot agree on a sketch that is wrong.
+    """
+    
+    # Keys that order each output deterministically for comparison
+    SORT_KEYS = OUTPUT_MERGE_KEYS
+    VOLATILE_COLUMNS = ("processed_timestamp", "created_timestamp")
+    SKETCH_COLUMNS = ("customer_sketch", "merchant_sketch")
+    
+    # Sketch estimates and the column they count; four standard errors of the sketch precision fail parity
+    ESTIMATE_COLUMNS = {"unique_customers": "customer_id", "unique_merchants": "merchant_id"}
+    ESTIMATE_TOLERANCE = 4 * 1.04 / math.sqrt(GrainAggregator.REGISTERS)
+    
+    def __init__(self, processor: 'ETLJobProcessor'):
+        self.processor = processor
+        self.spark = processor.spark
+    
+    def spark_outputs(self) -> Dict[str, DataFrame]:
+        processor = self.processor
+        customers = processor.transform_customer_data(processor.read_input("customers"))
+        transactions = processor.transform_transaction_data(processor.read_input("transactions"), customers)
+        return {
+            'processed_customers': customers,
+            'processed_transactions': transactions,
+            **processor.create_analytical_aggregates(transactions)
+        }
+    
+    def quality_problems(self, engine: DuckDBEngine, dataset: str, rtol: float) -> List[str]:
+        """Differences between the exact Spark profile of a raw input and the duckdb one"""
+        expected = self.processor.validator.check_data_quality(self.processor.read_input(dataset), exact_duplicates=True)
+        actual = engine.check_quality(dataset)
+        
+        problems = []
+        for key in ('total_rows', 'duplicate_count'):
+            if expected[key] != actual[key]:
+                problems.append(f"{key}: spark {expected[key]} vs duckdb {actual[key]}")
+        for column, nulls in expected['null_counts'].items():
+            if nulls['count'] != actual['null_counts'][column]['count']:
+                problems.append(f"{column} nulls: spark {nulls['count']} vs duckdb {actual['null_counts'][column]['count']}")
+        for column, stats in expected['column_stats'].items():
+            for stat, value in stats.items():
+                other = actual['column_stats'][column][stat]
+                if (value is None) != (other is None) or (value is not None and not math.isclose(value, other, rel_tol=rtol)):
+                    problems.append(f"{column} {stat}: spark {value} vs duckdb {other}")
+        return problems
     
-    app_name = f"{config.job_name}_{config.environment}_{config.data_date}"
+    def exact_distincts(self, transactions: DataFrame) -> Dict[str, any]:
+        """Exact distinct customers and merchants of every grain (pandas), to check the sketches against"""
+        dated = transactions.withColumn("transaction_date", date_format("transaction_timestamp", "yyyy-MM-dd"))
+        counts = [expr(f"count(DISTINCT {column})").alias(estimate) for estimate, column in self.ESTIMATE_COLUMNS.items()]
+        return {
+            name: dated.groupBy(*dimensions).agg(*counts).toPandas()
+            for name, dimensions in self.processor.grain_aggregator.grains.items()
+        }
+    
+    def estimate_problems(self, engine: str, output, exact, dimensions: List[str]) -> List[str]:
+        """Sketch estimates of one engine's grain table (pandas) further from the exact counts than the tolerance"""
+        merged = output.assign(__grain=0).merge(exact.assign(__grain=0), on=dimensions + ["__grain"], suffixes=("", "_exact"))
+        problems = []
+        for column in self.ESTIMATE_COLUMNS:
+            truth = merged[f"{column}_exact"]
+            error = (merged[column] - truth).abs()
+            outside = error > (truth * self.ESTIMATE_TOLERANCE).clip(lower=1)
+            worst = float((error / truth.clip(lower=1)).max()) if len(merged) else 0.0
+            logger.info(f"{engine} {column} estimates: largest relative error {worst:.2%} over {len(merged)} groups")
+            if outside.any():
+                problems.append(f"{engine} {column} outside {self.ESTIMATE_TOLERANCE:.1%} of the exact count "
+                                f"in {int(outside.sum())} group(s), largest error {worst:.2%}")
+        return problems
+    
+    def run(self, rtol: float = 1e-9) -> Dict[str, List[str]]:
+        """Differences per output and raw input profile; raises when any differs"""
+        # Both engines must interpret naive dates and hours in the same zone
+        self.spark.conf.set("spark.sql.session.timeZone", "UTC")
+        engine = DuckDBEngine(self.processor.config)
+        engine.register_inputs()
+        duckdb_tables = engine.transform()
+        
+        differences = {}
+        for dataset in ("customers", "transactions"):
+            differences[f"quality_{dataset}"] = self.quality_problems(engine, dataset, rtol)
+            logger.info(f"Quality parity for {dataset}: {differences[f'quality_{dataset}'] or 'OK'}")
+        
+        spark_outputs = self.spark_outputs()
+        exact = self.exact_distincts(spark_outputs['processed_transactions'])
+        for name, spark_df in spark_outputs.items():
+            problems = []
+            duckdb_table = duckdb_tables[name]
+            if spark_df.columns != duckdb_table.column_names:
+                problems.append(f"columns differ: spark {spark_df.columns} vs duckdb {duckdb_table.column_names}")
+            else:
+                keys = self.SORT_KEYS[name]
+                compared = [c for c in spark_df.columns if c not in self.VOLATILE_COLUMNS]
+                expected = spark_df.select(*compared).toPandas().sort_values(keys).reset_index(drop=True)
+                actual = duckdb_table.select(compared).to_pandas().sort_values(keys).reset_index(drop=True)
+                # toPandas yields naive timestamps in the (UTC) session zone
+                for column in actual.select_dtypes(include=["datetimetz"]).columns:
+                    actual[column] = actual[column].dt.tz_convert("UTC").dt.tz_localize(None)
+                # Sketch arrays come back as lists or numpy arrays depending on the engine
+                for column in [c for c in compared if c in self.SKETCH_COLUMNS]:
+                    expected[column] = expected[column].map(lambda codes: tuple(int(c) for c in codes))
+                    actual[column] = actual[column].map(lambda codes: tuple(int(c) for c in codes))
+                try:
+                    pd_testing.assert_frame_equal(expected, actual, check_dtype=False, rtol=rtol)
+                except AssertionError as e:
+                    problems.append(str(e))
+                if name in exact:
+                    dimensions = self.processor.grain_aggregator.grains[name]
+                    problems += self.estimate_problems("spark", expected, exact[name], dimensions)
+                    problems += self.estimate_problems("duckdb", actual, exact[name], dimensions)
+            
+            differences[name] = problems
+            logger.info(f"Parity for {name}: {'OK' if not problems else problems}")
+        
+        if any(differences.values()):
+            raise RuntimeError(f"Spark and duckdb outputs differ: {differences}")
+        return differences
+
+
+class SparkSessionFactory:
+    """Builds the session with static configs at builder time, Delta jars from a local cache, and startup timing"""
+    
+    DELTA_PACKAGES = ["io.delta:delta-core_2.12:2.4.0", "io.delta:delta-storage:2.4.0"]
+    
+    # Read once when the SparkContext starts - setting them on a running session has no effect.
+    # Cluster sizing (executor memory, dynamic allocation bounds) is left to spark-submit.
+    STATIC_CONFIGS = {
+        "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+        # Concurrent writes and reads get their own pools instead of queueing FIFO
+        "spark.scheduler.mode": "FAIR",
+        "spark.dynamicAllocation.enabled": "true",
+        "spark.sql.extensions": "io.delta.sql.DeltaSparkSessionExtension",
+        "spark.sql.catalog.spark_catalog": "org.apache.spark.sql.delta.catalog.DeltaCatalog",
+    }
     
-    builder = SparkSession.builder \
-        .appName(app_name) \
-        .config("spark.sql.adaptive.enabled", "true") \
-        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
-        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
-        .config("spark.serializer", "org.apache.spark.serializer.KryoSerializer") \
-        .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
-        .config("spark.dynamicAllocation.enabled", "true")
+    # spark-submit options that stand for a conf key (everything else arrives as --conf key=value)
+    SUBMIT_OPTIONS = {
+        "--master": "spark.master", "--deploy-mode": "spark.submit.deployMode", "--name": "spark.app.name",
+        "--jars": "spark.jars", "--packages": "spark.jars.packages", "--repositories": "spark.jars.repositories",
+        "--driver-memory": "spark.driver.memory", "--driver-cores": "spark.driver.cores",
+        "--executor-memory": "spark.executor.memory", "--executor-cores": "spark.executor.cores",
+        "--num-executors": "spark.executor.instances", "--queue": "spark.yarn.queue",
+    }
+    
+    def __init__(self, config: SparkJobConfig):
+        self.config = config
+        self.startup: Dict[str, any] = {}
+    
+    @classmethod
+    def submitted_keys(cls) -> set:
+        """Conf keys set by the launcher, read without starting a JVM of our own
+        
+        Under spark-submit the driver JVM already runs with the submitted conf. Under a plain
+        python launch the JVM is started by the builder, so the builder's settings (Delta jars
+        included) must reach launch_gateway - only PYSPARK_SUBMIT_ARGS and spark-defaults.conf
+        can hold settings then.
+        """
+        if os.environ.get("PYSPARK_GATEWAY_PORT"):
+            SparkContext._ensure_initialized()
+            return {key for key, _ in SparkConf().getAll()}
+        
+        keys = set()
+        args = shlex.split(os.environ.get("PYSPARK_SUBMIT_ARGS", ""))
+        for option, value in zip(args, args[1:]):
+            if option in ("--conf", "-c") and "=" in value:
+                keys.add(value.split("=", 1)[0])
+            elif option in cls.SUBMIT_OPTIONS:
+                keys.add(cls.SUBMIT_OPTIONS[option])
+        keys |= {arg.split("=", 2)[1] for arg in args if arg.startswith("--conf=") and arg.count("=") >= 2}
+        
+        conf_dir = os.environ.get("SPARK_CONF_DIR") or os.path.join(os.environ.get("SPARK_HOME", ""), "conf")
+        defaults = os.path.join(conf_dir, "spark-defaults.conf")
+        if os.path.isfile(defaults):
+            with open(defaults, "r", encoding="utf-8") as handle:
+                for line in handle:
+                    line = line.strip()
+                    if line.startswith("spark."):
+                        keys.add(re.split(r"[\s=]", line, 1)[0])
+        return keys
     
-    # Add Delta Lake support
-    builder = builder \
-        .config("spark.jars.packages", "io.delta:delta-core_2.12:2.4.0") \
-        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
-        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog")
+    def _cached_jars(self) -> Optional[List[str]]:
+        """Delta jars from a previous ivy resolution into the cache directory, if all are present"""
+        jars = []
+        for package in self.DELTA_PACKAGES:
+            organisation, artifact, version = package.split(":")
+            jar = os.path.join(self.config.jar_cache_dir, "jars", f"{organisation}_{artifact}-{version}.jar")
+            if not os.path.isfile(jar):
+                return None
+            jars.append(jar)
+        return jars
     
-    spark = builder.getOrCreate()
+    def _dependency_configs(self) -> Dict[str, str]:
+        cached_jars = self._cached_jars()
+        if cached_jars:
+            self.startup['jar_source'] = 'local_cache'
+            return {"spark.jars": ",".join(cached_jars)}
+        
+        # First launch resolves through ivy into the cache directory so later launches find the jars
+        self.startup['jar_source'] = 'ivy_resolution'
+        return {"spark.jars.packages": ",".join(self.DELTA_PACKAGES), "spark.jars.ivy": self.config.jar_cache_dir}
     
-    # Set log level
-    spark.sparkContext.setLogLevel("WARN")
+    def create(self) -> SparkSession:
+        start = time.monotonic()
+        app_name = f"{self.config.job_name}_{self.config.environment}_{self.config.data_date}"
+        
+        # Settings given to spark-submit win over the defaults here
+        submitted = self.submitted_keys()
+        builder = SparkSession.builder.appName(app_name)
+        for key, value in {**self.STATIC_CONFIGS, **self._dependency_configs()}.items():
+            if key not in submitted:
+                builder = builder.config(key, value)
+        
+        if SparkSession.getActiveSession() is not None:
+            logger.warning("A Spark session is already active - static configs will not be applied")
+        
+        spark = builder.getOrCreate()
+        spark.sparkContext.setLogLevel("WARN")
+        self.startup['session_seconds'] = round(time.monotonic() - start, 3)
+        
+        self.apply_runtime_configs(spark, self.config)
+        
+        # Executors (or local threads) are only proven usable once a job has run
+        spark.sparkContext.parallelize([0], 1).count()
+        self.startup['time_to_first_job_seconds'] = round(time.monotonic() - start, 3)
+        logger.info(f"Spark startup: {self.startup}")
+        return spark
     
-    return spark
+    @staticmethod
+    def apply_runtime_configs(spark: SparkSession, config: SparkJobConfig) -> None:
+        """SQL confs that may change on a running session"""
+        spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+        spark.conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", "10000")
+        
+        # Adaptive Query Execution
+        spark.conf.set("spark.sql.adaptive.enabled", "true")
+        spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+        spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+        if config.enable_adaptive_query:
+            spark.conf.set("spark.sql.adaptive.localShuffleReader.enabled", "true")
+            spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128MB")
+        
+        # File optimization
+        if config.max_records_per_file:
+            spark.conf.set("spark.sql.files.maxRecordsPerFile", str(config.max_records_per_file))
+
+
+def create_spark_session(config: SparkJobConfig) -> SparkSession:
+    """Create optimized Spark session"""
+    return SparkSessionFactory(config).create()
 
 
 def parse_arguments():
@@ -608,11 +4387,100 @@ def parse_arguments():
     parser.add_argument("--bucket-columns", help="Comma-separated bucket columns")
     parser.add_argument("--num-buckets", type=int, default=0, help="Number of buckets")
     parser.add_argument("--cache-level", default="MEMORY_AND_DISK", 
-                       choices=["NONE", "MEMORY_ONLY", "MEMORY_AND_DISK", "DISK_ONLY"],
+                       choices=["NONE", "MEMORY_ONLY", "MEMORY_AND_DISK", "MEMORY_AND_DISK_DESER", "DISK_ONLY"],
                        help="Cache storage level")
     parser.add_argument("--enable-adaptive-query", action="store_true", help="Enable adaptive query execution")
     parser.add_argument("--max-records-per-file", type=int, help="Maximum records per output file")
     parser.add_argument("--coalesce-partitions", type=int, default=0, help="Number of partitions to coalesce")
+    parser.add_argument("--materialization", default="auto",
+                       choices=["auto", "none", "local_checkpoint", "checkpoint", "delta"],
+                       help="Lineage truncation at stage boundaries (auto: checkpoint when --checkpoint-path is set)")
+    parser.add_argument("--jar-cache-dir", help="Local Delta jar cache (default: $SPARK_JAR_CACHE or ~/.cache/spark-jars)")
+    parser.add_argument("--mode", default="batch",
+                       choices=["batch", "streaming", "generate", "benchmark", "plan-check", "parity"],
+                       help="batch: run the pipeline; streaming: transaction features as a streaming query; "
+                            "generate: write synthetic inputs; benchmark: time the transforms; "
+                            "plan-check: compare transform plans with the baseline; parity: compare spark and duckdb outputs")
+    parser.add_argument("--streaming-trigger", default="availableNow", choices=["availableNow", "processingTime"],
+                       help="availableNow: process pending files and stop; processingTime: run every --streaming-interval "
+                            "(continuous triggers support neither stateful operators nor watermarks)")
+    parser.add_argument("--streaming-interval", default="1 minute", help="Micro-batch interval of processingTime triggers")
+    parser.add_argument("--streaming-watermark", default="1 hour",
+                       help="Event-time lateness accepted on transaction_timestamp")
+    parser.add_argument("--streaming-state-ttl-days", type=int, default=90,
+                       help="Event-time days without transactions after which a customer's streaming state is dropped")
+    parser.add_argument("--streaming-max-files-per-trigger", type=int, default=100, help="Input files per micro-batch")
+    parser.add_argument("--streaming-format", default="delta", choices=["delta", "parquet"],
+                       help="Sink format of the streaming_transactions output")
+    parser.add_argument("--streaming-checkpoint-path",
+                       help="Streaming query checkpoint (default: <checkpoint or output>/_streaming/transactions)")
+    parser.add_argument("--engine", default="auto", choices=["auto", "spark", "duckdb"],
+                       help="Execution engine for batch runs (auto: duckdb for inputs below --duckdb-max-input-mb when "
+                            "no flag needs spark - it skips sketch sidecars, schema drift checks and executor stage metrics)")
+    parser.add_argument("--duckdb-max-input-mb", type=int, default=512,
+                       help="Largest raw input size that auto selects the duckdb engine for")
+    parser.add_argument("--scale-factors", default="1",
+                       help="Comma-separated synthetic data scale factors (generate: several are written to <input>/sf=<n>/)")
+    parser.add_argument("--skew", type=float, default=0.0, help="Share of synthetic transactions sent to a few hot customers")
+    parser.add_argument("--null-rate", type=float, default=0.0, help="Null rate of nullable synthetic columns")
+    parser.add_argument("--benchmark-iterations", type=int, default=3, help="Timed runs per benchmark stage")
+    parser.add_argument("--benchmark-results-path", help="Benchmark results directory (default: <output>/_benchmarks)")
+    parser.add_argument("--benchmark-compare", help="Commit whose stored benchmark results to compare against")
+    parser.add_argument("--plan-baseline", help="Plan shape baseline JSON (default: plan_baseline.json next to this script)")
+    parser.add_argument("--plan-fixture-path", help="Fixture data directory for plan-check (default: <output>/_plan_fixtures)")
+    parser.add_argument("--update-plan-baseline", action="store_true", help="Rewrite the plan baseline from the current plans")
+    parser.add_argument("--metrics-path", help="Per-step stage metrics report directory (default: <output>/_pipeline_metrics)")
+    parser.add_argument("--write-mode", default="auto", choices=["auto", "overwrite", "append", "upsert", "replace_partitions"],
+                       help="Output write mode (auto: upserts for incremental runs, otherwise overwrite; "
+                            "replace_partitions: overwrite only the partitions present in the data)")
+    parser.add_argument("--write-concurrency", type=int, default=3,
+                       help="Outputs written at the same time, each in its own FAIR scheduler pool (1: sequential)")
+    parser.add_argument("--driver-concurrency", type=int, default=4,
+                       help="Driver threads running independent read/quality/transform steps")
+    parser.add_argument("--target-file-size-mb", type=int, default=DEFAULT_TARGET_FILE_SIZE_MB,
+                       help="Target output file size used to plan write partitions (ignored with --coalesce-partitions)")
+    parser.add_argument("--exact-duplicates", action="store_true",
+                       help="Count duplicates exactly with a distinct() job instead of the single-pass estimate, "
+                            "which reports counts within its error bound (about 2.4%% of rows) as 0")
+    parser.add_argument("--quality-mode", default="exact", choices=["exact", "sketch"],
+                       help="Data quality profiling mode (sketch persists mergeable per-partition sketches)")
+    parser.add_argument("--sketch-path", help="Directory for profile sketch sidecars (default: <checkpoint or output>/_quality_sketches)")
+    parser.add_argument("--refresh-sketches", action="store_true", help="Rebuild the sketch of the current data date")
+    parser.add_argument("--broadcast-threshold-mb", type=int, default=DEFAULT_BROADCAST_THRESHOLD_BYTES // (1024 * 1024),
+                       help="Estimated size below which the smaller join side is broadcast")
+    parser.add_argument("--incremental", action="store_true",
+                       help="Only read input files that arrived after the stored high-water mark (implies "
+                            "--incremental-aggregates; with --write-mode auto customers and transactions are upserted)")
+    parser.add_argument("--incremental-lookback-hours", type=float, default=24,
+                       help="With --incremental: files this far below the high-water mark are still picked up if unprocessed")
+    parser.add_argument("--full-refresh", action="store_true",
+                       help="Reprocess all input files: re-list every input directory and, with --incremental, "
+                            "reset the high-water marks")
+    parser.add_argument("--state-path", help="Ingestion state directory (default: <checkpoint or output>/_ingestion_state)")
+    parser.add_argument("--file-index-path", help="Input file manifest directory (default: <checkpoint or output>/_file_index)")
+    parser.add_argument("--file-index-refresh-partitions", type=int, default=2,
+                       help="Newest top-level input directories re-listed on stores without directory mtimes")
+    parser.add_argument("--file-index-full-relist-hours", type=float, default=24,
+                       help="Hours after which every input directory is listed again, finding files backfilled "
+                            "into older partitions (0: every run)")
+    parser.add_argument("--schema-cache-path", help="Footer fingerprint cache directory (default: <checkpoint or output>/_schema_fingerprints)")
+    parser.add_argument("--aggregate-grains",
+                       help=f"Comma-separated aggregate tables to build (default: all of {','.join(AGGREGATE_GRAINS)})")
+    parser.add_argument("--incremental-aggregates", action="store_true",
+                       help="Refresh aggregates from the change data feed of processed_transactions since the last "
+                            "refreshed version (first run, --full-refresh or an unreadable feed: full rebuild)")
+    parser.add_argument("--bloom-prefilter", action="store_true",
+                       help="Drop transactions of filtered-out customers with a Bloom filter before the join shuffle")
+    parser.add_argument("--bloom-fpp", type=float, default=0.01, help="Bloom prefilter false-positive probability")
+    parser.add_argument("--bloom-max-num-bits", type=int, default=DEFAULT_BLOOM_MAX_NUM_BITS,
+                       help="Largest Bloom prefilter in bits (default 8MB, as spark.sql.optimizer.runtime.bloomFilter.maxNumBits); "
+                            "a build side needing more skips the prefilter")
+    parser.add_argument("--skew-join", action="store_true", help="Detect hot join keys by sampling and salt them")
+    parser.add_argument("--skew-threshold", type=float, default=0.05,
+                       help="Fraction of sampled rows a join key must hold to be treated as hot")
+    parser.add_argument("--skew-salt-buckets", type=int, default=16, help="Salt buckets per hot join key")
+    parser.add_argument("--skew-sample-fraction", type=float, default=0.01, help="Row sample fraction for hot-key detection")
+    parser.add_argument("--quality-thresholds", help="JSON object of quality thresholds (default mirrors the Airflow DAG)")
     
     return parser.parse_args()
 
@@ -624,17 +4492,42 @@ def main():
     args = parse_arguments()
     config = SparkJobConfig(args)
     
-    # Create Spark session
-    spark = create_spark_session(config)
+    # Small batch runs skip the JVM and Spark session startup entirely
+    if DuckDBEngine.select_engine(config) == "duckdb":
+        try:
+            DuckDBEngine(config).run()
+        except Exception as e:
+            logger.error(f"Job failed with error: {str(e)}")
+            sys.exit(1)
+        return
     
-    # Apply additional optimizations
-    optimizer = SparkOptimizer()
-    spark = optimizer.optimize_spark_session(spark, config)
+    # Create Spark session (static and runtime configs, startup timing)
+    spark = create_spark_session(config)
     
     try:
         # Create and run ETL processor
         processor = ETLJobProcessor(spark, config)
-        processor.run_etl_pipeline()
+        if config.mode == "generate":
+            # Several scale factors get one input root each (sf=<n>/) instead of overwriting one another
+            for scale_factor in config.scale_factors:
+                input_path = config.input_path if len(config.scale_factors) == 1 \
+                    else f"{config.input_path.rstrip('/')}/sf={scale_factor:g}"
+                SyntheticDataGenerator(spark, scale_factor, config.skew, config.null_rate,
+                                       data_date=config.data_date).write(input_path)
+        elif config.mode == "plan-check":
+            PlanRegressionGuard(processor, config.plan_baseline_path, config.plan_fixture_path).check(
+                update_baseline=config.update_plan_baseline
+            )
+        elif config.mode == "parity":
+            EngineParityCheck(processor).run()
+        elif config.mode == "streaming":
+            StreamingTransactionPipeline(processor).run()
+        elif config.mode == "benchmark":
+            BenchmarkRunner(processor, config.benchmark_results_path, config.benchmark_iterations).run(
+                config.scale_factors, config.skew, config.null_rate, config.benchmark_compare
+            )
+        else:
+            processor.run_etl_pipeline()
         
     except Exception as e:
         logger.error(f"Job failed with error: {str(e)}")